@@ -0,0 +1,263 @@
+"""
+Benchmarks for the import pipeline, run against a local stand-in rather than production.
+
+SQL benchmarks need a scratch SQL Server, e.g. a local container:
+    docker run -e ACCEPT_EULA=Y -e MSSQL_SA_PASSWORD=<password> -p 1433:1433 mcr.microsoft.com/mssql/server:2022-latest
+
+Usage:
+    python benchmark.py staging --conn "<odbc connection string>" [--rows 100000] [--batch-size 5000] [--trace]
+    python benchmark.py formats --xlsx <certificate.xlsx> [--xlsb <same certificate.xlsb>] [--repeat 3]
+    python benchmark.py imports [--module function_app] [--budget-ms 300] [--repeat 5]
+
+imports exits with status 1 when the cold import is over budget or imports one of
+lazy_imports.DEFERRED_MODULES, so it can gate a build.
+"""
+import argparse
+import io
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import lab_formats
+import lazy_imports
+import sql
+import sql_tracing
+import utils
+
+BENCHMARK_TABLE = 'benchmark_assay_result'
+
+# cold import of function_app.py allowed, in milliseconds
+IMPORT_BUDGET_MS = 300
+
+# same shape as the assay_result columns written by http_lab
+BENCHMARK_COLUMNS = {
+    'source_name': 'varchar(255)',
+    'sample_id': 'varchar(50) NOT NULL',
+    'lab_method': 'varchar(50) NOT NULL',
+    'analyte': 'varchar(50) NOT NULL',
+    'unit': 'varchar(20)',
+    'text_value': 'varchar(50)',
+    'qualifier': 'varchar(2)',
+    'value': 'float',
+    'job_title': 'varchar(100)',
+    'srk_import_timestamp': 'datetime',
+}
+
+
+def synthetic_results(rows: int, analytes: int = 50, seed: int = 0) -> pd.DataFrame:
+    """
+    Long-format assay frame with `rows` rows, categorical keys as produced by utils.clean_lab_results().
+    """
+    rng = np.random.default_rng(seed)
+    samples = -(-rows // analytes)
+    sample_id = np.repeat([f'S{i:07d}' for i in range(samples)], analytes)[:rows]
+    analyte = np.tile([f'EL{i:02d}' for i in range(analytes)], samples)[:rows]
+    value = np.round(rng.random(rows) * 100, 3)
+    return pd.DataFrame({
+        'source_name': 'benchmark.xlsx',
+        'sample_id': pd.Categorical(sample_id),
+        'lab_method': pd.Categorical(np.where(np.char.endswith(analyte.astype(str), '0'), 'Au-AA23', 'ME-ICP61')),
+        'analyte': pd.Categorical(analyte),
+        'unit': pd.Categorical(np.full(rows, 'ppm')),
+        'text_value': value.astype(str),
+        'qualifier': pd.Categorical([None] * rows, categories=['<', '>']),
+        'value': value,
+        'job_title': pd.Categorical(np.full(rows, 'BENCHMARK - FINAL')),
+        'srk_import_timestamp': '2024-01-01 00:00:00',
+    })
+
+
+def benchmark_staging(conn_string: str, rows: int, batch_size: int, logger) -> list:
+    """
+    Load the same synthetic frame with each of sql.STAGING_METHODS into an empty scratch table.
+
+    Returns:
+        list: one dictionary per method with seconds and rows per second
+    """
+    cnxn, error = sql.open_database(conn_string, logger)
+    if cnxn is None:
+        raise RuntimeError(error)
+    cursor = cnxn.cursor()
+    df = synthetic_results(rows)
+    column_mappings = {col: col for col in BENCHMARK_COLUMNS}
+    match_conditions = {'sample_id': 'sample_id', 'lab_method': 'lab_method', 'analyte': 'analyte'}
+
+    results = []
+    for method in sql.STAGING_METHODS:
+        cursor.execute(f"IF OBJECT_ID('{BENCHMARK_TABLE}') IS NOT NULL DROP TABLE {BENCHMARK_TABLE}")
+        cursor.execute(f"CREATE TABLE {BENCHMARK_TABLE} ({', '.join(f'{col} {definition}' for col, definition in BENCHMARK_COLUMNS.items())})")
+        cnxn.commit()
+
+        start = time.perf_counter()
+        result = sql.db_insert_batch(cnxn, df, BENCHMARK_TABLE, column_mappings, match_conditions, logger, batch_size, stage_method=method)
+        seconds = time.perf_counter() - start
+        if result['status'] != 'success':
+            raise RuntimeError(f"{method}: {result['status']}")
+        results.append({'method': method, 'rows': rows, 'seconds': round(seconds, 3), 'rows_per_second': round(rows / seconds)})
+
+    cursor.execute(f"DROP TABLE {BENCHMARK_TABLE}")
+    cnxn.commit()
+    cnxn.close()
+    return results
+
+
+def trace_statements():
+    """
+    Send the statement spans of sql_tracing to an in-memory exporter.
+
+    Returns:
+        InMemorySpanExporter whose finished spans sql_tracing.statement_summary() ranks
+    """
+    from opentelemetry import trace
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    return exporter
+
+
+def clean_certificate(data: bytes, filename: str) -> pd.DataFrame:
+    """
+    Header and results cleaning of one certificate, as http_lab runs it.
+    """
+    df_workbook = utils.open_workbook(io.BytesIO(data), filename)
+    first_rows = utils.first_rows(df_workbook)
+    layout, reasons = lab_formats.detect_layout(first_rows)
+    if layout is None:
+        raise ValueError(' '.join(reasons))
+    df_headers = utils.clean_lab_header(df_workbook, first_rows, layout)
+    return utils.join_lab_header(utils.clean_lab_results(df_workbook, layout), df_headers, filename, layout.laboratory, '')
+
+
+def benchmark_formats(xlsx_path: str, xlsb_path: str = None, repeat: int = 3) -> list:
+    """
+    Clean the same certificate from xlsx, from CSV and tab separated exports of its first sheet,
+    and from xlsb when an Excel export of it is given (there is no Python writer for xlsb).
+
+    Returns:
+        list: one dictionary per format with the best of `repeat` runs
+    """
+    df_sheet = pd.read_excel(xlsx_path, header=None, sheet_name=0)
+    sources = {'xlsx': (xlsx_path, open(xlsx_path, 'rb').read())}
+    for extension, sep in (('csv', ','), ('txt', '\t')):
+        buffer = io.StringIO()
+        df_sheet.to_csv(buffer, header=False, index=False, sep=sep)
+        sources[extension] = (os.path.join(tempfile.gettempdir(), f'benchmark.{extension}'), buffer.getvalue().encode())
+    if xlsb_path:
+        sources['xlsb'] = (xlsb_path, open(xlsb_path, 'rb').read())
+
+    results = []
+    for name, (path, data) in sources.items():
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            df = clean_certificate(data, path)
+            seconds.append(time.perf_counter() - start)
+        best = min(seconds)
+        results.append({'format': name, 'bytes': len(data), 'rows': len(df), 'seconds': round(best, 3), 'rows_per_second': round(len(df) / best)})
+    xlsx_seconds = results[0]['seconds']
+    for result in results:
+        result['speedup_vs_xlsx'] = round(xlsx_seconds / result['seconds'], 1) if result['seconds'] else None
+    return results
+
+
+def parse_importtime(stderr: str) -> list:
+    """
+    Rows of `python -X importtime` output, e.g.
+        import time:       412 |      98837 |     azure.functions
+
+    Returns:
+        list: one dictionary per imported module with self_us, cumulative_us and depth
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append({'module': name.strip(), 'self_us': int(self_us), 'cumulative_us': int(cumulative_us), 'depth': depth})
+    return rows
+
+
+def benchmark_imports(module: str = 'function_app', budget_ms: float = IMPORT_BUDGET_MS, repeat: int = 5) -> dict:
+    """
+    Cold import `module` in fresh interpreters with -X importtime and check it against the budget.
+
+    Returns:
+        dict: best milliseconds, the slowest imports of the best run, the deferred modules
+        imported eagerly and a status of 'success' or 'failed'
+    """
+    best = None
+    for _ in range(repeat):
+        run = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if run.returncode != 0:
+            raise RuntimeError(run.stderr.strip().splitlines()[-1])
+        rows = parse_importtime(run.stderr)
+        total = next(row['cumulative_us'] for row in rows if row['module'] == module and row['depth'] == 0)
+        if best is None or total < best[0]:
+            best = (total, rows)
+    total, rows = best
+    imported = {row['module'] for row in rows}
+    eager = [name for name in lazy_imports.DEFERRED_MODULES if name in imported]
+    milliseconds = round(total / 1000, 1)
+    return {
+        'module': module,
+        'milliseconds': milliseconds,
+        'budget_ms': budget_ms,
+        'eager': eager,
+        'slowest': sorted(rows, key=lambda row: row['self_us'], reverse=True)[:15],
+        'status': 'success' if milliseconds <= budget_ms and not eager else 'failed',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    staging = subparsers.add_parser('staging', help='compare the #TempLabBatch staging methods')
+    staging.add_argument('--conn', required=True, help='ODBC connection string of a scratch database')
+    staging.add_argument('--rows', type=int, default=100000)
+    staging.add_argument('--batch-size', type=int, default=5000)
+    staging.add_argument('--trace', action='store_true', help='rank the SQL statements by time, needs opentelemetry-sdk')
+    formats = subparsers.add_parser('formats', help='compare cleaning the same certificate from xlsx, CSV, TXT and xlsb')
+    formats.add_argument('--xlsx', required=True, help='certificate to benchmark')
+    formats.add_argument('--xlsb', help='the same certificate saved as xlsb from Excel')
+    formats.add_argument('--repeat', type=int, default=3)
+    imports = subparsers.add_parser('imports', help='check the cold import time of the function app against a budget')
+    imports.add_argument('--module', default='function_app')
+    imports.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    imports.add_argument('--repeat', type=int, default=5, help='fresh interpreters, the fastest counts')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('benchmark')
+    if args.benchmark == 'staging':
+        exporter = trace_statements() if args.trace else None
+        results = benchmark_staging(args.conn, args.rows, args.batch_size, logger)
+        if exporter is not None:
+            print(pd.DataFrame(sql_tracing.statement_summary(exporter.get_finished_spans())).to_string(index=False))
+    elif args.benchmark == 'formats':
+        results = benchmark_formats(args.xlsx, args.xlsb, args.repeat)
+    elif args.benchmark == 'imports':
+        result = benchmark_imports(args.module, args.budget_ms, args.repeat)
+        print(pd.DataFrame(result['slowest']).to_string(index=False))
+        print(f"\nimport {result['module']}: {result['milliseconds']} ms, budget {result['budget_ms']} ms")
+        if result['eager']:
+            print(f"Imported eagerly, should be deferred: {', '.join(result['eager'])}")
+        if result['status'] != 'success':
+            sys.exit(1)
+        return
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+"""
+Health check of the database behind the lab import.
+
+Verifies the unique index on the match keys that the staging MERGE relies on, and reports the
+target table's indexes and statistics. It then captures the actual execution plan, with
+STATISTICS IO and TIME, of two statements: a representative MERGE, run the way
+sql.stage_and_insert() runs it inside a transaction that is rolled back, and a key lookup
+with parameters bound as http_lab binds them. The plans are checked for scans of the target
+table, implicit conversions (e.g. varchar keys compared with nvarchar parameters) and
+missing index suggestions.
+
+Try it against a local SQL Server container before pointing it at a shared database:
+    docker run -e ACCEPT_EULA=Y -e MSSQL_SA_PASSWORD=<password> -p 1433:1433 mcr.microsoft.com/mssql/server:2022-latest
+
+Usage:
+    python db_health.py --conn "<odbc connection string>" [--table assay_result] [--file <certificate>] [--rows 5000]
+    python db_health.py --keyvault <vault name> [--json report.json] [--create-index] [--migrate]
+
+Without --file the MERGE is run on rows already in the table, i.e. every row matches.
+--create-index and --migrate are the admin changes an import never makes itself: the unique
+key index, and the columns of sql.SCHEMA_COLUMNS (e.g. row_hash for upserts).
+"""
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import re
+from xml.etree import ElementTree
+
+import pandas as pd
+
+import lab_formats
+import sql
+import utils
+import variables as var
+
+SHOWPLAN = '{http://schemas.microsoft.com/sqlserver/2004/07/showplan}'
+SHOWPLAN_COLUMN = 'Microsoft SQL Server 2005 XML Showplan'
+
+# operators reading a whole index or heap
+SCAN_OPERATORS = ('Table Scan', 'Clustered Index Scan', 'Index Scan', 'Columnstore Index Scan')
+
+
+def table_indexes(cursor, table: str) -> list:
+    """
+    Indexes of `table` with their key and included columns, size and fragmentation.
+    """
+    cursor.execute("""
+        SELECT i.name, i.type_desc, i.is_unique, i.is_primary_key,
+            STRING_AGG(CASE WHEN ic.is_included_column = 0 THEN c.name END, ',') WITHIN GROUP (ORDER BY ic.key_ordinal),
+            STRING_AGG(CASE WHEN ic.is_included_column = 1 THEN c.name END, ','),
+            MAX(ps.page_count), MAX(ps.avg_fragmentation_in_percent)
+        FROM sys.indexes AS i
+        JOIN sys.index_columns AS ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+        JOIN sys.columns AS c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+        OUTER APPLY sys.dm_db_index_physical_stats(DB_ID(), i.object_id, i.index_id, NULL, 'LIMITED') AS ps
+        WHERE i.object_id = OBJECT_ID(?) AND i.type > 0
+        GROUP BY i.name, i.type_desc, i.is_unique, i.is_primary_key
+    """, table)
+    return [
+        {
+            'name': name,
+            'type': type_desc,
+            'unique': bool(is_unique),
+            'primary_key': bool(is_primary_key),
+            'key_columns': key_columns.split(',') if key_columns else [],
+            'included_columns': included.split(',') if included else [],
+            'pages': pages,
+            'fragmentation_percent': round(fragmentation, 1) if fragmentation is not None else None,
+        }
+        for name, type_desc, is_unique, is_primary_key, key_columns, included, pages, fragmentation in cursor.fetchall()
+    ]
+
+
+def key_index(indexes: list, key_columns: list):
+    """
+    The unique index whose key columns are exactly the match keys, in any order, or None.
+    """
+    wanted = {col.lower() for col in key_columns}
+    for index in indexes:
+        if index['unique'] and {col.lower() for col in index['key_columns']} == wanted:
+            return index
+    return None
+
+
+def table_statistics(cursor, table: str) -> list:
+    """
+    Statistics of `table` with their age, sampling and modifications since the last update.
+    Statistics are stale once the modifications pass SQL Server's automatic update threshold.
+    """
+    cursor.execute("""
+        SELECT s.name, sp.last_updated, sp.rows, sp.rows_sampled, sp.modification_counter
+        FROM sys.stats AS s
+        CROSS APPLY sys.dm_db_stats_properties(s.object_id, s.stats_id) AS sp
+        WHERE s.object_id = OBJECT_ID(?)
+    """, table)
+    statistics = []
+    for name, last_updated, rows, rows_sampled, modifications in cursor.fetchall():
+        threshold = min(500 + 0.2 * (rows or 0), math.sqrt(1000 * (rows or 0))) if rows else 500
+        statistics.append({
+            'name': name,
+            'last_updated': str(last_updated),
+            'rows': rows,
+            'sampled_percent': round(100 * rows_sampled / rows, 1) if rows else None,
+            'modifications': modifications,
+            'stale': (modifications or 0) > threshold,
+        })
+    return statistics
+
+
+def capture_plan(cursor, statement: str, params=()) -> dict:
+    """
+    Run a statement with STATISTICS XML, IO and TIME on.
+
+    Returns:
+        dict: the actual plan XML, the server's IO and TIME messages, and the other result sets
+    """
+    for option in ('XML', 'IO', 'TIME'):
+        cursor.execute(f"SET STATISTICS {option} ON")
+    try:
+        if params:
+            cursor.execute(statement, *params)
+        else:
+            cursor.execute(statement)
+        plans, messages, results = [], [], []
+        while True:
+            messages += [text for _, text in getattr(cursor, 'messages', None) or []]
+            if cursor.description:
+                if cursor.description[0][0] == SHOWPLAN_COLUMN:
+                    plans.append(cursor.fetchone()[0])
+                else:
+                    results.append(cursor.fetchall())
+            if not cursor.nextset():
+                break
+    finally:
+        for option in ('XML', 'IO', 'TIME'):
+            cursor.execute(f"SET STATISTICS {option} OFF")
+    return {'plans': plans, 'messages': messages, 'results': results}
+
+
+def parse_statistics(messages: list) -> dict:
+    """
+    Logical and physical reads per table, and CPU and elapsed milliseconds, from STATISTICS IO/TIME messages.
+    """
+    io_stats = {}
+    cpu_ms = elapsed_ms = 0
+    for message in messages:
+        for table, scans, logical, physical in re.findall(r"Table '([^']+)'\. Scan count (\d+), logical reads (\d+), physical reads (\d+)", message):
+            # temp tables are reported with a generated suffix
+            table = re.sub(r'_{5,}\w+$', '', table)
+            counts = io_stats.setdefault(table, {'scan_count': 0, 'logical_reads': 0, 'physical_reads': 0})
+            counts['scan_count'] += int(scans)
+            counts['logical_reads'] += int(logical)
+            counts['physical_reads'] += int(physical)
+        # the execution times, not the parse and compile times
+        for cpu, elapsed in re.findall(r'Execution Times:\s*CPU time = (\d+) ms,\s*elapsed time = (\d+) ms', message):
+            cpu_ms += int(cpu)
+            elapsed_ms += int(elapsed)
+    return {'io': io_stats, 'cpu_ms': cpu_ms, 'elapsed_ms': elapsed_ms}
+
+
+def plan_findings(plan_xml: str, table: str) -> dict:
+    """
+    Operators of an actual plan, with scans of `table`, implicit conversions and missing index suggestions.
+    """
+    root = ElementTree.fromstring(plan_xml)
+    operators, scans = [], []
+    for relop in root.iter(f'{SHOWPLAN}RelOp'):
+        obj = next((child for scan in relop for child in scan if child.tag == f'{SHOWPLAN}Object'), None)
+        target = obj.get('Table', '').strip('[]') if obj is not None else ''
+        # one counter per thread, only in actual plans
+        runtime = relop.find(f'{SHOWPLAN}RunTimeInformation')
+        actual_rows = sum(int(counter.get('ActualRows', 0)) for counter in runtime) if runtime is not None else None
+        operator = {
+            'operator': relop.get('PhysicalOp'),
+            'logical': relop.get('LogicalOp'),
+            'object': f"{target}.{obj.get('Index', '').strip('[]')}".strip('.') if obj is not None else '',
+            'estimated_rows': float(relop.get('EstimateRows', 0)),
+            'actual_rows': actual_rows,
+        }
+        operators.append(operator)
+        if operator['operator'] in SCAN_OPERATORS and target.lower() == table.lower():
+            scans.append(operator)
+
+    expressions = [warning.get('Expression', '') for warning in root.iter(f'{SHOWPLAN}PlanAffectingConvert')]
+    expressions += [scalar.get('ScalarString', '') for scalar in root.iter(f'{SHOWPLAN}ScalarOperator')]
+    conversions = {
+        conversion
+        for expression in expressions
+        for conversion in re.findall(r'CONVERT_IMPLICIT\([^()]*(?:\([^()]*\))?[^()]*\)', expression)
+    }
+
+    missing_indexes = []
+    for group in root.iter(f'{SHOWPLAN}MissingIndexGroup'):
+        columns = {
+            column_group.get('Usage'): [column.get('Name').strip('[]') for column in column_group.iter(f'{SHOWPLAN}Column')]
+            for column_group in group.iter(f'{SHOWPLAN}ColumnGroup')
+        }
+        missing_indexes.append({'impact': float(group.get('Impact', 0)), **columns})
+
+    return {
+        'operators': operators,
+        'scans': scans,
+        'implicit_conversions': sorted(conversions),
+        'missing_indexes': missing_indexes,
+    }
+
+
+def analyse_statement(cursor, statement: str, params, table: str) -> dict:
+    """ capture_plan() and the findings of every plan it returned """
+    captured = capture_plan(cursor, statement, params)
+    findings = {'operators': [], 'scans': [], 'implicit_conversions': [], 'missing_indexes': []}
+    for plan in captured['plans']:
+        for key, values in plan_findings(plan, table).items():
+            findings[key] += [value for value in values if value not in findings[key]]
+    return {**parse_statistics(captured['messages']), **findings, 'plans': captured['plans']}
+
+
+def certificate_rows(path: str) -> pd.DataFrame:
+    """
+    Cleaned results of a certificate, as http_lab would load them.
+    """
+    with open(path, 'rb') as file:
+        df_workbook = utils.open_workbook(io.BytesIO(file.read()), path)
+    first_rows = utils.first_rows(df_workbook)
+    layout, reasons = lab_formats.detect_layout(first_rows)
+    if layout is None:
+        raise ValueError('File Format Incorrect. ' + ' '.join(reasons))
+    df_headers = utils.clean_lab_header(df_workbook, first_rows, layout)
+    df = utils.join_lab_header(utils.clean_lab_results(df_workbook, layout), df_headers, os.path.basename(path), layout.laboratory, pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'))
+    df, _ = utils.resolve_duplicate_keys(df, list(var.ASSAY_MATCH_CONDITIONS), 'first')
+    return df
+
+
+def table_rows(cursor, table: str, column_mappings: dict, rows: int) -> pd.DataFrame:
+    """
+    Up to `rows` rows already in `table`, with the DataFrame column names of column_mappings.
+    """
+    cursor.execute(f"SELECT TOP (?) {', '.join(column_mappings.values())} FROM {table}", rows)
+    return pd.DataFrame([tuple(row) for row in cursor.fetchall()], columns=list(column_mappings))
+
+
+def check(cnxn, table: str, column_mappings: dict, match_conditions: dict, df: pd.DataFrame, logger, stage_method='executemany', create_index=False, migrate=False) -> dict:
+    """
+    Inspect `table` and the plans of its load statements.
+
+    Returns:
+        dict: the report, with 'findings' listing what needs attention
+    """
+    cursor = cnxn.cursor()
+    report = {'table': table, 'findings': []}
+    findings = report['findings']
+    key_columns = list(match_conditions)
+    definitions = {col[0].lower(): col for col in sql.column_definitions(cursor, table)}
+    if not definitions:
+        raise ValueError(f"Table {table} not found")
+
+    if migrate:
+        try:
+            added = sql.add_columns(cnxn, table, sql.SCHEMA_COLUMNS)
+            if added:
+                findings.append(f"Added columns {', '.join(added)} to {table}.")
+                definitions = {col[0].lower(): col for col in sql.column_definitions(cursor, table)}
+        except Exception as e:
+            cnxn.rollback()
+            findings.append(f"Could not add the columns of sql.SCHEMA_COLUMNS: {e}")
+    report['missing_columns'] = [col for col in sql.SCHEMA_COLUMNS if col.lower() not in definitions]
+    if report['missing_columns']:
+        findings.append(f"{table} is missing {', '.join(report['missing_columns'])}, upserts fail until it is added. Rerun with --migrate.")
+
+    # re-assays of a key are separate rows, numbered in the reassay column once it is migrated
+    index_columns = key_columns + ([utils.REASSAY_COLUMN] if utils.REASSAY_COLUMN in definitions else [])
+    report['indexes'] = table_indexes(cursor, table)
+    index = key_index(report['indexes'], index_columns)
+    if index is None and create_index:
+        name = f"ux_{table}_key"
+        try:
+            cursor.execute(f"CREATE UNIQUE INDEX {name} ON {table} ({', '.join(index_columns)})")
+            cnxn.commit()
+            findings.append(f"Created unique index {name} on ({', '.join(index_columns)}).")
+            report['indexes'] = table_indexes(cursor, table)
+            index = key_index(report['indexes'], index_columns)
+        except Exception as e:
+            cnxn.rollback()
+            findings.append(f"Could not create unique index {name}: {e}")
+    report['key_index'] = index['name'] if index else None
+    if index is None:
+        findings.append(f"No unique index on ({', '.join(index_columns)}): every MERGE has to scan {table}. Rerun with --create-index.")
+    elif [col.lower() for col in index['key_columns']][:1] != [key_columns[0].lower()]:
+        findings.append(f"Index {index['name']} does not lead with {key_columns[0]}, the key range each batch is limited to.")
+    if not any(index['type'] == 'CLUSTERED' for index in report['indexes']):
+        findings.append(f"{table} is a heap.")
+    for fragmented in [index for index in report['indexes'] if (index['pages'] or 0) > 1000 and (index['fragmentation_percent'] or 0) > 30]:
+        findings.append(f"Index {fragmented['name']} is {fragmented['fragmentation_percent']}% fragmented over {fragmented['pages']} pages.")
+
+    report['statistics'] = table_statistics(cursor, table)
+    for stale in [statistic for statistic in report['statistics'] if statistic['stale']]:
+        findings.append(f"Statistics {stale['name']} are stale: {stale['modifications']} modifications since {stale['last_updated']}.")
+
+    if len(df):
+        # the representative MERGE, exactly as a batch is loaded, then undone
+        temp_table_columns = sql.temp_table_definition(cursor, table)
+        try:
+            sql.create_temp_batch(cursor, temp_table_columns, match_conditions, logger)
+            sql.stage_batch(cursor, df, table, column_mappings, stage_method, logger)
+            report['merge'] = analyse_statement(cursor, sql.insert_merge_statement(cursor, table, column_mappings, match_conditions), (), table)
+            report['merge']['rows'] = len(df)
+        finally:
+            cnxn.rollback()
+
+        # a key lookup with the parameters bound as pyodbc binds Python strings
+        key_row = sql.batch_params(df.head(1), sql.key_columns(column_mappings, match_conditions))[0]
+        lookup = f"SELECT COUNT(*) FROM {table} WHERE {' AND '.join([f'{col} = ?' for col in key_columns])}"
+        report['lookup'] = analyse_statement(cursor, lookup, key_row, table)
+        cnxn.rollback()
+
+        for name in ('merge', 'lookup'):
+            for scan in report[name]['scans']:
+                findings.append(f"The {name} scans {scan['object']} ({scan['operator']}, {scan['actual_rows']} rows read).")
+            for conversion in report[name]['implicit_conversions']:
+                findings.append(f"The {name} converts implicitly: {conversion}.")
+            for missing in report[name]['missing_indexes']:
+                findings.append(f"The {name} suggests an index (impact {missing['impact']:.0f}%): {missing}.")
+        if any(definitions[col.lower()][1] in ('varchar', 'char') for col in key_columns) and report['lookup']['implicit_conversions']:
+            findings.append("varchar key columns compared with nvarchar parameters, bind them as varchar with cursor.setinputsizes() or stage them first.")
+    else:
+        findings.append("No rows to run a representative MERGE with, give a certificate with --file.")
+
+    cursor.close()
+    return report
+
+
+def print_report(report: dict):
+    print(f"Table {report['table']}, key index: {report['key_index'] or 'MISSING'}")
+    print("\nIndexes:")
+    for index in report['indexes']:
+        print(f"  {index['name']} {index['type']}{' UNIQUE' if index['unique'] else ''} ({', '.join(index['key_columns'])})"
+              + (f" INCLUDE ({', '.join(index['included_columns'])})" if index['included_columns'] else '')
+              + f", {index['pages']} pages, {index['fragmentation_percent']}% fragmented")
+    print("\nStatistics:")
+    for statistic in report['statistics']:
+        print(f"  {statistic['name']}: updated {statistic['last_updated']}, {statistic['rows']} rows, {statistic['sampled_percent']}% sampled, {statistic['modifications']} modifications{' STALE' if statistic['stale'] else ''}")
+    for name in ('merge', 'lookup'):
+        if name not in report:
+            continue
+        result = report[name]
+        print(f"\n{name.capitalize()}: {result['cpu_ms']} ms CPU, {result['elapsed_ms']} ms elapsed")
+        for table, counts in result['io'].items():
+            print(f"  {table}: {counts['scan_count']} scans, {counts['logical_reads']} logical reads, {counts['physical_reads']} physical reads")
+        for operator in result['operators']:
+            print(f"  {operator['operator']} {operator['object']} estimated {operator['estimated_rows']:.0f}, actual {operator['actual_rows']} rows")
+    print("\nFindings:")
+    for finding in report['findings'] or ['None']:
+        print(f"  {finding}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    connection = parser.add_mutually_exclusive_group(required=True)
+    connection.add_argument('--conn', help='ODBC connection string')
+    connection.add_argument('--keyvault', help="key vault holding the 'sql-connection' secret")
+    parser.add_argument('--table', default=var.ASSAY_TABLE)
+    parser.add_argument('--file', help='certificate whose cleaned rows are used for the representative MERGE')
+    parser.add_argument('--rows', type=int, default=5000, help='rows taken from the table when no --file is given')
+    parser.add_argument('--stage-method', choices=sql.STAGING_METHODS, default='executemany')
+    parser.add_argument('--create-index', action='store_true', help='create the unique key index when it is missing')
+    parser.add_argument('--migrate', action='store_true', help='add the columns of sql.SCHEMA_COLUMNS the table is missing')
+    parser.add_argument('--json', help='also write the report, with the plan XML, to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('db_health')
+
+    conn_string = args.conn
+    if not conn_string:
+        conn_string, log = utils.get_sql_connection(args.keyvault, logger)
+        if conn_string is None:
+            parser.error(log)
+    cnxn, error = sql.open_database(conn_string, logger)
+    if cnxn is None:
+        parser.error(error)
+
+    cursor = cnxn.cursor()
+    df = certificate_rows(args.file) if args.file else table_rows(cursor, args.table, var.ASSAY_COLUMN_MAPPINGS, args.rows)
+    cursor.close()
+    report = check(cnxn, args.table, var.ASSAY_COLUMN_MAPPINGS, var.ASSAY_MATCH_CONDITIONS, df, logger, args.stage_method, args.create_index, args.migrate)
+    cnxn.close()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2, default=str)
+        print(f"\nReport written to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,39 @@ import azure.functions as func
 import logging
 import utils
 import sql
-import pandas as pd
+import lab_formats
+import profiling
+import json
+import os
 import variables as var
+import warmup
 from datetime import datetime
 
 br = '<br>'
 
+# imports too large for http_lab's memory budget are queued here, see utils.plan_import()
+DEFERRED_QUEUE = 'lab-import-deferred'
+
+# keep-warm timer, every 10 minutes from 04:00 to 18:50 (UTC unless WEBSITE_TIME_ZONE is set),
+# and the Key Vault it primes since a timer has no request to name one
+WARM_SCHEDULE = '0 */10 4-18 * * *'
+WARM_KEYVAULT = os.environ.get('LAB_IMPORT_KEYVAULT')
+
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
 @app.route(route="http_lab")
-def http_lab(req: func.HttpRequest) -> func.HttpResponse:
+@app.queue_output(arg_name="deferred", queue_name=DEFERRED_QUEUE, connection="AzureWebJobsStorage")
+def http_lab(req: func.HttpRequest, deferred: func.Out[str]) -> func.HttpResponse:
     logging.info('Lab trigger function processed a request.')
 
     # get variables from http request
     path = req.params.get('path')
     container = req.params.get('container')
     vault_id = req.params.get('keyvault')
+    duplicate_policy = req.params.get('duplicates')
+    stream = req.params.get('stream')
+    mode = req.params.get('mode')
+    profile = req.params.get('profile')
 
     if not path:
         try:
@@ -28,7 +45,112 @@ def http_lab(req: func.HttpRequest) -> func.HttpResponse:
             path = req_body.get('path')
             container = req_body.get('container')
             vault_id = req_body.get('keyvault')
-    
+            duplicate_policy = req_body.get('duplicates')
+            stream = req_body.get('stream')
+            mode = req_body.get('mode')
+            profile = req_body.get('profile')
+    duplicate_policy = duplicate_policy or 'first'
+    mode = mode or 'insert'
+    stream = str(stream).lower() in ('true', '1', 'yes')
+    if not path:
+        return import_lab(path, container, vault_id, duplicate_policy, stream, mode, deferred)
+
+    # duplicate triggers for the same file wait for the first import and reuse its response,
+    # the key holds every parameter that changes the outcome, so e.g. an upsert never gets an insert's response
+    run = lambda: import_lab(path, container, vault_id, duplicate_policy, stream, mode, deferred)
+    profiled = bool(profile) and profiling.authorized(profile)
+    if profiled:
+        unprofiled = run
+        run = lambda: import_lab_profiled(path, container, vault_id, unprofiled)
+    elif profile:
+        logging.warning(f'Ignored an unauthorized profile request for {container}/{path}')
+    key = import_key(container, path, mode, duplicate_policy, stream, profiled)
+    response, shared = utils.single_flight(key, lambda: import_lab_exclusive(key, vault_id, run))
+    if shared:
+        logging.info(f'Reused the response of a concurrent import of {key}')
+    return utils.copy_response(response)
+
+def import_key(container, path, mode, duplicate_policy, stream, profiled=False) -> str:
+    """
+    Key of an import for single_flight() and the SQL application lock. The parameters come
+    first, as import_run_result keeps the first 450 characters of a key. A profiled import has
+    its own key, so it is never answered with the response of an unprofiled one.
+    """
+    return f"{'profile|' if profiled else ''}{mode}|{duplicate_policy}|{'stream' if stream else 'eager'}|{container}/{path}"
+
+def import_lab_exclusive(key: str, vault_id, run) -> func.HttpResponse:
+    """
+    Run an import under an SQL application lock on key, so a duplicate trigger on another
+    instance waits for it and reuses its response instead of importing the file again.
+    """
+    sql_conn_string, log_sql_conn = utils.get_sql_connection(vault_id, logging)
+    cnxn, log_sql_opendb = sql.open_database(sql_conn_string, logging, autocommit=True) if sql_conn_string else (None, log_sql_conn)
+    if cnxn is None:
+        logging.warning(f'Importing {key} without a cross-instance lock. {log_sql_opendb}')
+        return run()
+    try:
+        requested_at = sql.acquire_app_lock(cnxn, key, logging)
+        if requested_at is None:
+            return utils.create_response(key.rsplit('|', 1)[-1], 'failed', f'Timed out waiting for a concurrent import of {key}.', 'low', '', '', logger=logging)
+        try:
+            stored = sql.import_result_since(cnxn, key, requested_at)
+            if stored is not None:
+                logging.info(f'Reused the response of a concurrent import of {key} on another instance')
+                return func.HttpResponse(stored)
+            response = run()
+            sql.record_import_result(cnxn, key, response.get_body().decode())
+            return response
+        finally:
+            sql.release_app_lock(cnxn, key)
+    finally:
+        cnxn.close()
+
+def import_lab_profiled(path, container, vault_id, run) -> func.HttpResponse:
+    """
+    Run an import under the sampling profiler and tracemalloc, write the flame graph and
+    allocation sites next to the source file and link them from the response.
+    """
+    response, report = profiling.profile_call(run)
+    container_client, log_container = utils.get_container_client(vault_id, container, logging)
+    if container_client is None:
+        logging.warning(f'Profile of {path} not written. {log_container}')
+        return response
+    # the source blob is stored under its filename, the profile goes next to it
+    parsed_path = utils.parse_path(path)
+    filename = parsed_path['filename'] if parsed_path else path
+    written = profiling.write_profile(container_client, filename, report, logging)
+    if written['status'] != 'success':
+        return response
+    return utils.add_to_response(response, profile=written['flamegraph'], profile_allocations=written['allocations'])
+
+@app.queue_trigger(arg_name="msg", queue_name=DEFERRED_QUEUE, connection="AzureWebJobsStorage")
+def queue_lab(msg: func.QueueMessage):
+    """
+    Import a certificate deferred by http_lab. host.json sets the queue batch size to 1,
+    so a deferred import has the whole instance's memory to itself.
+    """
+    params = msg.get_json()
+    logging.info(f"Deferred lab import of {params['path']}")
+    response = import_lab(params['path'], params['container'], params['keyvault'], params['duplicates'], params['stream'], params['mode'])
+    logging.info(response.get_body().decode())
+
+@app.timer_trigger(arg_name="timer", schedule=WARM_SCHEDULE, run_on_startup=False, use_monitor=False)
+def warm_lab(timer: func.TimerRequest):
+    """
+    Keep the worker warm and prime its imports, token, secrets, pooled SQL connection and
+    parser, so the first import after an idle spell is as fast as the ones after it.
+    """
+    if timer.past_due:
+        logging.info('Warm-up timer is past due')
+    result = warmup.warm(WARM_KEYVAULT, logging)
+    if result['status'] != 'success':
+        logging.warning(f"Warm-up incomplete: {result['steps']}")
+
+def import_lab(path, container, vault_id, duplicate_policy='first', stream=False, mode='insert', deferred=None) -> func.HttpResponse:
+    """
+    Import one lab certificate, for http_lab and the deferred queue_lab.
+    With `deferred` set, a certificate too large for the memory budget is queued instead.
+    """
     logging.info(
         f"""Request Parameters: 
         container | {container}; 
@@ -58,14 +180,19 @@ def http_lab(req: func.HttpRequest) -> func.HttpResponse:
         project = ''
         comments = ''
         po_number = ''
+        duplicate_count = ''
+        rejected_count = ''
+        updated_count = ''
+        unchanged_count = ''
+        removed_count = ''
+        version = ''
         log = ''
 
-        # get file contents
-        df_workbook, log_fetch = utils.fetch_file_contents(vault_id, container, filename, logging)
-        if df_workbook is None:
-            log = 'Workbook not found. '
-            log += log_fetch + br
-            status = status
+        if duplicate_policy not in utils.DUPLICATE_POLICIES or mode not in utils.IMPORT_MODES:
+            if duplicate_policy not in utils.DUPLICATE_POLICIES:
+                log += f"Unknown duplicates policy '{duplicate_policy}'. Expected one of {', '.join(utils.DUPLICATE_POLICIES)}." + br
+            if mode not in utils.IMPORT_MODES:
+                log += f"Unknown mode '{mode}'. Expected one of {', '.join(utils.IMPORT_MODES)}." + br
             return utils.create_response(
                             filename, 
                             status, 
@@ -83,62 +210,107 @@ def http_lab(req: func.HttpRequest) -> func.HttpResponse:
                             po_number,
                             logging
                         )
-        logging.info('Fetch file contents successful')
 
-        # Check for PO Number
-        df_check = pd.read_excel(df_workbook, header=None, sheet_name=0)
-        po_number_check_value = df_check.iloc[6,0]
-        logging.info(f'PO Number check value: {po_number_check_value}')
-        logging.info(f'Sample check value: {df_check.iloc[8,0]}')
-        sample_check_value = df_check.iloc[8,0]
-        if 'PO NUMBER' not in  str(po_number_check_value).upper():
-            message = 'File Format Incorrect. PO NUMBER not found in the first column of the file.'
-            logging.error(message)
-            log += message + br
-            status = 'failed'
-            return utils.create_response(
-                            filename, 
-                            status, 
-                            log, 
-                            "low", 
-                            inserted_count,
-                            sample_count,
-                            work_order_status,
-                            client_ref,
-                            samples_submitted,
-                            date_received,
-                            date_finalized,
-                            project,
-                            comments,
-                            po_number,
-                            logging
-                        )
-        # Check for Sample
-        if 'SAMPLE' not in str(sample_check_value).upper():
-            message = 'File Format Incorrect. SAMPLE not found in the first column of the file.'
-            logging.error(message)
-            log += message + br
-            status = 'failed'
-            return utils.create_response(
-                            filename, 
-                            status, 
-                            log, 
-                            "low", 
-                            inserted_count,
-                            sample_count,
-                            work_order_status,
-                            client_ref,
-                            samples_submitted,
-                            date_received,
-                            date_finalized,
-                            project,
-                            comments,
-                            po_number,
-                            logging
-                        )
-        logging.info('File Format Check Successful')
-        # clear df_check from memory
-        del df_check
+        # reuse the cleaned results sidecar written by an earlier run on this file version
+        properties, log_properties = utils.fetch_file_properties(vault_id, container, filename, logging)
+        if properties is None:
+            logging.warning(f'Could not read file properties, resuming is disabled. {log_properties}')
+        run_key = (filename, properties['content_hash']) if properties else None
+        container_client, log_container = utils.get_container_client(vault_id, container, logging) if properties else (None, '')
+        cached = utils.load_cleaned_frames(container_client, filename, properties['etag'], logging) if container_client else None
+        df_workbook = None
+        if cached is not None:
+            logging.info('Reusing cached cleaned data, skipping download and parse')
+        else:
+            # get file contents
+            df_workbook, log_fetch = utils.fetch_file_contents(vault_id, container, filename, logging)
+            if df_workbook is None:
+                log = 'Workbook not found. '
+                log += log_fetch + br
+                status = status
+                return utils.create_response(
+                                filename, 
+                                status, 
+                                log, 
+                                "low", 
+                                inserted_count,
+                                sample_count,
+                                work_order_status,
+                                client_ref,
+                                samples_submitted,
+                                date_received,
+                                date_finalized,
+                                project,
+                                comments,
+                                po_number,
+                                logging
+                            )
+            logging.info('Fetch file contents successful')
+
+            # Detect the laboratory layout from the first rows
+            # only the first rows are sniffed, a wrong file is rejected before the sheet is parsed
+            first_rows = utils.first_rows(df_workbook)
+            layout, reasons = lab_formats.detect_layout(first_rows)
+            if layout is None:
+                message = 'File Format Incorrect. ' + ' '.join(reasons)
+                logging.error(message)
+                log += message + br
+                status = 'failed'
+                return utils.create_response(
+                                filename, 
+                                status, 
+                                log, 
+                                "low", 
+                                inserted_count,
+                                sample_count,
+                                work_order_status,
+                                client_ref,
+                                samples_submitted,
+                                date_received,
+                                date_finalized,
+                                project,
+                                comments,
+                                po_number,
+                                logging
+                            )
+            logging.info(f'Detected {layout.laboratory} layout')
+            logging.info('File Format Check Successful')
+
+            # pick the eager or streaming clean from the estimated peak memory, or queue the import
+            plan = utils.plan_import(df_workbook, properties['size'] if properties else len(df_workbook.io.getbuffer()), first_rows)
+            logging.info(f"Import plan {plan['plan']}: {plan['cells']} cells from the {plan['source']}, estimated peak {plan['eager_mb']} MB eager, {plan['stream_mb']} MB streaming, budget {plan['budget_mb']} MB")
+            if plan['plan'] == 'stream' and mode != 'insert':
+                # only inserts stream, the other modes need the whole file at once
+                plan['plan'] = 'defer'
+            if plan['plan'] == 'defer' and deferred is not None:
+                deferred.set(json.dumps({'path': path, 'container': container, 'keyvault': vault_id, 'duplicates': duplicate_policy, 'stream': plan['eager_mb'] > plan['budget_mb'], 'mode': mode}))
+                message = f"Import deferred to the {DEFERRED_QUEUE} queue, estimated peak {plan['eager_mb']} MB eager, {plan['stream_mb']} MB streaming, budget {plan['budget_mb']} MB."
+                logging.warning(message)
+                log += message + br
+                status = 'deferred'
+                return utils.create_response(
+                                filename, 
+                                status, 
+                                log, 
+                                "low", 
+                                inserted_count,
+                                sample_count,
+                                work_order_status,
+                                client_ref,
+                                samples_submitted,
+                                date_received,
+                                date_finalized,
+                                project,
+                                comments,
+                                po_number,
+                                logging
+                            )
+            stream = stream or plan['plan'] != 'eager'
+
+        # streamed chunks are deduplicated per chunk, so their row offsets get their own checkpoints
+        stream = stream and cached is None and mode == 'insert'
+        if stream and run_key:
+            run_key = (run_key[0], run_key[1] + ':stream')
 
         ### Get access to sql connection ###
         sql_conn_string, log_sql_conn = utils.get_sql_connection(vault_id, logging)
@@ -165,13 +337,12 @@ def http_lab(req: func.HttpRequest) -> func.HttpResponse:
         logging.info('Get access to sql connection successful')
 
         ###! STARTING RESHAPE AND INSERT !###
-        if df_workbook : 
-            ## Connect to the database ##
-            cnxn, log_sql_opendb = sql.open_database(sql_conn_string, logging)
-            if cnxn is None:
-                log = 'SQL Connection is not present.'
-                log += log_sql_opendb + br
-                return utils.create_response(
+        ## Connect to the database ##
+        cnxn, log_sql_opendb = sql.open_database(sql_conn_string, logging)
+        if cnxn is None:
+            log = 'SQL Connection is not present.'
+            log += log_sql_opendb + br
+            return utils.create_response(
                             filename, 
                             status, 
                             log, 
@@ -188,22 +359,32 @@ def http_lab(req: func.HttpRequest) -> func.HttpResponse:
                             po_number,
                             logging
                         )
-            logging.info('Open database successful')
+        logging.info('Open database successful')
 
         try:
-            # Clean Results and Header infromation from Excel File
-            df_headers = utils.clean_lab_header(df_workbook)
-            logging.info('Cleaned headers')
-            df_results = utils.clean_lab_results(df_workbook)
-            logging.info('Cleaned results')
-
-            # Join header on to results based on jobtitle 
-            df = pd.merge(df_results, df_headers, on='job_title', how='left')
-            logging.info('Merged headers and results')
-            df['source_name'] = path.split('/')[-1]
-            df['laboratory'] = 'ALS Arabia'
             # Add the current date and time to a column in the DataFrame
-            df['srk_import_timestamp'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')           
+            import_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            if cached is not None:
+                df_headers, df = cached
+                df['srk_import_timestamp'] = import_timestamp
+            else:
+                # Clean Results and Header infromation from Excel File
+                df_headers = utils.clean_lab_header(df_workbook, first_rows, layout, logging)
+                logging.info('Cleaned headers')
+                if stream:
+                    # results are cleaned chunk by chunk while earlier chunks are inserted
+                    duplicates = {}
+                    df = utils.iter_lab_import(df_workbook, df_headers, filename, layout.laboratory, import_timestamp, duplicate_policy, duplicates, layout=layout)
+                else:
+                    df_results = utils.clean_lab_results(df_workbook, layout)
+                    logging.info('Cleaned results')
+
+                    # Join header on to results based on jobtitle 
+                    df = utils.join_lab_header(df_results, df_headers, filename, layout.laboratory, import_timestamp)
+                    logging.info('Merged headers and results')
+                    # Parquet sidecar next to the source, so a retry or reprocess skips the download and parse
+                    if container_client:
+                        utils.save_cleaned_frames(container_client, filename, properties['etag'], df_headers, df, logging)
 
             # Store Header information in variables
             work_order_status = str(df_headers['job_title'].iloc[0])
@@ -215,52 +396,87 @@ def http_lab(req: func.HttpRequest) -> func.HttpResponse:
             comments = str(df_headers['cert_comment'].iloc[0])
             po_number = str(df_headers['po_number'].iloc[0])
             logging.info('Obtained header info')
-            logging.info(f'Records to be inserted from file: {len(df)}')
+
+            if not stream:
+                # Resolve repeated keys (e.g. a re-assay listed twice) so the MERGE source is unique
+                df, duplicates = utils.resolve_duplicate_keys(df, ['sample_id', 'lab_method', 'analyte'], duplicate_policy)
+                duplicate_count = duplicates['duplicate_rows']
+                if duplicate_count:
+                    message = f"{duplicate_count} duplicate rows resolved with policy '{duplicate_policy}': {', '.join(duplicates['examples'])}"
+                    logging.warning(message)
+                    log += message + br
+                logging.info(f'Records to be inserted from file: {len(df)}')
         except:
             message = f'Error Cleaning Files before insertion.'
             logging.error(message)
             log += message + br
 
+        result = {}
         try:
-            # left is DF right is DB
-            column_mappings = {
-                'source_name': 'source_name',
-                'sample_id': 'sample_id', 
-                'lab_method': 'lab_method',
-                'analyte': 'analyte', 
-                'unit': 'unit', 
-                'text_value': 'text_value',
-                'qualifier': 'qualifier', 
-                'value': 'value', 
-                'job_title': 'job_title', 
-                'client_ref': 'client_ref', 
-                'quantity': 'quantity', 
-                'project': 'project', 
-                'cert_comment': 'cert_comment',
-                'po_number':'po_number',
-                'job_number':'job_number',
-                'result_status':'result_status',
-                'date_received':'date_received',
-                'date_finalized':'date_finalised',
-                'laboratory':'laboratory',
-                'srk_import_timestamp':'srk_import_timestamp'
-            }
-            match_conditions = {
-                'sample_id': 'sample_id', 
-                'lab_method': 'lab_method',
-                'analyte': 'analyte', 
-            }
-            table = 'assay_result'
+            # the 'reassay' policy keeps repeated keys apart by their assay number
+            column_mappings, match_conditions = utils.assay_keys(var.ASSAY_COLUMN_MAPPINGS, var.ASSAY_MATCH_CONDITIONS, duplicate_policy)
+            table = var.ASSAY_TABLE
+            if duplicate_policy == 'reassay':
+                sql.require_column(cnxn.cursor(), table, utils.REASSAY_COLUMN)
+            # caps the merges into the table across all scaled out instances, excess batches queue in order
+            governor = sql.SqlWriteGovernor(cnxn, table, logging)
+            # a batch hit by a deadlock, throttling or a dropped connection is retried on its own
+            connector = sql.Connector(sql_conn_string, logging)
             logging.info('Attempting to insert data into SQL')
-            result = sql.db_insert_batch(cnxn, df, table, column_mappings, match_conditions, logging, 1000)
+            # bad rows are bisected out of their batch and quarantined instead of failing the import
+            # committed batches are checkpointed per file version, a retry resumes after the last one
+            # batch sizes adapt to the row width and measured latency
+            if mode == 'upsert':
+                # matched rows are only rewritten when their content hash changed
+                result = sql.db_merge_batch(cnxn, df, table, column_mappings, match_conditions, logging, 5000, change_detection=True, hash_exclude=('source_name', 'srk_import_timestamp'), governor=governor, connector=connector)
+            elif mode == 'reissue':
+                # only the difference to the job's last imported version is written
+                result = sql.db_apply_reissue(cnxn, df, table, column_mappings, match_conditions, logging, str(df['job_number'].iloc[0]).strip(), str(df['result_status'].iloc[0]).strip(), filename, governor=governor)
+            elif stream:
+                result = sql.db_insert_stream(cnxn, df, table, column_mappings, match_conditions, logging, 'auto', isolate_errors=True, run_key=run_key, governor=governor, connector=connector)
+                duplicate_count = duplicates.get('duplicate_rows', 0)
+                if duplicate_count:
+                    message = f"{duplicate_count} duplicate rows resolved with policy '{duplicate_policy}': {', '.join(duplicates['examples'])}"
+                    logging.warning(message)
+                    log += message + br
+            else:
+                result = sql.db_insert_batch(cnxn, df, table, column_mappings, match_conditions, logging, 'auto', isolate_errors=True, run_key=run_key, governor=governor, connector=connector)
             logging.info(result)
+            write_waits = governor.stats()
+            logging.info(f"SQL write slot waits: {write_waits}")
+            if write_waits['wait_seconds_total'] >= 1:
+                log += f"Waited {write_waits['wait_seconds_total']:.1f}s for SQL write slots." + br
+            if result.get('retry_count'):
+                log += f"{result['retry_count']} batch retries after transient SQL errors {result['retries']}." + br
+            if result.get('skipped_rows'):
+                log += f"Resumed import, {result['skipped_rows']} records were already committed." + br
             sample_count = result['distinct_count']
             inserted_count = result['inserted_count']
-            message = f'No Errors inserting data. {inserted_count} records inserted.'
-            logging.info(message)
-            log = message
-        except:
+            updated_count = result.get('updated_count', '')
+            unchanged_count = result.get('unchanged_count', '')
+            removed_count = result.get('removed_count', '')
+            version = result.get('version', '')
+            rejected_count = result.get('rejected_count', '')
+            if rejected_count:
+                message = f'{inserted_count} records inserted. {rejected_count} records rejected to assay_result_reject.'
+                logging.warning(message)
+            elif mode == 'upsert':
+                message = f'No Errors merging data. {inserted_count} records inserted, {updated_count} updated, {unchanged_count} unchanged.'
+                logging.info(message)
+            elif mode == 'reissue':
+                message = f'No Errors applying version {version}. {inserted_count} records inserted, {updated_count} updated, {removed_count} removed, {unchanged_count} unchanged.'
+                logging.info(message)
+            else:
+                message = f'No Errors inserting data. {inserted_count} records inserted.'
+                logging.info(message)
+            log += message
+        except Exception as e:
             message = f'Error inserting data. No data was inserted.'
+            # e.g. a missing schema column, see sql.require_column()
+            if str(result.get('status', 'success')) != 'success':
+                message += f" {result['status']}"
+            elif isinstance(e, ValueError):
+                message += f" {e}"
             logging.error(message)
             log += message + br
 
@@ -280,7 +496,13 @@ def http_lab(req: func.HttpRequest) -> func.HttpResponse:
                             project,
                             comments,
                             po_number,
-                            logging
+                            logging,
+                            duplicate_count,
+                            rejected_count,
+                            updated_count,
+                            unchanged_count,
+                            removed_count,
+                            version
                         )
     else:
         return func.HttpResponse(
@@ -121,6 +121,9 @@ def ac(req: func.HttpRequest) -> func.HttpResponse:
                 df['Import_File'] = unique_path
                 #df['Hole_Type'] = 'AC' # this is already in Collar sheet
                 
+                # Normalise date columns before they are converted to string
+                df = utils.normalize_date_columns(df, ['Date_Start', 'Date_Completed'])
+
                 # Fill NaN values with empty string and convert all columns to string
                 df = df.fillna('')
                 for column in df.columns:
@@ -597,6 +600,9 @@ def dd(req: func.HttpRequest) -> func.HttpResponse:
                 df['Import_File'] = unique_path
                 #df['Hole_Type'] = 'DD' # this is already in Collar sheet
                 
+                # Normalise date columns before they are converted to string
+                df = utils.normalize_date_columns(df, ['Date_Start', 'Date_Completed'])
+
                 # Fill NaN values with empty string and convert all columns to string
                 df = df.fillna('')
                 for column in df.columns:
@@ -667,6 +673,9 @@ def dd(req: func.HttpRequest) -> func.HttpResponse:
                 df['Import_File'] = unique_path
                 df['Hole_Type'] = 'DD'
                 
+                # Normalise date columns before they are converted to string
+                df = utils.normalize_date_columns(df, ['Surveyed_Date'])
+
                 # Fill NaN values with empty string and convert all columns to string
                 df = df.fillna('')
                 for column in df.columns:
@@ -1443,6 +1452,9 @@ def soil(req: func.HttpRequest) -> func.HttpResponse:
                     'Sample Comments': 'Sample_Comments'
                 })
                 
+                # Normalise date columns before they are converted to string
+                df = utils.normalize_date_columns(df, ['Sample_Date_Time'])
+
                 # Fill NaN values with empty string and convert all columns to string
                 df = df.fillna('')
                 for column in df.columns:
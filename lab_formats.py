@@ -0,0 +1,105 @@
+"""
+Registry of lab certificate layouts.
+
+A layout describes where a laboratory puts the certificate header, which rows above the
+results name the parameters, and how a result value carries its qualifier. detect_layout()
+picks the layout of a file from its first rows (see utils.first_rows()), and the cleaning
+functions in utils take that layout instead of assuming the ALS one. Adding a laboratory
+means registering a LabLayout here, not another copy of the reshaping code.
+"""
+import re
+
+
+class LabLayout:
+    """
+    Layout of one laboratory's certificate, with its patterns compiled once on registration.
+
+    Args:
+        laboratory (str): name written to the laboratory column
+        signature (dict): {(row, column): (text, failure message)} cells of the first rows that
+            must contain text (case insensitive), checked by detect_layout()
+        header_rows (int): rows above the parameter rows
+        parameter_rows (tuple): names of the parameter rows between the header and the samples,
+            in sheet order, e.g. ('lab_method', 'analyte', 'unit')
+        header_fields (dict): {field: (row, column, pattern)} header cells, in output order.
+            pattern None keeps the whole cell, otherwise the first group of the first match
+        date_fields (tuple): header fields formatted as dates
+        qualifiers (tuple): qualifier characters looked for in a result, in priority order
+        value_pattern (str): characters removed from a result to leave its number
+
+    The sample id is in the first column of the parameter and sample rows.
+    """
+    def __init__(self, laboratory: str, signature: dict, header_rows: int, parameter_rows: tuple, header_fields: dict, date_fields: tuple = (), qualifiers: tuple = ('<', '>'), value_pattern: str = r'[^0-9.]'):
+        self.laboratory = laboratory
+        self.signature = {cell: (text.upper(), message) for cell, (text, message) in signature.items()}
+        self.header_rows = header_rows
+        self.parameter_rows = tuple(parameter_rows)
+        self.header_fields = {
+            field: (row, column, re.compile(pattern) if pattern else None)
+            for field, (row, column, pattern) in header_fields.items()
+        }
+        self.date_fields = tuple(date_fields)
+        self.qualifiers = tuple(qualifiers)
+        self.value_pattern = re.compile(value_pattern)
+
+    def mismatch(self, rows: list):
+        """
+        Failure message of the first signature cell not found in `rows`, or None when the file matches.
+        """
+        for (row, column), (text, message) in self.signature.items():
+            try:
+                value = rows[row][column]
+            except IndexError:
+                value = None
+            if text not in str(value).upper():
+                return message
+        return None
+
+    def __repr__(self):
+        return f"LabLayout({self.laboratory!r})"
+
+
+# ALS: job title and header lines in column A, 3 parameter rows, then one row per sample
+ALS_ARABIA = LabLayout(
+    laboratory='ALS Arabia',
+    signature={
+        (6, 0): ('PO NUMBER', 'PO NUMBER not found in the first column of the file.'),
+        (8, 0): ('SAMPLE', 'SAMPLE not found in the first column of the file.'),
+    },
+    header_rows=7,
+    parameter_rows=('lab_method', 'analyte', 'unit'),
+    header_fields={
+        'job_title': (0, 0, None),
+        'client_ref': (1, 0, None),
+        'quantity': (2, 0, None),
+        'project': (4, 0, None),
+        'cert_comment': (5, 0, None),
+        'po_number': (6, 0, None),
+        # e.g. 'JB24012345 - FINAL'
+        'job_number': (0, 0, r'^([^-]*)'),
+        'result_status': (0, 0, r'^[^-]*-([^-]*)'),
+        # e.g. 'DATE RECEIVED : 2024-01-02 DATE FINALISED : 2024-01-09'
+        'date_received': (3, 0, r'(?s)^(?:(?!DATE).)*DATE(?:(?!DATE)[^:])*:((?:(?!DATE)[^:])*)'),
+        'date_finalized': (3, 0, r'(?s)^(?:(?!DATE).)*DATE(?:(?!DATE).)*DATE(?:(?!DATE)[^:])*:((?:(?!DATE)[^:])*)'),
+    },
+    date_fields=('date_received', 'date_finalized'),
+)
+
+# detection order, the first layout whose signature matches is used
+LAYOUTS = [ALS_ARABIA]
+
+
+def detect_layout(rows: list) -> tuple:
+    """
+    Find the layout of a certificate from its first rows.
+
+    Returns:
+        tuple: (LabLayout or None, list of '<laboratory>: <reason>' for the layouts that did not match)
+    """
+    reasons = []
+    for layout in LAYOUTS:
+        message = layout.mismatch(rows)
+        if message is None:
+            return layout, reasons
+        reasons.append(f"{layout.laboratory}: {message}")
+    return None, reasons
@@ -0,0 +1,43 @@
+"""
+Heavy dependencies imported on first use.
+
+The Functions host imports function_app.py, and with it utils.py and sql.py, to index the
+triggers of every cold started worker before a request arrives. pandas, numpy, pyarrow, pyodbc
+and the Azure SDK clients take most of a second to import, so those modules bind them with
+lazy_import() instead and the import happens inside the first request that touches them.
+Modules that name them only in annotations start with `from __future__ import annotations`,
+which keeps a signature such as `df: pd.DataFrame` from importing pandas.
+
+`python benchmark.py imports` checks the cold import of function_app.py against a time budget and
+fails when one of DEFERRED_MODULES is imported eagerly again.
+"""
+import importlib
+
+# modules that must not be imported by `import function_app`
+DEFERRED_MODULES = ('pandas', 'numpy', 'pyarrow', 'pyodbc', 'openpyxl', 'azure.identity', 'azure.storage.blob', 'azure.keyvault.secrets', 'azure.core.exceptions', 'opentelemetry.trace', 'azure.monitor.opentelemetry')
+
+
+class LazyModule:
+    """
+    Stand-in for a module that imports it on the first attribute access.
+    Later accesses are served from sys.modules, like a normal import.
+    """
+    def __init__(self, name: str):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name), attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self.__name}'>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Args:
+        name (str): dotted module name, e.g. 'pandas' or 'pyarrow.csv'
+
+    Returns:
+        LazyModule: proxy importing `name` when first used
+    """
+    return LazyModule(name)
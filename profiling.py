@@ -0,0 +1,150 @@
+"""
+On-demand profiling of a single import.
+
+http_lab runs a request under profile_call() when it carries a `profile` flag equal to the
+LAB_IMPORT_PROFILE_TOKEN app setting. A background thread samples the stacks of the request
+thread, and of any thread it starts, every SAMPLE_INTERVAL seconds into folded stacks
+(one `frame;frame;frame count` line per distinct stack), which flamegraph.pl, speedscope or
+inferno render as a flame graph. tracemalloc records the top allocation sites and the peak.
+write_profile() saves both next to the source file.
+
+Nothing here runs unless a request is authorized, so unprofiled requests pay nothing.
+"""
+import hmac
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+PROFILE_TOKEN = os.environ.get('LAB_IMPORT_PROFILE_TOKEN', '')
+
+# seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+# frames kept per allocation traceback, and allocation sites reported
+ALLOCATION_FRAMES = 10
+TOP_ALLOCATIONS = 25
+
+
+def authorized(token) -> bool:
+    """ True when profiling is configured and token matches LAB_IMPORT_PROFILE_TOKEN """
+    if not PROFILE_TOKEN or not token:
+        return False
+    return hmac.compare_digest(str(token).encode(), PROFILE_TOKEN.encode())
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread, and of every thread started while it runs,
+    from a daemon thread every `interval` seconds.
+    """
+    def __init__(self, thread_id: int = None, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # threads alive now, other than the profiled one, are the host's and are not sampled
+        self._existing = set(sys._current_frames()) - {self.thread_id}
+        self._thread = threading.Thread(target=self._run, name='lab-import-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or ident in self._existing:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def top_allocations(snapshot, limit: int = TOP_ALLOCATIONS) -> str:
+    """ The largest allocation sites of a tracemalloc snapshot, by line, with their tracebacks """
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    lines = []
+    for stat in snapshot.statistics('traceback')[:limit]:
+        lines.append(f"{stat.size / 2**20:.2f} MB in {stat.count} blocks")
+        lines.extend(f"    {line.strip()}" for line in stat.traceback.format(most_recent_first=True) if line.strip())
+    return '\n'.join(lines) + '\n'
+
+
+def profile_call(call):
+    """
+    Run call() under the sampling profiler and tracemalloc.
+
+    Returns:
+        tuple: (result of call, report dict with folded stacks, allocations, seconds, samples and peak_mb)
+    """
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(ALLOCATION_FRAMES)
+    tracemalloc.reset_peak()
+    profiler = SamplingProfiler()
+    start = time.perf_counter()
+    profiler.start()
+    try:
+        result = call()
+    finally:
+        profiler.stop()
+        seconds = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+    report = {
+        'folded': profiler.folded(),
+        'allocations': f"peak traced memory {peak / 2**20:.1f} MB over {seconds:.2f}s\n\n" + top_allocations(snapshot),
+        'seconds': round(seconds, 3),
+        'samples': profiler.samples,
+        'peak_mb': round(peak / 2**20, 1),
+    }
+    return result, report
+
+
+def write_profile(container_client, path: str, report: dict, logger) -> dict:
+    """
+    Upload the folded stacks and allocation sites of a profiled import next to the source file.
+
+    Returns:
+        dict: {'status', 'flamegraph', 'allocations'} with the blob URLs
+    """
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+    stem = f"{os.path.splitext(path)[0]}.{stamp}.profile"
+    urls = {}
+    try:
+        for key, name, body in [('flamegraph', f"{stem}.folded", report['folded']), ('allocations', f"{stem}.allocations.txt", report['allocations'])]:
+            blob = container_client.upload_blob(name, body.encode(), overwrite=True)
+            urls[key] = blob.url
+    except Exception as e:
+        logger.warning(f"WARNING: Could not write the profile of {path}: {e}")
+        return {'status': 'failed', **urls}
+    logger.info(f"INFO: Profiled {path} in {report['seconds']}s, {report['samples']} samples, peak {report['peak_mb']} MB: {urls}")
+    return {'status': 'success', **urls}
@@ -0,0 +1,225 @@
+"""
+Offline bulk reprocessing of lab certificates, for historical backfills.
+
+Runs the same cleaning as http_lab on every certificate under a local directory or a blob
+container prefix, on a process pool using all cores. Each file's cleaned results are written as
+a Parquet sidecar (see utils.save_cleaned_frames()), so files with a valid sidecar are not
+parsed again. With --output sql the results are also loaded into assay_result through the
+batched staging path, one file at a time while the pool keeps cleaning.
+
+Usage:
+    python reprocess.py --dir <directory> [--output parquet] [--out-dir <directory>]
+    python reprocess.py --container <name> [--prefix <prefix>] --blob-conn "<connection string>" --output sql --conn "<odbc connection string>"
+    python reprocess.py --container <name> --keyvault <vault name> --output sql
+
+Failed files are listed with their error in the failure manifest (--manifest).
+"""
+import argparse
+import hashlib
+import io
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+from azure.identity import DefaultAzureCredential
+from azure.keyvault.secrets import SecretClient
+from azure.storage.blob import BlobServiceClient
+
+import lab_formats
+import sql
+import utils
+import variables as var
+
+
+def list_local_files(directory: str) -> list:
+    """
+    Certificates under `directory`, recursively, as (path, name relative to directory).
+    """
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            if name.lower().endswith(utils.WORKBOOK_EXTENSIONS) and not name.startswith('~$'):
+                path = os.path.join(root, name)
+                files.append((path, os.path.relpath(path, directory)))
+    return files
+
+
+def list_blob_files(blob_conn: str, container: str, prefix: str) -> list:
+    """
+    Certificates in `container` whose name starts with `prefix`, as (blob name, blob name).
+    """
+    container_client = BlobServiceClient.from_connection_string(blob_conn).get_container_client(container)
+    return [
+        (blob.name, blob.name)
+        for blob in container_client.list_blobs(name_starts_with=prefix or None)
+        if blob.name.lower().endswith(utils.WORKBOOK_EXTENSIONS)
+    ]
+
+
+def clean_file(source: str, name: str, blob_conn: str, container: str, out_dir: str, laboratory: str, import_timestamp: str, duplicate_policy: str, return_frames: bool) -> dict:
+    """
+    Clean one certificate in a worker process, or load it from a valid Parquet sidecar.
+
+    Returns:
+        dict: name, rows, seconds, cached, error and, when return_frames is set, the cleaned frame
+    """
+    start = time.perf_counter()
+    logger = logging.getLogger('reprocess')
+    result = {'name': name, 'rows': 0, 'seconds': 0.0, 'cached': False, 'error': '', 'df': None, 'content_hash': ''}
+    try:
+        if blob_conn:
+            location = BlobServiceClient.from_connection_string(blob_conn).get_container_client(container)
+            blob_client = location.get_blob_client(source)
+            etag = blob_client.get_blob_properties().etag.strip('"')
+            read = lambda: blob_client.download_blob().readall()
+        else:
+            location = os.path.dirname(source)
+            data = open(source, 'rb').read()
+            etag = hashlib.md5(data).hexdigest()
+            read = lambda: data
+        result['content_hash'] = etag
+        # sidecars go next to the source file unless an output directory is given
+        name_in_location = source if blob_conn else os.path.basename(source)
+        if out_dir:
+            location, name_in_location = out_dir, name
+
+        cached = utils.load_cleaned_frames(location, name_in_location, etag, logger)
+        if cached is not None:
+            df_headers, df = cached
+            df['srk_import_timestamp'] = import_timestamp
+            result['cached'] = True
+        else:
+            df_workbook = utils.open_workbook(io.BytesIO(read()), source)
+            first_rows = utils.first_rows(df_workbook)
+            layout, reasons = lab_formats.detect_layout(first_rows)
+            if layout is None:
+                raise ValueError('File Format Incorrect. ' + ' '.join(reasons))
+            df_headers = utils.clean_lab_header(df_workbook, first_rows, layout, logger)
+            df_results = utils.clean_lab_results(df_workbook, layout)
+            df = utils.join_lab_header(df_results, df_headers, os.path.basename(name), laboratory or layout.laboratory, import_timestamp)
+            utils.save_cleaned_frames(location, name_in_location, etag, df_headers, df, logger)
+
+        df, _ = utils.resolve_duplicate_keys(df, list(var.ASSAY_MATCH_CONDITIONS), duplicate_policy)
+        result['rows'] = len(df)
+        if return_frames:
+            result['df'] = df
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def reprocess(files: list, blob_conn: str, container: str, out_dir: str, output: str, sql_conn_string: str, laboratory: str, duplicate_policy: str, workers: int, logger) -> tuple:
+    """
+    Clean `files` on a process pool and, for output 'sql', insert each cleaned file as it completes.
+
+    Returns:
+        tuple: (list of per-file results, summary dictionary)
+    """
+    cnxn = None
+    if output == 'sql':
+        # also replaces the connection if it drops during a load
+        connector = sql.Connector(sql_conn_string, logger)
+        cnxn = connector.connect()
+        if duplicate_policy == 'reassay':
+            sql.require_column(cnxn.cursor(), var.ASSAY_TABLE, utils.REASSAY_COLUMN)
+    column_mappings, match_conditions = utils.assay_keys(var.ASSAY_COLUMN_MAPPINGS, var.ASSAY_MATCH_CONDITIONS, duplicate_policy)
+
+    import_timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(clean_file, source, name, blob_conn, container, out_dir, laboratory, import_timestamp, duplicate_policy, output == 'sql')
+            for source, name in files
+        ]
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            df = result.pop('df')
+            if cnxn is not None and not result['error']:
+                # same checkpoints as http_lab, a rerun skips the batches already committed
+                run_key = (os.path.basename(result['name']), result['content_hash'])
+                inserted = sql.db_insert_batch(cnxn, df, var.ASSAY_TABLE, column_mappings, match_conditions, logger, 'auto', isolate_errors=True, run_key=run_key, connector=connector)
+                cnxn = connector.current
+                if inserted['status'] != 'success':
+                    result['error'] = inserted['status']
+                result['inserted_count'] = inserted['inserted_count']
+                result['rejected_count'] = inserted.get('rejected_count', 0)
+                result['retry_count'] = inserted.get('retry_count', 0)
+            results.append(result)
+            state = f"failed: {result['error']}" if result['error'] else f"{result['rows']} rows" + (' (sidecar)' if result['cached'] else '')
+            print(f"[{done}/{len(files)}] {result['name']} {state} in {result['seconds']}s")
+
+    if cnxn is not None:
+        cnxn.close()
+    seconds = time.perf_counter() - start
+    succeeded = [result for result in results if not result['error']]
+    rows = sum(result['rows'] for result in succeeded)
+    summary = {
+        'files': len(files),
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'from_sidecar': sum(result['cached'] for result in succeeded),
+        'rows': rows,
+        'seconds': round(seconds, 1),
+        'files_per_second': round(len(files) / seconds, 2) if seconds else 0,
+        'rows_per_second': round(rows / seconds) if seconds else 0,
+        'sql_retries': sum(result.get('retry_count', 0) for result in results),
+    }
+    return results, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help='local directory of certificates, searched recursively')
+    source.add_argument('--container', help='blob container of certificates')
+    parser.add_argument('--prefix', default='', help='blob name prefix within --container')
+    parser.add_argument('--blob-conn', help='blob storage connection string, e.g. UseDevelopmentStorage=true for Azurite')
+    parser.add_argument('--keyvault', help="key vault holding the 'blob-connection' and 'sql-connection' secrets")
+    parser.add_argument('--output', choices=('parquet', 'sql'), default='parquet')
+    parser.add_argument('--out-dir', help='write Parquet sidecars here instead of next to the source files')
+    parser.add_argument('--conn', help='ODBC connection string for --output sql')
+    parser.add_argument('--laboratory', help='laboratory name to record instead of the detected layout\'s')
+    parser.add_argument('--duplicates', choices=utils.DUPLICATE_POLICIES, default='first')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--manifest', default='reprocess_failures.csv', help='CSV of the files that failed and why')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger('reprocess')
+
+    blob_conn = args.blob_conn
+    if args.container and not blob_conn:
+        if not args.keyvault:
+            parser.error('--container needs --blob-conn or --keyvault')
+        secret_client = SecretClient(vault_url=f"https://{args.keyvault}.vault.azure.net/", credential=DefaultAzureCredential())
+        blob_conn = secret_client.get_secret('blob-connection').value
+    sql_conn_string = args.conn
+    if args.output == 'sql' and not sql_conn_string:
+        if not args.keyvault:
+            parser.error('--output sql needs --conn or --keyvault')
+        sql_conn_string, log = utils.get_sql_connection(args.keyvault, logger)
+        if sql_conn_string is None:
+            parser.error(log)
+
+    files = list_blob_files(blob_conn, args.container, args.prefix) if args.container else list_local_files(args.dir)
+    print(f"{len(files)} certificates to process on {args.workers} workers")
+    results, summary = reprocess(
+        files, blob_conn if args.container else None, args.container, args.out_dir, args.output,
+        sql_conn_string, args.laboratory, args.duplicates, args.workers, logger
+    )
+
+    failures = pd.DataFrame([result for result in results if result['error']], columns=['name', 'error', 'seconds'])
+    if len(failures):
+        failures.to_csv(args.manifest, index=False)
+        print(f"{len(failures)} failures written to {args.manifest}")
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,310 @@
 """
 All functions related to SQL Server commands  
 """
-import pyodbc
-from azure.identity import DefaultAzureCredential
-import pandas as pd
+from __future__ import annotations
+
+import json
+import time
+import queue
+import threading
+import hashlib
+import os
+import re
+import random
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+import sql_tracing
+from lazy_imports import lazy_import
+
+# imported by the first request rather than when the host indexes the functions, see lazy_imports.py
+pyodbc = lazy_import('pyodbc')
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+
+# ways stage_batch() can load a batch into #TempLabBatch
+STAGING_METHODS = ('executemany', 'fast_executemany', 'values', 'openjson')
+
+# SQL Server limits on one statement: parameters, and rows in a VALUES constructor
+MAX_PARAMETERS = 2100
+MAX_VALUES_ROWS = 1000
+
+# how long an import waits for a concurrent import of the same file, see acquire_app_lock()
+IMPORT_LOCK_TIMEOUT_MS = 180000
+
+# MERGE batches allowed to run against a table at once across all instances, see WriteGovernor
+WRITE_SLOTS = int(os.environ.get('SQL_WRITE_SLOTS', 4))
+WRITE_SLOT_TIMEOUT_MS = 600000
+WRITE_SLOT_POLL_SECONDS = 0.2
+
+# transient SQL Server errors by error number, see classify_error()
+TRANSIENT_ERRORS = {
+    1205: 'deadlock',       # chosen as deadlock victim
+    40501: 'throttled',     # service is busy
+    40613: 'unavailable',   # database not currently available
+    40197: 'unavailable',   # service error, e.g. during a failover
+    49918: 'throttled',     # not enough resources to process the request
+    49919: 'throttled',     # too many create or update operations
+    49920: 'throttled',     # too many operations in progress
+}
+
+# retries per error class: attempts (including the first), backoff base and cap in seconds,
+# and whether the connection is replaced before retrying
+RETRY_POLICIES = {
+    'deadlock': {'attempts': 5, 'base_seconds': 0.2, 'max_seconds': 5, 'reconnect': False},
+    'throttled': {'attempts': 6, 'base_seconds': 2, 'max_seconds': 60, 'reconnect': False},
+    'unavailable': {'attempts': 6, 'base_seconds': 2, 'max_seconds': 60, 'reconnect': True},
+    'connection': {'attempts': 4, 'base_seconds': 1, 'max_seconds': 30, 'reconnect': True},
+}
+
+# retries per error class since the worker started, see run_batch()
+RETRY_COUNTS = Counter()
+_retry_counts_lock = threading.Lock()
+
+# columns the import needs on top of the assay_result columns it maps, added by add_columns()
+# from `python db_health.py --migrate` rather than by an import: the upsert row hash, and the
+# assay number matched on under the 'reassay' duplicate policy (see utils.assay_keys())
+SCHEMA_COLUMNS = {'row_hash': 'bigint NULL', 'reassay': 'int NOT NULL DEFAULT 0'}
+
+# INFORMATION_SCHEMA column definitions per table, see column_definitions()
+_column_definitions = {}
 
 def open_database(conn_string, logger, autocommit=False):
     """ Connect to the database """
     # connect without auto commit
     cnxn = None
     try:
-        cnxn = pyodbc.connect(conn_string)
-        return cnxn, ''
+        cnxn = pyodbc.connect(conn_string, autocommit=autocommit)
+        # statement spans and metrics when OpenTelemetry is installed
+        return sql_tracing.traced(cnxn), ''
     except Exception as e:
         error = 'Could not establish connection: ' + str(e)
         logger.error(error)
         return None, error
 
-def db_merge_batch(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column_mappings: dict, match_conditions: dict, logger, batch_size=5000):
+def validate_connection(conn_string, logger):
+    """
+    Open a connection, check it with SELECT 1 and close it again, which hands it back to
+    the ODBC driver manager's pool (pyodbc.pooling is on by default) for the next request.
+
+    Parameters:
+    - conn_string: ODBC connection string
+    - logger: logger for connection errors
+
+    Returns:
+    - dictionary with connect_seconds, query_seconds and status
+    """
+    start = time.perf_counter()
+    cnxn, error = open_database(conn_string, logger, autocommit=True)
+    if cnxn is None:
+        return {'status': error}
+    connected = time.perf_counter()
+    try:
+        cnxn.cursor().execute("SELECT 1").fetchall()
+    except Exception as e:
+        logger.error(f'Connection check failed: {e}')
+        return {'status': f'failure: {e}'}
+    finally:
+        cnxn.close()
+    return {'connect_seconds': round(connected - start, 3), 'query_seconds': round(time.perf_counter() - connected, 3), 'status': 'success'}
+
+class Connector:
+    """
+    Opens connections for one connection string, used to replace a connection that dropped.
+    pyodbc pools connections by default, so a replacement usually reuses a pooled one.
+    `current` is the last connection opened, for callers that keep using the connection after a load.
+    """
+    def __init__(self, conn_string: str, logger, autocommit=False):
+        self.conn_string = conn_string
+        self.logger = logger
+        self.autocommit = autocommit
+        self.current = None
+
+    def connect(self) -> pyodbc.Connection:
+        cnxn, error = open_database(self.conn_string, self.logger, self.autocommit)
+        if cnxn is None:
+            raise ConnectionError(error)
+        self.current = cnxn
+        return cnxn
+
+def classify_error(e: Exception):
+    """
+    Class of a transient error, a key of RETRY_POLICIES, or None when retrying would not help.
+    """
+    if isinstance(e, ConnectionError):
+        return 'connection'
+    if not isinstance(e, pyodbc.Error):
+        return None
+    # the driver puts the native error number in brackets, e.g. '... deadlocked ... (1205) (SQLExecDirectW)'
+    for number in re.findall(r'\((\d+)\)', str(e)):
+        if int(number) in TRANSIENT_ERRORS:
+            return TRANSIENT_ERRORS[int(number)]
+    sqlstate = str(e.args[0]) if e.args else ''
+    if sqlstate == '40001':
+        return 'deadlock'
+    if sqlstate.startswith('08'):
+        return 'connection'
+    return None
+
+def retry_delay(policy: dict, attempt: int) -> float:
+    """ Exponential backoff with full jitter, so retrying instances do not collide again """
+    return random.uniform(0, min(policy['max_seconds'], policy['base_seconds'] * 2 ** attempt))
+
+def run_batch(work, cnxn: pyodbc.Connection, logger, description: str, connector: Connector = None, governor=None, retries: Counter = None):
+    """
+    Run work(cnxn, cursor), which writes and commits one batch, retrying it on transient errors.
+
+    Errors classified by classify_error() are retried as RETRY_POLICIES says: the transaction is
+    rolled back, the batch waits a jittered exponential backoff and, for dropped connections,
+    runs again on a connection from `connector` (the governor follows it). A connection has
+    dropped when the policy says so or when the rollback fails, e.g. a deadlock on a connection
+    that broke meanwhile; without a connector it is closed and the error raised. Other errors, and
+    transient ones that used up their attempts, are raised. work must leave nothing behind that
+    a retry would repeat, e.g. it counts its rows only in what it returns.
+    Retries are counted per class in `retries` and RETRY_COUNTS.
+
+    Returns:
+    - (work's result, the connection it succeeded on)
+    """
+    attempt = 1
+    while True:
+        try:
+            if cnxn is None:
+                cnxn = connector.connect()
+                if governor is not None:
+                    governor.reconnected(cnxn)
+            cursor = cnxn.cursor()
+            result = work(cnxn, cursor)
+            cursor.close()
+            return result, cnxn
+        except Exception as e:
+            kind = classify_error(e)
+            policy = RETRY_POLICIES.get(kind)
+            if policy is None or attempt >= policy['attempts']:
+                raise
+            # a connection that cannot roll back has dropped, whatever the error was
+            dropped = policy['reconnect'] and connector is not None
+            if cnxn is not None:
+                try:
+                    cnxn.rollback()
+                except pyodbc.Error:
+                    dropped = True
+            if dropped:
+                # a replaced connection is closed, not left open until the worker recycles it
+                close_quietly(cnxn)
+                cnxn = None
+                if connector is None:
+                    raise
+            delay = retry_delay(policy, attempt)
+            logger.warning(f"Retrying {description} in {delay:.1f}s after {kind} error, attempt {attempt + 1} of {policy['attempts']}: {e}")
+            if retries is not None:
+                retries[kind] += 1
+            with _retry_counts_lock:
+                RETRY_COUNTS[kind] += 1
+            time.sleep(delay)
+            attempt += 1
+
+def close_quietly(cnxn):
+    """ Close a connection that may already be broken, ignoring the driver's errors """
+    if cnxn is None:
+        return
+    try:
+        cnxn.close()
+    except pyodbc.Error:
+        pass
+
+def batch_params(batch: pd.DataFrame, columns) -> list:
+    """
+    Build the executemany parameter tuples for a batch.
+
+    Categorical columns are decoded here, one batch at a time, so the full frame
+    stays dictionary encoded. Missing values of any column are sent as None.
+    """
+    values = []
+    for col in columns:
+        series = batch[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = np.append(np.asarray(series.cat.categories, dtype=object), None)
+            # code -1 (missing) picks the trailing None
+            values.append(categories[series.cat.codes.to_numpy()])
+        else:
+            column = series.to_numpy(dtype=object)
+            column[pd.isna(column)] = None
+            values.append(column)
+    return list(zip(*values))
+
+def values_rows_per_statement(column_count: int) -> int:
+    """
+    Rows one multi-row INSERT ... VALUES statement can carry for `column_count` columns.
+    """
+    return max(1, min(MAX_VALUES_ROWS, (MAX_PARAMETERS - 1) // column_count))
+
+def estimate_row_bytes(df: pd.DataFrame, columns, sample_size=1000) -> int:
+    """
+    Approximate client memory of one staged row: its serialised size plus a Python object per value.
+    """
+    sample = df.head(sample_size)
+    if sample.empty:
+        return 1
+    return int(len(batch_json(sample, columns)) / len(sample)) + 56 * len(list(columns))
+
+class AdaptiveBatcher:
+    """
+    Sizes SQL staging batches at runtime.
+
+    The size is capped by the parameter limit when the 'values' staging method is used
+    (one statement per batch) and by a client memory budget for the staged rows. Within
+    the cap it grows while throughput keeps improving, shrinks when a batch takes longer
+    than target_seconds, and settles back on the best size seen when growing stops paying off.
+    Every change is logged with the measured throughput.
+    """
+    def __init__(self, column_count: int, logger, stage_method='executemany', row_bytes=1024,
+                 initial_size=1000, min_size=100, max_size=50000, memory_budget=64 * 1024 * 1024,
+                 target_seconds=5.0, growth=2.0):
+        self.logger = logger
+        self.min_size = min_size
+        self.max_size = min(max_size, max(min_size, memory_budget // max(row_bytes, 1)))
+        if stage_method == 'values':
+            self.max_size = min(self.max_size, values_rows_per_statement(column_count))
+            self.min_size = min(self.min_size, self.max_size)
+        self.target_seconds = target_seconds
+        self.growth = growth
+        self.size = max(self.min_size, min(initial_size, self.max_size))
+        self.best_size = self.size
+        self.best_rate = 0.0
+        self.history = []
+        logger.info(f"Adaptive batch size starts at {self.size} rows (cap {self.max_size}, {column_count} columns, ~{row_bytes} bytes per row)")
+
+    def next_size(self) -> int:
+        return self.size
+
+    def record(self, rows: int, seconds: float, full=None):
+        """
+        Feed back the size and duration of the last batch and pick the next size.
+        full tells whether the batch was sized by this batcher, by default when it has the full size;
+        a batch trimmed to a key boundary is a little shorter but still full.
+        """
+        rate = rows / seconds if seconds > 0 else float('inf')
+        self.history.append((rows, round(seconds, 3)))
+        previous = self.size
+        if not (rows >= self.size if full is None else full):
+            # short final batch, says nothing about this size
+            return
+        if seconds > self.target_seconds:
+            self.size = max(self.min_size, int(self.size / self.growth))
+            self.max_size = max(self.min_size, previous - 1)
+        elif rate >= self.best_rate:
+            self.best_rate = rate
+            self.best_size = self.size
+            self.size = min(self.max_size, int(self.size * self.growth))
+        else:
+            # bigger batches stopped paying off, settle on the best size
+            self.max_size = self.best_size
+            self.size = self.best_size
+        if self.size != previous:
+            self.logger.info(f"Adaptive batch size {previous} -> {self.size} rows ({rate:.0f} rows/s, {seconds:.2f}s per batch)")
+
+def db_merge_batch(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column_mappings: dict, match_conditions: dict, logger, batch_size=5000, stage_method='executemany', change_detection=False, hash_column='row_hash', hash_exclude=('srk_import_timestamp',), governor=None, connector=None, key_order=True):
     """
     Merges records into a table using batch processing.
 
@@ -28,108 +315,328 @@ def db_merge_batch(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column
     - column_mappings: Dictionary mapping DataFrame columns to table columns.
     - match_conditions: Dictionary mapping target columns to source columns for the ON clause.
     - batch_size: Number of rows to process in each batch.
+    - stage_method: How rows reach #TempLabBatch, one of STAGING_METHODS (see stage_batch()).
+    - change_detection: Store a content hash of each row in hash_column and only update
+      matched rows whose hash differs. Unchanged rows are counted, not written.
+    - hash_column: bigint column of `table` holding the row hash, see SCHEMA_COLUMNS. The merge fails when it is missing.
+    - hash_exclude: DataFrame columns left out of the hash, e.g. the import timestamp.
+    - governor: WriteGovernor limiting concurrent merges into `table`, each batch runs in one of its slots.
+    - connector: Connector replacing the connection when it drops, see db_insert_batch().
+    - key_order: Merge the rows sorted by the match keys, see db_insert_batch().
 
     Returns:
-    - A dictionary with counts of updated and inserted records, and a success/failure status.
+    - A dictionary with counts of updated, inserted and unchanged records, retries, and a success/failure status.
     """
+    updated_count = 0
+    inserted_count = 0
+    retries = Counter()
     try:
         cursor = cnxn.cursor()
-        updated_count = 0
-        inserted_count = 0
+        unchanged_count = 0
+
+        if change_detection:
+            require_column(cursor, table, hash_column)
+            df = df.assign(**{hash_column: row_hashes(df, [col for col in column_mappings if col not in hash_exclude])})
+            column_mappings = {**column_mappings, hash_column: hash_column}
 
         # Retrieve the column definitions from the main table
-        cursor.execute(f"""
-            SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_NAME = '{table}'
-        """)
-        column_definitions = cursor.fetchall()
-
-        # Construct the CREATE TABLE statement for the temp table
-        temp_table_columns = ', '.join([
-            f"{col[0]} {col[1]}" + 
-            (f"({col[2]})" if col[2] and col[2] != -1 else "(max)" if col[1] in ['nvarchar', 'varchar', 'varbinary'] else "") + 
-            (" NULL" if col[3] == 'YES' else " NOT NULL")
-            for col in column_definitions
+        temp_table_columns = temp_table_definition(cursor, table)
+        # each batch gets a cursor of its own, see run_batch()
+        cursor.close()
+
+        if key_order and len(df):
+            df, _ = order_by_key(df, column_mappings, match_conditions)
+
+        # Prepare the SQL query with dynamic columns
+        update_columns = ', '.join([
+            f"target.{col} = source.{col}" for col in column_mappings.values() if col != 'srk_import_timestamp'
         ])
+        insert_columns = ', '.join(column_mappings.values())
+        insert_values = ', '.join([f"source.{col}" for col in column_mappings.values()])
+        match_clause = ' AND '.join([f"target.{target_col} = source.{source_col}" for target_col, source_col in match_conditions.items()])
+
+        # only rewrite matched rows whose content changed
+        matched_clause = f"WHEN MATCHED AND (target.{hash_column} IS NULL OR target.{hash_column} <> source.{hash_column})" if change_detection else "WHEN MATCHED"
 
         # Process data in batches
         for i in range(0, len(df), batch_size):
             batch = df.iloc[i:i + batch_size]
 
-            # Create a temp table for this batch
-            cursor.execute(f"CREATE TABLE #TempLabBatch ({temp_table_columns})")
-            logger.info(f"Executed CREATE TABLE #TempLabBatch ({temp_table_columns})")
+            def merge(cnxn, cursor):
+                create_temp_batch(cursor, temp_table_columns, match_conditions, logger)
 
-            # Insert batch data into temp table
-            params = []
-            for _, row in batch.iterrows():
-                params.append(tuple(row[col] for col in column_mappings.keys()))
+                # Insert batch data into temp table
+                stage_batch(cursor, batch, table, column_mappings, stage_method, logger)
 
-            insert_placeholders = ', '.join(['?' for _ in column_mappings])
-            logger.info(f"Executing INSERT INTO #TempLabBatch ({', '.join(column_mappings.values())}) VALUES ({insert_placeholders})...")
-            cursor.executemany(
-                f"INSERT INTO #TempLabBatch ({', '.join(column_mappings.values())}) VALUES ({insert_placeholders})",
-                params
-            )
-            
-            # Prepare the SQL query with dynamic columns
-            update_columns = ', '.join([
-                f"target.{col} = source.{col}" for col in column_mappings.values() if col != 'srk_import_timestamp'
-            ])
-            insert_columns = ', '.join(column_mappings.values())
-            insert_values = ', '.join([f"source.{col}" for col in column_mappings.values()])
-            match_clause = ' AND '.join([f"target.{target_col} = source.{source_col}" for target_col, source_col in match_conditions.items()])
+                # only the MERGE and its commit hold a write slot, staging into tempdb does not contend
+                with write_slot(governor):
+                    # Perform MERGE operation with OUTPUT clause
+                    sql_query = f"""
+                        {key_range_target(cursor, table, match_conditions)}
+                        MERGE INTO target_range AS target
+                        USING #TempLabBatch AS source
+                        ON {match_clause}
+                        {matched_clause} THEN
+                            UPDATE SET {update_columns}
+                        WHEN NOT MATCHED THEN
+                            INSERT ({insert_columns})
+                            VALUES ({insert_values})
+                        OUTPUT $action;
+                    """
+                    cursor.execute(sql_query)
 
-            # Perform MERGE operation with OUTPUT clause
-            sql_query = f"""
-                MERGE INTO {table} AS target
-                USING #TempLabBatch AS source
-                ON {match_clause}
-                WHEN MATCHED THEN
-                    UPDATE SET {update_columns}
-                WHEN NOT MATCHED THEN
-                    INSERT ({insert_columns})
-                    VALUES ({insert_values})
-                OUTPUT $action;
-            """
-            cursor.execute(sql_query)
+                    # Get the result of the OUTPUT clause
+                    actions = [action[0] for action in first_result_set(cursor).fetchall()]
 
-            # Get the result of the OUTPUT clause
-            for action in cursor.fetchall():
-                if action[0] == 'UPDATE':
-                    updated_count += 1
-                elif action[0] == 'INSERT':
-                    inserted_count += 1
-            
-            distinct_insert_count = f"""
-            SELECT COUNT(DISTINCT sample_id) 
-            AS 'distinct' 
-            FROM #TempLabBatch
-            """ 
-            
-            cursor.execute(distinct_insert_count)
-            sample_count = cursor.fetchall()
+                    distinct_insert_count = f"""
+                    SELECT COUNT(DISTINCT sample_id) 
+                    AS 'distinct' 
+                    FROM #TempLabBatch
+                    """ 
 
-            # Drop the temporary table
-            cursor.execute("DROP TABLE #TempLabBatch")
+                    cursor.execute(distinct_insert_count)
+                    sample_count = cursor.fetchall()
 
-            cnxn.commit()
+                    # Drop the temporary table
+                    cursor.execute("DROP TABLE #TempLabBatch")
+
+                    cnxn.commit()
+                return actions, sample_count
+
+            (actions, sample_count), cnxn = run_batch(merge, cnxn, logger, f"rows {i+1} to {min(i+batch_size, len(df))}", connector, governor, retries)
+            updated_count += actions.count('UPDATE')
+            inserted_count += actions.count('INSERT')
+            # matched rows with an identical hash produce no OUTPUT row
+            unchanged_count += len(batch) - len(actions)
             print(f"Processed batch {i//batch_size + 1}, rows {i+1} to {min(i+batch_size, len(df))}")
 
-        cursor.close()
         return {
             'updated_count': updated_count,
             'inserted_count': inserted_count,
+            'unchanged_count': unchanged_count if change_detection else '',
             'distinct_count' : sample_count[0][0],
+            'retry_count': sum(retries.values()),
+            'retries': dict(retries),
             'status': 'success'
         }
     except Exception as e:
         return {
             'updated_count': updated_count,
             'inserted_count': inserted_count,
+            'retry_count': sum(retries.values()),
+            'retries': dict(retries),
             'status': f'failure: {str(e)}'
         }
+
+def row_hashes(df: pd.DataFrame, columns: list) -> np.ndarray:
+    """
+    64-bit content hash of each row over `columns`, computed column-wise by pandas.
+    Categorical columns hash by value, so the hash does not depend on the encoding.
+    Returned as int64 to fit a bigint column.
+    """
+    return pd.util.hash_pandas_object(df[list(columns)], index=False).to_numpy().view('int64')
+
+def diff_snapshot(current: pd.DataFrame, previous: pd.DataFrame, keys: list) -> tuple:
+    """
+    Compare the key and row_hash columns of a new result set with the last imported one.
+
+    Returns:
+    - (status of each row of `current` as 'inserted', 'changed' or 'unchanged',
+       keys of `previous` missing from `current`)
+    """
+    merged = current[keys + ['row_hash']].astype({key: str for key in keys}).assign(_row=np.arange(len(current))).merge(
+        previous[keys + ['row_hash']].astype({key: str for key in keys}),
+        on=keys, how='outer', suffixes=('', '_previous'), indicator=True
+    )
+    removed = merged.loc[merged['_merge'] == 'right_only', keys].reset_index(drop=True)
+    merged = merged[merged['_merge'] != 'right_only'].sort_values('_row')
+    status = np.where(
+        merged['_merge'] == 'left_only', 'inserted',
+        np.where(merged['row_hash'] != merged['row_hash_previous'], 'changed', 'unchanged')
+    )
+    return pd.Series(status, index=current.index), removed
+
+def db_apply_reissue(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column_mappings: dict, match_conditions: dict, logger, job_number: str, result_status='', source_name='', snapshot_table='assay_result_snapshot', version_table='assay_result_version', hash_exclude=('source_name', 'srk_import_timestamp'), batch_size=5000, governor=None):
+    """
+    Import a certificate as the next version of its job, applying only the difference to the last import.
+
+    A compact snapshot (keys and row hash) of each job's last imported result set is kept in
+    snapshot_table. The new file is diffed against it in memory: new keys are inserted, rows
+    whose hash changed are updated, keys no longer in the file are deleted, and unchanged rows
+    are not sent at all. Each import is recorded in version_table with its counts.
+    The first import of a job diffs against an empty snapshot, i.e. everything is inserted.
+
+    Parameters:
+    - cnxn: Database connection object.
+    - df: DataFrame containing the whole reissued result set.
+    - table: db table
+    - column_mappings: Dictionary mapping DataFrame columns to table columns.
+    - match_conditions: Dictionary mapping target columns to source columns for the ON clause.
+    - job_number: Job the certificate belongs to.
+    - result_status: Status of this issue, e.g. preliminary or final, recorded with the version.
+    - source_name: File name recorded with the version.
+    - snapshot_table: Table holding the last imported keys and hashes per job, created if missing.
+    - version_table: Table recording each imported version per job, created if missing.
+    - hash_exclude: DataFrame columns left out of the row hash.
+    - batch_size: Number of rows to process in each batch.
+    - governor: WriteGovernor limiting concurrent merges into `table`, see db_merge_batch().
+
+    Returns:
+    - A dictionary with counts of inserted, updated, removed and unchanged records,
+      the version number, and a success/failure status.
+    """
+    try:
+        cursor = cnxn.cursor()
+        keys = list(match_conditions.keys())
+        key_columns = [column_mappings[key] for key in keys]
+        definitions = {col[0].lower(): col for col in column_definitions(cursor, table)}
+        key_definitions = ', '.join([f"{col} {column_type(definitions[col.lower()])} NOT NULL" for col in key_columns])
+        ensure_snapshot_tables(cnxn, cursor, snapshot_table, version_table, key_definitions, key_columns)
+
+        # the same hash as db_merge_batch(change_detection=True) stores in the table
+        df = df.assign(row_hash=row_hashes(df, [col for col in column_mappings if col not in hash_exclude]))
+
+        cursor.execute(f"SELECT {', '.join(key_columns)}, row_hash FROM {snapshot_table} WHERE job_number = ?", job_number)
+        previous = pd.DataFrame([tuple(row) for row in cursor.fetchall()], columns=keys + ['row_hash'])
+        cursor.execute(f"SELECT COALESCE(MAX(version), 0) FROM {version_table} WHERE job_number = ?", job_number)
+        version = cursor.fetchone()[0] + 1
+
+        status, removed = diff_snapshot(df, previous, keys)
+        counts = status.value_counts()
+        inserted_count = int(counts.get('inserted', 0))
+        updated_count = int(counts.get('changed', 0))
+        unchanged_count = int(counts.get('unchanged', 0))
+        logger.info(f"Job {job_number} version {version}: {inserted_count} new, {updated_count} changed, {len(removed)} removed, {unchanged_count} unchanged")
+
+        # new and changed rows only
+        df_changed = df[status != 'unchanged'].drop(columns=['row_hash'])
+        if len(df_changed):
+            result = db_merge_batch(cnxn, df_changed, table, column_mappings, match_conditions, logger, batch_size, change_detection=True, hash_exclude=hash_exclude, governor=governor)
+            if result['status'] != 'success':
+                return {**result, 'removed_count': 0, 'unchanged_count': unchanged_count, 'version': None}
+
+        match_clause = ' AND '.join([f"target.{col} = source.{col}" for col in key_columns])
+        # the deletes hold their locks on the table until the commit
+        with write_slot(governor):
+            if len(removed):
+                cursor.execute(f"CREATE TABLE #TempLabKeys ({key_definitions})")
+                cursor.executemany(
+                    f"INSERT INTO #TempLabKeys ({', '.join(key_columns)}) VALUES ({', '.join(['?' for _ in key_columns])})",
+                    batch_params(removed, keys)
+                )
+                cursor.execute(f"DELETE target FROM {table} AS target JOIN #TempLabKeys AS source ON {match_clause}")
+                cursor.execute(f"DELETE target FROM {snapshot_table} AS target JOIN #TempLabKeys AS source ON {match_clause} WHERE target.job_number = ?", job_number)
+                cursor.execute("DROP TABLE #TempLabKeys")
+
+            # bring the snapshot up to this version
+            snapshot = df.loc[status != 'unchanged', keys + ['row_hash']]
+            if len(snapshot):
+                cursor.execute(f"CREATE TABLE #TempLabSnapshot ({key_definitions}, row_hash bigint NOT NULL)")
+                cursor.executemany(
+                    f"INSERT INTO #TempLabSnapshot ({', '.join(key_columns)}, row_hash) VALUES ({', '.join(['?' for _ in key_columns])}, ?)",
+                    batch_params(snapshot, keys + ['row_hash'])
+                )
+                cursor.execute(f"""
+                    MERGE INTO {snapshot_table} AS target
+                    USING #TempLabSnapshot AS source
+                    ON target.job_number = ? AND {match_clause}
+                    WHEN MATCHED THEN
+                        UPDATE SET target.row_hash = source.row_hash, target.version = ?
+                    WHEN NOT MATCHED THEN
+                        INSERT (job_number, {', '.join(key_columns)}, row_hash, version)
+                        VALUES (?, {', '.join([f'source.{col}' for col in key_columns])}, source.row_hash, ?);
+                """, (job_number, version, job_number, version))
+                cursor.execute("DROP TABLE #TempLabSnapshot")
+
+            cursor.execute(
+                f"INSERT INTO {version_table} (job_number, version, result_status, source_name, inserted_count, updated_count, removed_count, unchanged_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_number, version, result_status, source_name, inserted_count, updated_count, len(removed), unchanged_count)
+            )
+            cnxn.commit()
+        cursor.close()
+        return {
+            'inserted_count': inserted_count,
+            'updated_count': updated_count,
+            'removed_count': len(removed),
+            'unchanged_count': unchanged_count,
+            'distinct_count': df['sample_id'].nunique() if 'sample_id' in df.columns else '',
+            'version': version,
+            'status': 'success'
+        }
+    except Exception as e:
+        return {
+            'inserted_count': 0,
+            'updated_count': 0,
+            'removed_count': 0,
+            'status': f'failure: {str(e)}'
+        }
+
+def ensure_snapshot_tables(cnxn: pyodbc.Connection, cursor: pyodbc.Cursor, snapshot_table: str, version_table: str, key_definitions: str, key_columns: list):
+    """
+    Create the snapshot and version tables used by db_apply_reissue() if they are missing.
+    """
+    cursor.execute(f"""
+        IF OBJECT_ID('{snapshot_table}') IS NULL
+        CREATE TABLE {snapshot_table} (
+            job_number varchar(50) NOT NULL,
+            {key_definitions},
+            row_hash bigint NOT NULL,
+            version int NOT NULL,
+            PRIMARY KEY (job_number, {', '.join(key_columns)})
+        )
+    """)
+    cursor.execute(f"""
+        IF OBJECT_ID('{version_table}') IS NULL
+        CREATE TABLE {version_table} (
+            job_number varchar(50) NOT NULL,
+            version int NOT NULL,
+            result_status varchar(50) NULL,
+            source_name varchar(255) NULL,
+            inserted_count int NOT NULL,
+            updated_count int NOT NULL,
+            removed_count int NOT NULL,
+            unchanged_count int NOT NULL,
+            imported_at datetime NOT NULL DEFAULT GETDATE(),
+            PRIMARY KEY (job_number, version)
+        )
+    """)
+    cnxn.commit()
+
+def require_column(cursor: pyodbc.Cursor, table: str, column: str):
+    """
+    Raise when `table` has no `column`. Columns are added by `python db_health.py --migrate`,
+    never by an import, so a schema change does not depend on which request comes first.
+    """
+    cursor.execute(f"SELECT COL_LENGTH('{table}', '{column}')")
+    if cursor.fetchone()[0] is None:
+        raise ValueError(f"Column {table}.{column} is missing, add it with `python db_health.py --migrate`.")
+    if table in _column_definitions and column.lower() not in [col[0].lower() for col in _column_definitions[table]]:
+        # migrated since the definitions were cached
+        _column_definitions.pop(table)
+
+def add_columns(cnxn: pyodbc.Connection, table: str, columns: dict) -> list:
+    """
+    Migration adding the columns of `columns` that `table` is missing, run by db_health.py --migrate.
+
+    Parameters:
+    - cnxn: Database connection object.
+    - table: Target table, e.g. assay_result.
+    - columns: {column: definition}, e.g. SCHEMA_COLUMNS.
+
+    Returns:
+    - List of the columns added.
+    """
+    cursor = cnxn.cursor()
+    added = []
+    for column, definition in columns.items():
+        cursor.execute(f"SELECT COL_LENGTH('{table}', '{column}')")
+        if cursor.fetchone()[0] is None:
+            cursor.execute(f"ALTER TABLE {table} ADD {column} {definition}")
+            added.append(column)
+    cnxn.commit()
+    cursor.close()
+    _column_definitions.pop(table, None)
+    return added
     
 def db_merge(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column_mappings: dict, match_conditions: dict):
     """
@@ -202,7 +709,7 @@ def db_merge(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column_mappi
             'status': f'failure: {str(e)}'
         }
     
-def db_insert_batch(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column_mappings: dict, match_conditions: dict, logger, batch_size=5000):
+def db_insert_batch(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column_mappings: dict, match_conditions: dict, logger, batch_size=5000, isolate_errors=False, reject_table='assay_result_reject', run_key=None, ledger_table='import_run_batch', stage_method='executemany', governor=None, connector=None, key_order=True):
     """
     Batch inserts records using MERGE - only inserts records that that are not matched.
 
@@ -212,105 +719,729 @@ def db_insert_batch(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, colum
     - table: db table
     - column_mappings: Dictionary mapping DataFrame columns to table columns.
     - match_conditions: Dictionary mapping target columns to source columns for the ON clause.
-    - batch_size: Number of rows to process in each batch.
+    - batch_size: Number of rows to process in each batch, or 'auto' to size batches at runtime
+      with an AdaptiveBatcher.
+    - isolate_errors: When a batch fails on bad data, bisect it to find the offending rows,
+      quarantine them to reject_table with the driver error and load the rest. The rejects of a
+      batch are committed with its checkpoint.
+    - reject_table: Table receiving quarantined rows when isolate_errors is set.
+    - run_key: (source name, content hash) of the import. When given, every committed batch
+      is recorded in ledger_table and rows already recorded for the key are skipped,
+      so a retried import resumes from the first uncommitted batch.
+    - ledger_table: Table recording committed batch ranges per run_key.
+    - stage_method: How rows reach #TempLabBatch, one of STAGING_METHODS (see stage_batch()).
+    - governor: WriteGovernor limiting concurrent merges into `table`, each MERGE and its commit run in
+      one of its slots, staging does not (see stage_and_insert()).
+    - connector: Connector replacing the connection when it drops. A batch failing on a deadlock,
+      throttling or a dropped connection is retried on its own (see run_batch()), without it
+      only on the same connection.
+    - key_order: Load the rows sorted by the match keys, in batches of whole samples (leading key),
+      so each MERGE walks one contiguous range of the table's key index (see order_by_key()).
+      Checkpoints of key ordered runs are kept apart from runs in file order.
 
     Returns:
-    - A dictionary with counts of updated and inserted records, and a success/failure status.
+    - A dictionary with counts of inserted and rejected records, retries, and a success/failure status.
     """
-    try:
-        cursor = cnxn.cursor()
-        inserted_count = 0
+    return insert_frames(cnxn, [df], table, column_mappings, match_conditions, logger, batch_size, isolate_errors, reject_table, run_key, ledger_table, stage_method, governor, connector, key_order)
 
-        # Retrieve the column definitions from the main table
-        cursor.execute(f"""
-            SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_NAME = '{table}'
-        """)
-        column_definitions = cursor.fetchall()
-
-        # Construct the CREATE TABLE statement for the temp table
-        temp_table_columns = ', '.join([
-            f"{col[0]} {col[1]}" + 
-            (f"({col[2]})" if col[2] and col[2] != -1 else "(max)" if col[1] in ['nvarchar', 'varchar', 'varbinary'] else "") + 
-            (" NULL" if col[3] == 'YES' else " NOT NULL")
-            for col in column_definitions
-        ])
+def db_insert_stream(cnxn: pyodbc.Connection, chunks, table: str, column_mappings: dict, match_conditions: dict, logger, batch_size=5000, isolate_errors=False, reject_table='assay_result_reject', run_key=None, ledger_table='import_run_batch', stage_method='executemany', queue_size=2, governor=None, connector=None, key_order=True):
+    """
+    db_insert_batch() for a stream of DataFrame chunks, overlapping parsing with loading.
 
-        # Process data in batches
-        for i in range(0, len(df), batch_size):
-            batch = df.iloc[i:i + batch_size]
+    A consumer thread stages and merges each chunk while the caller's generator produces
+    the next one. The queue between them holds at most queue_size chunks, so a fast
+    producer blocks instead of buffering the whole file. If the consumer fails, production
+    stops and the failure is returned; if the producer raises, the consumer finishes the
+    chunks already queued and the exception is re-raised. Batches committed before a failure
+    stay checkpointed under run_key.
 
-            # Create a temp table for this batch
-            cursor.execute(f"CREATE TABLE #TempLabBatch ({temp_table_columns})")
-            logger.info(f"Executed CREATE TABLE #TempLabBatch ({temp_table_columns})")
+    Parameters are those of db_insert_batch(), with chunks in place of df.
 
-            # Insert batch data into temp table
-            params = []
-            for _, row in batch.iterrows():
-                params.append(tuple(row[col] for col in column_mappings.keys()))
+    Returns:
+    - A dictionary with counts of inserted and rejected records, and a success/failure status.
+    """
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    end_of_stream = object()
+    stopped = threading.Event()
+    result = {}
 
-            insert_placeholders = ', '.join(['?' for _ in column_mappings])
-            logger.info(f"Executing INSERT INTO #TempLabBatch ({', '.join(column_mappings.values())}) VALUES ({insert_placeholders})...")
-            cursor.executemany(
-                f"INSERT INTO #TempLabBatch ({', '.join(column_mappings.values())}) VALUES ({insert_placeholders})",
-                params
-            )
-            
-            # # Prepare the SQL query with dynamic columns
-            # update_columns = ', '.join([
-            #     f"target.{col} = source.{col}" for col in column_mappings.values() if col != 'srk_import_timestamp'
-            # ])
-            insert_columns = ', '.join(column_mappings.values())
-            insert_values = ', '.join([f"source.{col}" for col in column_mappings.values()])
-            match_clause = ' AND '.join([f"target.{target_col} = source.{source_col}" for target_col, source_col in match_conditions.items()])
+    def frames():
+        while True:
+            chunk = chunk_queue.get()
+            if chunk is end_of_stream:
+                return
+            yield chunk
 
-            distinct_record_count = f"""
-            SELECT COUNT(*) AS distinct_count
-            FROM (
-                SELECT DISTINCT sample_id, lab_method, analyte
-                FROM #TempLabBatch
-            ) AS subquery;
-            """ 
+    def consume():
+        result.update(insert_frames(cnxn, frames(), table, column_mappings, match_conditions, logger, batch_size, isolate_errors, reject_table, run_key, ledger_table, stage_method, governor, connector, key_order))
+        # tells the producer to stop if the load ended before the stream did
+        stopped.set()
 
-            # Perform MERGE operation with OUTPUT clause
-            sql_query = f"""
-                MERGE INTO {table} AS target
-                USING #TempLabBatch AS source
-                ON {match_clause}
-                WHEN NOT MATCHED THEN
-                    INSERT ({insert_columns})
-                    VALUES ({insert_values})
-                OUTPUT $action;
-            """
-            cursor.execute(sql_query)
+    def put(item) -> bool:
+        while consumer.is_alive() and not stopped.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-            # Get the result of the OUTPUT clause
-            for action in cursor.fetchall():
-                if action[0] == 'INSERT':
-                    inserted_count += 1
-            
-            cursor.execute(distinct_record_count)
-            sample_count = cursor.fetchall()
+    consumer = threading.Thread(target=consume, name='sql-insert-consumer', daemon=True)
+    consumer.start()
+    try:
+        for chunk in chunks:
+            if not put(chunk):
+                break
+    finally:
+        put(end_of_stream)
+        consumer.join()
+    return result
 
-            # Drop the temporary table
-            cursor.execute("DROP TABLE #TempLabBatch")
+def insert_frames(cnxn: pyodbc.Connection, frames, table: str, column_mappings: dict, match_conditions: dict, logger, batch_size=5000, isolate_errors=False, reject_table='assay_result_reject', run_key=None, ledger_table='import_run_batch', stage_method='executemany', governor=None, connector=None, key_order=True):
+    """
+    Load an iterable of DataFrames as one import, see db_insert_batch() for the parameters.
+    Row offsets, checkpoints and batch sizing run across the frames as if they were one frame.
+    """
+    inserted_count = 0
+    retries = Counter()
+    try:
+        cursor = cnxn.cursor()
+        sample_count = 0
+        rejected = []
 
-            cnxn.commit()
-            print(f"Processed batch {i//batch_size + 1}, rows {i+1} to {min(i+batch_size, len(df))}")
+        # Retrieve the column definitions from the main table
+        temp_table_columns = temp_table_definition(cursor, table)
 
+        if run_key and key_order:
+            # row offsets refer to the key order
+            run_key = (run_key[0], run_key[1] + ':key')
+        committed = committed_ranges(cnxn, cursor, run_key, ledger_table) if run_key else []
+        skipped_rows = resume_row(committed)
+        if skipped_rows:
+            logger.info(f"Resuming import, rows 1 to {skipped_rows} already committed")
+        if isolate_errors:
+            ensure_reject_table(cnxn, cursor, reject_table)
+        # each batch gets a cursor of its own, see run_batch()
         cursor.close()
+
+        batcher = None
+        # row offset of the current frame within the import
+        offset = 0
+        batch_number = 0
+        for df in frames:
+            boundaries = None
+            if key_order and len(df):
+                df, boundaries = order_by_key(df, column_mappings, match_conditions)
+            if batch_size == 'auto' and batcher is None and len(df):
+                batcher = AdaptiveBatcher(len(column_mappings), logger, stage_method, row_bytes=estimate_row_bytes(df, column_mappings.keys()))
+
+            # Process data in batches
+            i = min(max(skipped_rows - offset, 0), len(df))
+            while i < len(df):
+                row_end = i + (batcher.next_size() if batcher else batch_size)
+                # a batch cut short by the end of the frame says nothing about its size
+                full = row_end <= len(df)
+                row_end = min(row_end, len(df))
+                if boundaries is not None and row_end < len(df):
+                    row_end = key_boundary(boundaries, i, row_end)
+                batch = df.iloc[i:row_end]
+
+                # parts committed by bisect_insert() before a transient error are matched, not inserted again, on the retry
+                def load(cnxn, cursor):
+                    batch_rejected = []
+                    start = time.perf_counter()
+                    taken = slots_taken(governor)
+                    checkpoint = (lambda inserted: record_batch(cursor, run_key, ledger_table, offset + i, offset + row_end, inserted)) if run_key else None
+                    if isolate_errors:
+                        batch_inserted, batch_count = bisect_insert(cnxn, cursor, batch, table, temp_table_columns, column_mappings, match_conditions, logger, batch_rejected, stage_method, governor)
+                        # the rejects are committed with the checkpoint, so a resumed run that
+                        # skips the batch has already quarantined its rejects
+                        if batch_rejected:
+                            reject_rows(cursor, batch_rejected, table, reject_table, column_mappings, logger)
+                        if checkpoint:
+                            checkpoint(batch_inserted)
+                        cnxn.commit()
+                    else:
+                        # the checkpoint is committed with the MERGE, so a batch is never recorded without its rows
+                        batch_inserted, batch_count = stage_and_insert(cnxn, cursor, batch, table, temp_table_columns, column_mappings, match_conditions, logger, stage_method, governor, checkpoint)
+                    # waiting for a write slot does not shrink the batches
+                    return batch_inserted, batch_count, batch_rejected, time.perf_counter() - start - slot_wait(governor, taken)
+
+                (batch_inserted, batch_count, batch_rejected, seconds), cnxn = run_batch(load, cnxn, logger, f"rows {offset+i+1} to {offset+row_end}", connector, governor, retries)
+                rejected.extend(batch_rejected)
+                if batcher:
+                    batcher.record(row_end - i, seconds, full)
+                inserted_count += batch_inserted
+                sample_count = batch_count or sample_count
+                batch_number += 1
+                print(f"Processed batch {batch_number}, rows {offset+i+1} to {offset+row_end}")
+                i = row_end
+            offset += len(df)
+
+        if rejected:
+            logger.warning(f"{len(rejected)} rows rejected to {reject_table}")
+
         return {
             'inserted_count': inserted_count,
-            'distinct_count' : sample_count[0][0],
+            'distinct_count' : sample_count,
+            'rejected_count': len(rejected),
+            'skipped_rows': min(skipped_rows, offset),
+            'retry_count': sum(retries.values()),
+            'retries': dict(retries),
             'status': 'success'
         }
     except Exception as e:
         return {
             'inserted_count': inserted_count,
+            'retry_count': sum(retries.values()),
+            'retries': dict(retries),
             'status': f'failure: {str(e)}'
         }
 
+def committed_ranges(cnxn: pyodbc.Connection, cursor: pyodbc.Cursor, run_key: tuple, ledger_table: str) -> list:
+    """
+    Return the (row_start, row_end) ranges already committed for an import run,
+    creating the ledger table on first use.
+    """
+    cursor.execute(f"""
+        IF OBJECT_ID('{ledger_table}') IS NULL
+        CREATE TABLE {ledger_table} (
+            source_name varchar(255) NOT NULL,
+            content_hash varchar(64) NOT NULL,
+            row_start int NOT NULL,
+            row_end int NOT NULL,
+            inserted_count int NOT NULL,
+            committed_at datetime NOT NULL DEFAULT GETDATE(),
+            PRIMARY KEY (source_name, content_hash, row_start)
+        )
+    """)
+    cnxn.commit()
+    cursor.execute(
+        f"SELECT row_start, row_end FROM {ledger_table} WHERE source_name = ? AND content_hash = ?",
+        run_key
+    )
+    return [(row[0], row[1]) for row in cursor.fetchall()]
+
+def resume_row(committed: list) -> int:
+    """
+    First row not covered by the committed ranges, counting contiguously from row 0.
+    """
+    row = 0
+    for start, end in sorted(committed):
+        if start > row:
+            break
+        row = max(row, end)
+    return row
+
+def record_batch(cursor: pyodbc.Cursor, run_key: tuple, ledger_table: str, row_start: int, row_end: int, inserted_count: int):
+    """
+    Checkpoint a batch of an import run in the ledger. The caller commits.
+    """
+    cursor.execute(
+        f"INSERT INTO {ledger_table} (source_name, content_hash, row_start, row_end, inserted_count) VALUES (?, ?, ?, ?, ?)",
+        (*run_key, row_start, row_end, inserted_count)
+    )
+
+def app_lock_resource(key: str) -> str:
+    """
+    sp_getapplock resource name for a key, hashed when it exceeds the 255 character limit.
+    """
+    resource = f"lab_import:{key}"
+    return resource if len(resource) <= 255 else f"lab_import:{hashlib.sha1(key.encode()).hexdigest()}"
+
+def acquire_app_lock(cnxn: pyodbc.Connection, key: str, logger, timeout_ms: int = IMPORT_LOCK_TIMEOUT_MS):
+    """
+    Take an exclusive session application lock on key, waiting up to timeout_ms for another
+    session holding it. The connection must be in autocommit mode.
+
+    Returns:
+    - The server time the lock was requested at, or None when the wait timed out.
+    """
+    cursor = cnxn.cursor()
+    cursor.execute("SELECT SYSUTCDATETIME()")
+    requested_at = cursor.fetchone()[0]
+    cursor.close()
+    result = get_app_lock(cnxn, app_lock_resource(key), timeout_ms)
+    # 0 granted at once, 1 granted after waiting, negative timed out, cancelled or deadlocked
+    if result < 0:
+        logger.warning(f"Could not lock {key}: sp_getapplock returned {result}")
+        return None
+    if result == 1:
+        logger.info(f"Waited for a concurrent import of {key}")
+    return requested_at
+
+def release_app_lock(cnxn: pyodbc.Connection, key: str):
+    """ Release the lock taken by acquire_app_lock() """
+    free_app_lock(cnxn, app_lock_resource(key))
+
+def get_app_lock(cnxn: pyodbc.Connection, resource: str, timeout_ms: int) -> int:
+    """
+    sp_getapplock on resource, exclusive and owned by the session.
+
+    Returns:
+    - 0 granted at once, 1 granted after waiting, negative timed out, cancelled or deadlocked.
+    """
+    cursor = cnxn.cursor()
+    cursor.execute("""
+        DECLARE @result int;
+        EXEC @result = sp_getapplock @Resource = ?, @LockMode = 'Exclusive', @LockOwner = 'Session', @LockTimeout = ?;
+        SELECT @result;
+    """, (resource, timeout_ms))
+    result = first_result_set(cursor).fetchone()[0]
+    cursor.close()
+    return result
+
+def free_app_lock(cnxn: pyodbc.Connection, resource: str):
+    """ Release a lock taken by get_app_lock() """
+    cursor = cnxn.cursor()
+    cursor.execute("EXEC sp_releaseapplock @Resource = ?, @LockOwner = 'Session'", resource)
+    cursor.close()
+
+def import_result_since(cnxn: pyodbc.Connection, key: str, since, result_table='import_run_result'):
+    """
+    Response of an import of key that completed after `since`, or None.
+    Creates the result table on first use.
+    """
+    cursor = cnxn.cursor()
+    cursor.execute(f"""
+        IF OBJECT_ID('{result_table}') IS NULL
+        CREATE TABLE {result_table} (
+            lock_key nvarchar(450) NOT NULL PRIMARY KEY,
+            completed_at datetime2 NOT NULL,
+            response nvarchar(max) NOT NULL
+        )
+    """)
+    cursor.execute(f"SELECT response FROM {result_table} WHERE lock_key = ? AND completed_at >= ?", (key[:450], since))
+    row = cursor.fetchone()
+    cursor.close()
+    return row[0] if row else None
+
+def record_import_result(cnxn: pyodbc.Connection, key: str, response: str, result_table='import_run_result'):
+    """
+    Keep the latest response of an import of key for duplicates waiting on its lock.
+    """
+    cursor = cnxn.cursor()
+    cursor.execute(f"DELETE FROM {result_table} WHERE lock_key = ?", key[:450])
+    cursor.execute(f"INSERT INTO {result_table} (lock_key, completed_at, response) VALUES (?, SYSUTCDATETIME(), ?)", (key[:450], response))
+    cursor.close()
+
+class WriteGovernor:
+    """
+    Caps the number of MERGE batches running against one table at the same time.
+
+    slot() blocks until one of the table's `slots` is free and holds it until the block exits,
+    so the batch and its commit run inside the slot. Waiters are served in arrival order. The
+    wait of every slot taken is kept, see stats(), and waits longer than log_after seconds are logged.
+
+    This class limits the threads of one process and stands in for SqlWriteGovernor in tests
+    and single-process tools. SqlWriteGovernor applies the same cap across every Function instance.
+    """
+    def __init__(self, table: str, logger, slots: int = WRITE_SLOTS, timeout_ms: int = WRITE_SLOT_TIMEOUT_MS, log_after: float = 1.0):
+        self.table = table
+        self.logger = logger
+        self.slots = max(1, slots)
+        self.timeout_ms = timeout_ms
+        self.log_after = log_after
+        self.waits = []
+        self._condition = threading.Condition()
+        self._queue = []
+        self._in_use = 0
+
+    @contextmanager
+    def slot(self):
+        start = time.perf_counter()
+        slot = self.acquire()
+        waited = time.perf_counter() - start
+        self.waits.append(waited)
+        if waited >= self.log_after:
+            self.logger.info(f"Waited {waited:.1f}s for a {self.table} write slot")
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    def acquire(self) -> int:
+        """ Take a slot, first come first served. Raises TimeoutError after timeout_ms. """
+        deadline = time.monotonic() + self.timeout_ms / 1000
+        ticket = object()
+        with self._condition:
+            self._queue.append(ticket)
+            try:
+                while self._queue[0] is not ticket or self._in_use >= self.slots:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No {self.table} write slot free after {self.timeout_ms} ms")
+                    self._condition.wait(remaining)
+            finally:
+                self._queue.remove(ticket)
+                # the next in line may be able to take a slot too
+                self._condition.notify_all()
+            self._in_use += 1
+        return 0
+
+    def release(self, slot: int):
+        with self._condition:
+            self._in_use -= 1
+            self._condition.notify_all()
+
+    def reconnected(self, cnxn: pyodbc.Connection):
+        """ Called by run_batch() when the load continues on a new connection """
+
+    def stats(self) -> dict:
+        """ Slots taken and their waits in seconds """
+        return {
+            'table': self.table,
+            'slots_taken': len(self.waits),
+            'wait_seconds_total': round(sum(self.waits), 3),
+            'wait_seconds_max': round(max(self.waits, default=0.0), 3),
+        }
+
+class SqlWriteGovernor(WriteGovernor):
+    """
+    WriteGovernor shared by every process connected to the database, using application locks.
+
+    Each slot is an exclusive session lock on 'write:<table>:<n>'. A waiter first queues on the
+    lock 'write:<table>:queue', which SQL Server grants in request order; only the head of that
+    queue polls the slot locks, and it leaves the queue once it holds one. Session locks are
+    independent of transactions, so the merge connection itself can hold them, and they are
+    released by the server if the connection drops.
+    """
+    def __init__(self, cnxn: pyodbc.Connection, table: str, logger, slots: int = WRITE_SLOTS, timeout_ms: int = WRITE_SLOT_TIMEOUT_MS, log_after: float = 1.0, poll_seconds: float = WRITE_SLOT_POLL_SECONDS):
+        super().__init__(table, logger, slots, timeout_ms, log_after)
+        self.cnxn = cnxn
+        self.poll_seconds = poll_seconds
+
+    def resource(self, name) -> str:
+        return app_lock_resource(f"write:{self.table}:{name}")
+
+    def acquire(self) -> int:
+        deadline = time.monotonic() + self.timeout_ms / 1000
+        if get_app_lock(self.cnxn, self.resource('queue'), self.timeout_ms) < 0:
+            raise TimeoutError(f"No {self.table} write slot free after {self.timeout_ms} ms")
+        try:
+            while True:
+                for slot in range(self.slots):
+                    if get_app_lock(self.cnxn, self.resource(slot), 0) >= 0:
+                        return slot
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"No {self.table} write slot free after {self.timeout_ms} ms")
+                time.sleep(self.poll_seconds)
+        finally:
+            free_app_lock(self.cnxn, self.resource('queue'))
+
+    def release(self, slot: int):
+        try:
+            free_app_lock(self.cnxn, self.resource(slot))
+        except pyodbc.Error as e:
+            # a session lock goes with its connection
+            self.logger.warning(f"Could not release {self.table} write slot {slot}: {e}")
+
+    def reconnected(self, cnxn: pyodbc.Connection):
+        self.cnxn = cnxn
+
+def write_slot(governor):
+    """ governor.slot(), or no limit when there is no governor """
+    return governor.slot() if governor is not None else nullcontext()
+
+def slots_taken(governor) -> int:
+    """ Write slots taken so far, to pass to slot_wait() """
+    return len(governor.waits) if governor is not None else 0
+
+def slot_wait(governor, taken: int) -> float:
+    """ Seconds spent waiting for the write slots taken since slots_taken() returned `taken` """
+    return sum(governor.waits[taken:]) if governor is not None else 0.0
+
+def column_definitions(cursor: pyodbc.Cursor, table: str) -> list:
+    """
+    Column definitions (name, data type, max length, nullable, collation) of `table`.
+    They are cached per table for the life of the worker.
+    """
+    if table not in _column_definitions:
+        cursor.execute(f"""
+            SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE, COLLATION_NAME
+            FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_NAME = '{table}'
+        """)
+        definitions = [tuple(row) for row in cursor.fetchall()]
+        if not definitions:
+            return definitions
+        _column_definitions[table] = definitions
+    return _column_definitions[table]
+
+def column_type(col: tuple) -> str:
+    """
+    SQL type of a column definition, e.g. varchar(50), nvarchar(max) or float.
+    """
+    return f"{col[1]}" + (f"({col[2]})" if col[2] and col[2] != -1 else "(max)" if col[1] in ['nvarchar', 'varchar', 'varbinary'] else "")
+
+def column_collation(col: tuple) -> str:
+    """
+    COLLATE clause of a column definition, e.g. " COLLATE Latin1_General_CI_AS", or '' for
+    columns without a collation.
+    """
+    return f" COLLATE {col[4]}" if col[4] else ""
+
+def temp_table_definition(cursor: pyodbc.Cursor, table: str) -> str:
+    """
+    Build the column list for #TempLabBatch from the column definitions of `table`.
+    Character columns keep the collation of `table` rather than the default of tempdb.
+    """
+    # Construct the CREATE TABLE statement for the temp table
+    return ', '.join([
+        f"{col[0]} {column_type(col)}{column_collation(col)}" + 
+        (" NULL" if col[3] == 'YES' else " NOT NULL")
+        for col in column_definitions(cursor, table)
+    ])
+
+def batch_json(batch: pd.DataFrame, columns) -> str:
+    """
+    Serialise a batch as one JSON array of row arrays, in `columns` order.
+    pandas writes the whole frame in C, categoricals as their values and missing values as null.
+    Floats are written with 10 decimal places, so 26.979 stays 26.979 in character columns.
+    """
+    return batch[list(columns)].to_json(orient='values', date_format='iso', double_precision=10)
+
+def stage_batch(cursor: pyodbc.Cursor, batch: pd.DataFrame, table: str, column_mappings: dict, stage_method: str, logger):
+    """
+    Insert a batch into #TempLabBatch.
+
+    Staging methods:
+    - executemany: parameterised INSERT per row (pyodbc default)
+    - fast_executemany: the same INSERT with pyodbc parameter arrays
+    - values: multi-row INSERT ... VALUES statements, as many rows per statement as the
+      2100 parameter limit allows
+    - openjson: the batch is sent as a single JSON parameter and shredded server side with
+      OPENJSON ... WITH (...), typed from the column definitions of `table`. One round trip per batch.
+    """
+    insert_columns = ', '.join(column_mappings.values())
+    if stage_method == 'openjson':
+        definitions = {col[0].lower(): col for col in column_definitions(cursor, table)}
+        with_clause = ', '.join([
+            f"{col} {column_type(definitions[col.lower()])} '$[{i}]'" for i, col in enumerate(column_mappings.values())
+        ])
+        logger.info(f"Executing INSERT INTO #TempLabBatch ({insert_columns}) SELECT ... FROM OPENJSON(?) WITH ({with_clause})")
+        cursor.execute(
+            f"INSERT INTO #TempLabBatch ({insert_columns}) SELECT {insert_columns} FROM OPENJSON(?) WITH ({with_clause})",
+            batch_json(batch, column_mappings.keys())
+        )
+    elif stage_method == 'values':
+        params = batch_params(batch, column_mappings.keys())
+        rows_per_statement = values_rows_per_statement(len(column_mappings))
+        row_placeholders = '(' + ', '.join(['?' for _ in column_mappings]) + ')'
+        logger.info(f"Executing INSERT INTO #TempLabBatch ({insert_columns}) VALUES {row_placeholders}, ... in statements of {rows_per_statement} rows")
+        for start in range(0, len(params), rows_per_statement):
+            rows = params[start:start + rows_per_statement]
+            cursor.execute(
+                f"INSERT INTO #TempLabBatch ({insert_columns}) VALUES {', '.join([row_placeholders] * len(rows))}",
+                [value for row in rows for value in row]
+            )
+    elif stage_method in ('executemany', 'fast_executemany'):
+        cursor.fast_executemany = stage_method == 'fast_executemany'
+        insert_placeholders = ', '.join(['?' for _ in column_mappings])
+        logger.info(f"Executing INSERT INTO #TempLabBatch ({insert_columns}) VALUES ({insert_placeholders})...")
+        cursor.executemany(
+            f"INSERT INTO #TempLabBatch ({insert_columns}) VALUES ({insert_placeholders})",
+            batch_params(batch, column_mappings.keys())
+        )
+    else:
+        raise ValueError(f"Unknown staging method '{stage_method}'. Expected one of {', '.join(STAGING_METHODS)}.")
+
+def key_columns(column_mappings: dict, match_conditions: dict) -> list:
+    """
+    DataFrame columns of the match keys, in match_conditions order.
+    """
+    df_columns = {col: df_col for df_col, col in column_mappings.items()}
+    return [df_columns[source_col] for source_col in match_conditions.values()]
+
+def order_by_key(df: pd.DataFrame, column_mappings: dict, match_conditions: dict) -> tuple:
+    """
+    Sort a frame by the match keys so consecutive batches cover contiguous ranges of the
+    table's key index, instead of the analyte-grouped order the melt leaves.
+
+    Keys compare upper-cased, close to SQL Server's case insensitive collations. The sort is
+    stable, so a file gets the same order, and the same checkpoint offsets, on every run.
+
+    Returns:
+    - (sorted frame, row positions where the leading key changes)
+    """
+    keys = key_columns(column_mappings, match_conditions)
+    upper = {key: df[key].astype(str).str.upper().to_numpy() for key in keys}
+    positions = pd.DataFrame(upper).sort_values(keys, kind='mergesort').index.to_numpy()
+    leading = upper[keys[0]][positions]
+    return df.iloc[positions].reset_index(drop=True), np.flatnonzero(leading[1:] != leading[:-1]) + 1
+
+def key_boundary(boundaries: np.ndarray, start: int, end: int) -> int:
+    """
+    Move a batch end back to the last leading key boundary after start, so the batch holds
+    whole samples and its key range does not overlap the next batch's.
+    A batch of a single sample keeps its end.
+    """
+    k = np.searchsorted(boundaries, end, side='right') - 1
+    return int(boundaries[k]) if k >= 0 and boundaries[k] > start else end
+
+def create_temp_batch(cursor: pyodbc.Cursor, temp_table_columns: str, match_conditions: dict, logger):
+    """
+    Create #TempLabBatch with a clustered index on the match keys, dropping any left over from
+    a failed attempt. The MERGE then reads the source in key order, matching the table's key index.
+    """
+    cursor.execute("IF OBJECT_ID('tempdb..#TempLabBatch') IS NOT NULL DROP TABLE #TempLabBatch")
+    cursor.execute(f"CREATE TABLE #TempLabBatch ({temp_table_columns})")
+    cursor.execute(f"CREATE CLUSTERED INDEX ix_TempLabBatch_key ON #TempLabBatch ({', '.join(match_conditions.values())})")
+    logger.info(f"Executed CREATE TABLE #TempLabBatch ({temp_table_columns}) with a clustered index on ({', '.join(match_conditions.values())})")
+
+def key_range_target(cursor: pyodbc.Cursor, table: str, match_conditions: dict) -> str:
+    """
+    Statements narrowing the MERGE target to `target_range`, the rows of `table` within the
+    leading key range of #TempLabBatch, so the MERGE seeks one range of the key index.
+
+    The bounds are declared with the column's type to avoid an implicit conversion. A variable
+    cannot be declared with a collation, so the bounds are taken and compared under the
+    column's COLLATE: every source row is within the range, and limiting the target cannot
+    turn a match into an insert. The statements leave the session options as they were, read
+    the OUTPUT of the MERGE with first_result_set().
+    """
+    target_col, source_col = next(iter(match_conditions.items()))
+    definitions = {col[0].lower(): col for col in column_definitions(cursor, table)}
+    key_type = column_type(definitions[target_col.lower()])
+    collate = column_collation(definitions[target_col.lower()])
+    return f"""
+        DECLARE @key_low {key_type} = (SELECT MIN({source_col}{collate}) FROM #TempLabBatch);
+        DECLARE @key_high {key_type} = (SELECT MAX({source_col}{collate}) FROM #TempLabBatch);
+        WITH target_range AS (
+            SELECT * FROM {table} WHERE {target_col} BETWEEN @key_low{collate} AND @key_high{collate}
+        )"""
+
+def first_result_set(cursor: pyodbc.Cursor) -> pyodbc.Cursor:
+    """
+    Move `cursor` past the row counts a batch reports before its first result set, as a
+    session with NOCOUNT OFF does, and return it.
+    """
+    while cursor.description is None and cursor.nextset():
+        pass
+    return cursor
+
+def insert_merge_statement(cursor: pyodbc.Cursor, table: str, column_mappings: dict, match_conditions: dict) -> str:
+    """
+    MERGE inserting the rows of #TempLabBatch not yet in `table`, with OUTPUT $action.
+    """
+    insert_columns = ', '.join(column_mappings.values())
+    insert_values = ', '.join([f"source.{col}" for col in column_mappings.values()])
+    match_clause = ' AND '.join([f"target.{target_col} = source.{source_col}" for target_col, source_col in match_conditions.items()])
+    return f"""
+        {key_range_target(cursor, table, match_conditions)}
+        MERGE INTO target_range AS target
+        USING #TempLabBatch AS source
+        ON {match_clause}
+        WHEN NOT MATCHED THEN
+            INSERT ({insert_columns})
+            VALUES ({insert_values})
+        OUTPUT $action;
+    """
+
+def stage_and_insert(cnxn: pyodbc.Connection, cursor: pyodbc.Cursor, batch: pd.DataFrame, table: str, temp_table_columns: str, column_mappings: dict, match_conditions: dict, logger, stage_method='executemany', governor=None, checkpoint=None):
+    """
+    Stage one batch in #TempLabBatch, MERGE the unmatched rows into `table` and commit.
+
+    As in db_merge_batch(), only the MERGE and its commit hold a write slot of `governor`,
+    staging into tempdb does not contend. checkpoint(inserted rows), e.g. a record_batch(),
+    writes in the transaction of the MERGE.
+
+    Returns:
+    - (inserted rows, distinct keys in the batch)
+    """
+    create_temp_batch(cursor, temp_table_columns, match_conditions, logger)
+
+    # Insert batch data into temp table
+    stage_batch(cursor, batch, table, column_mappings, stage_method, logger)
+
+    distinct_record_count = f"""
+    SELECT COUNT(*) AS distinct_count
+    FROM (
+        SELECT DISTINCT sample_id, lab_method, analyte
+        FROM #TempLabBatch
+    ) AS subquery;
+    """ 
+    cursor.execute(distinct_record_count)
+    sample_count = cursor.fetchall()
+
+    with write_slot(governor):
+        # Perform MERGE operation with OUTPUT clause
+        cursor.execute(insert_merge_statement(cursor, table, column_mappings, match_conditions))
+
+        # Get the result of the OUTPUT clause
+        inserted_count = 0
+        for action in first_result_set(cursor).fetchall():
+            if action[0] == 'INSERT':
+                inserted_count += 1
+
+        # Drop the temporary table
+        cursor.execute("DROP TABLE #TempLabBatch")
+        if checkpoint is not None:
+            checkpoint(inserted_count)
+        cnxn.commit()
+    return inserted_count, sample_count[0][0]
+
+def bisect_insert(cnxn: pyodbc.Connection, cursor: pyodbc.Cursor, batch: pd.DataFrame, table: str, temp_table_columns: str, column_mappings: dict, match_conditions: dict, logger, rejected: list, stage_method='executemany', governor=None):
+    """
+    Insert a batch with stage_and_insert(), halving it on data errors until the offending rows are isolated.
+
+    Each part that loads is committed on its own, in a write slot of `governor`. A single row that still fails is appended
+    to `rejected` as (row params, driver error). Errors that are not caused by the data
+    (connection, permissions, ...) are re-raised so the whole load fails as before.
+
+    Returns:
+    - (inserted rows, distinct keys of the last part loaded)
+    """
+    try:
+        return stage_and_insert(cnxn, cursor, batch, table, temp_table_columns, column_mappings, match_conditions, logger, stage_method, governor)
+    except (pyodbc.DataError, pyodbc.IntegrityError) as e:
+        if classify_error(e):
+            # transient, retried by run_batch() rather than bisected
+            raise
+        cnxn.rollback()
+        if len(batch) == 1:
+            row = batch_params(batch, column_mappings.keys())[0]
+            logger.warning(f"Rejected row {row}: {e}")
+            rejected.append((row, str(e)))
+            return 0, 0
+        logger.info(f"Batch of {len(batch)} rows failed, bisecting: {e}")
+        middle = len(batch) // 2
+        first_inserted, first_count = bisect_insert(cnxn, cursor, batch.iloc[:middle], table, temp_table_columns, column_mappings, match_conditions, logger, rejected, stage_method, governor)
+        last_inserted, last_count = bisect_insert(cnxn, cursor, batch.iloc[middle:], table, temp_table_columns, column_mappings, match_conditions, logger, rejected, stage_method, governor)
+        return first_inserted + last_inserted, last_count or first_count
+
+def ensure_reject_table(cnxn: pyodbc.Connection, cursor: pyodbc.Cursor, reject_table: str):
+    """
+    Create the table receiving the rows quarantined by reject_rows() on first use.
+    """
+    cursor.execute(f"""
+        IF OBJECT_ID('{reject_table}') IS NULL
+        CREATE TABLE {reject_table} (
+            target_table varchar(128) NOT NULL,
+            source_name varchar(255) NULL,
+            row_data nvarchar(max) NOT NULL,
+            error nvarchar(max) NOT NULL,
+            srk_reject_timestamp datetime NOT NULL DEFAULT GETDATE()
+        )
+    """)
+    cnxn.commit()
+
+def reject_rows(cursor: pyodbc.Cursor, rejected: list, table: str, reject_table: str, column_mappings: dict, logger):
+    """
+    Quarantine rows isolated by bisect_insert() in `reject_table`, as JSON with the driver error.
+    The caller commits, together with the batch the rows came from.
+    """
+    columns = list(column_mappings.values())
+    params = []
+    for row, error in rejected:
+        row_data = dict(zip(columns, row))
+        params.append((table, row_data.get('source_name'), json.dumps(row_data, default=str), error))
+    cursor.executemany(
+        f"INSERT INTO {reject_table} (target_table, source_name, row_data, error) VALUES (?, ?, ?, ?)",
+        params
+    )
+    logger.info(f"Quarantined {len(rejected)} rows in {reject_table}")
+
 def db_insert(cnxn: pyodbc.Connection, df: pd.DataFrame, table: str, column_mappings: dict, logger):
     """
     Replaces records in the table based on the Import_File column.
@@ -0,0 +1,234 @@
+"""
+Statement level tracing of the SQL load.
+
+traced() wraps a pyodbc connection so that every execute, executemany, commit and rollback
+made by the functions in sql.py is recorded as an OpenTelemetry span, and in histograms of
+latency, rows and parameter bytes per statement kind (see STATEMENT_KINDS). On the first traced
+statement configure_providers() points the OpenTelemetry providers at Application Insights,
+unless a provider is already installed. Benchmarks and tests install an in-memory exporter
+instead and rank the statements of an import with statement_summary().
+
+Rows come from the driver's rowcount. The load never sets NOCOUNT ON on a session, so tracing
+costs no extra round trip; a statement whose rowcount is -1 is recorded without rows.
+
+With LAB_IMPORT_SQL_TRACING=0, or without the opentelemetry packages, traced() returns the
+connection unchanged.
+"""
+import importlib.util
+import os
+import re
+import time
+
+from lazy_imports import lazy_import
+
+# opentelemetry is imported by the first traced connection, see lazy_imports.py
+if importlib.util.find_spec('opentelemetry.trace') is not None:
+    metrics = lazy_import('opentelemetry.metrics')
+    trace = lazy_import('opentelemetry.trace')
+else:
+    metrics = trace = None
+
+TRACING_ENABLED = os.environ.get('LAB_IMPORT_SQL_TRACING', '1') != '0'
+
+# statement kinds, the first pattern that matches wins
+STATEMENT_KINDS = [
+    ('merge', r'\bMERGE\s+INTO\b'),
+    ('lock', r'\bsp_(get|release)applock\b'),
+    ('stage', r'^\s*INSERT\s+INTO\s+#'),
+    ('drop', r'^\s*(IF\s+OBJECT_ID\s*\([^)]*\)\s+IS\s+NOT\s+NULL\s+)?DROP\s+TABLE\b'),
+    ('ddl', r'^\s*(IF\s+(OBJECT_ID|COL_LENGTH)\s*\([^)]*\)\s+IS\s+NULL\s+)?(CREATE|ALTER)\b'),
+    ('count', r'^\s*SELECT\s+COUNT\b'),
+    ('select', r'^\s*SELECT\b'),
+    ('insert', r'^\s*INSERT\b'),
+    ('delete', r'^\s*DELETE\b'),
+    ('set', r'^\s*SET\b'),
+]
+_statement_kinds = [(kind, re.compile(pattern, re.IGNORECASE | re.DOTALL)) for kind, pattern in STATEMENT_KINDS]
+
+# statement text kept on a span
+STATEMENT_TEXT_LIMIT = 1000
+
+# rows of an executemany whose parameters are measured, the total is extrapolated
+PARAMETER_SAMPLE_ROWS = 100
+
+_instruments = None
+
+
+def statement_kind(statement: str) -> str:
+    for kind, pattern in _statement_kinds:
+        if pattern.search(statement):
+            return kind
+    return 'other'
+
+
+def value_bytes(value) -> int:
+    """ Approximate bytes a parameter takes on the wire, strings as UTF-16 like nvarchar """
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return 2 * len(value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return 8
+
+
+def parameter_bytes(rows: list) -> int:
+    """
+    Approximate parameter bytes of a list of parameter rows, measured on at most
+    PARAMETER_SAMPLE_ROWS rows so a large executemany is not walked twice.
+    """
+    if not rows:
+        return 0
+    sample = rows[:PARAMETER_SAMPLE_ROWS]
+    measured = sum(value_bytes(value) for row in sample for value in (row if isinstance(row, (list, tuple)) else (row,)))
+    return round(measured * len(rows) / len(sample))
+
+
+def configure_providers():
+    """
+    Export spans and metrics to Application Insights with azure-monitor-opentelemetry when
+    APPLICATIONINSIGHTS_CONNECTION_STRING is set and no tracer provider has been installed,
+    e.g. by benchmark.py or a test. The exporter is imported here, not at cold start.
+    """
+    if not os.environ.get('APPLICATIONINSIGHTS_CONNECTION_STRING'):
+        return
+    if not isinstance(trace.get_tracer_provider(), trace.ProxyTracerProvider):
+        return
+    from azure.monitor.opentelemetry import configure_azure_monitor
+    configure_azure_monitor()
+
+
+def instruments():
+    """ Tracer and histograms, created on first use """
+    global _instruments
+    if _instruments is None:
+        configure_providers()
+        meter = metrics.get_meter('lab_import.sql')
+        _instruments = {
+            'tracer': trace.get_tracer('lab_import.sql'),
+            'duration': meter.create_histogram('db.client.operation.duration', unit='s', description='Latency of SQL statements by kind'),
+            'rows': meter.create_histogram('lab_import.sql.rows', unit='{row}', description='Rows affected or returned by SQL statements'),
+            'parameter_bytes': meter.create_histogram('lab_import.sql.parameter_bytes', unit='By', description='Parameter bytes sent with SQL statements'),
+        }
+    return _instruments
+
+
+def record(kind: str, statement: str, call, parameter_rows: list = None, rows: int = None):
+    """
+    Run call() in a span for a statement of `kind` and record its latency, rows and parameter bytes.
+    rows defaults to the driver's rowcount.
+    """
+    tools = instruments()
+    attributes = {'db.system': 'mssql', 'db.operation.name': kind}
+    with tools['tracer'].start_as_current_span(f"sql {kind}", kind=trace.SpanKind.CLIENT, attributes=attributes) as span:
+        if statement:
+            span.set_attribute('db.query.text', statement.strip()[:STATEMENT_TEXT_LIMIT])
+        size = parameter_bytes(parameter_rows)
+        start = time.perf_counter()
+        try:
+            result = call()
+        except Exception as e:
+            tools['duration'].record(time.perf_counter() - start, {**attributes, 'error.type': type(e).__name__})
+            raise
+        tools['duration'].record(time.perf_counter() - start, attributes)
+        if rows is None:
+            rows = getattr(result, 'rowcount', -1)
+        if rows >= 0:
+            span.set_attribute('db.response.returned_rows', rows)
+            tools['rows'].record(rows, attributes)
+        if size:
+            span.set_attribute('lab_import.sql.parameter_bytes', size)
+            tools['parameter_bytes'].record(size, attributes)
+    return result
+
+
+class TracedCursor:
+    """
+    pyodbc cursor recording each execute and executemany, see record().
+    Everything else, including attributes such as fast_executemany, goes to the wrapped cursor.
+    """
+    def __init__(self, cursor):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, 'kind', None)
+
+    def execute(self, statement, *params):
+        object.__setattr__(self, 'kind', statement_kind(statement))
+        # parameters come as execute(sql, a, b) or execute(sql, (a, b))
+        row = params[0] if len(params) == 1 and isinstance(params[0], (list, tuple)) else params
+        record(self.kind, statement, lambda: self._cursor.execute(statement, *params), [row] if row else None)
+        return self
+
+    def executemany(self, statement, params):
+        object.__setattr__(self, 'kind', statement_kind(statement))
+        params = params if isinstance(params, list) else list(params)
+        record(self.kind, statement, lambda: self._cursor.executemany(statement, params), params, len(params))
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        if self.kind is not None:
+            instruments()['rows'].record(len(rows), {'db.system': 'mssql', 'db.operation.name': self.kind, 'lab_import.sql.fetched': True})
+        return rows
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+
+class TracedConnection:
+    """
+    pyodbc connection handing out TracedCursors and recording commits and rollbacks.
+    """
+    def __init__(self, cnxn):
+        object.__setattr__(self, '_cnxn', cnxn)
+
+    def cursor(self):
+        return TracedCursor(self._cnxn.cursor())
+
+    def commit(self):
+        record('commit', '', self._cnxn.commit)
+
+    def rollback(self):
+        record('rollback', '', self._cnxn.rollback)
+
+    def __getattr__(self, name):
+        return getattr(self._cnxn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cnxn, name, value)
+
+
+def traced(cnxn):
+    """
+    The connection wrapped in a TracedConnection, or unchanged when tracing is off or unavailable.
+    """
+    if cnxn is None or trace is None or not TRACING_ENABLED or isinstance(cnxn, TracedConnection):
+        return cnxn
+    return TracedConnection(cnxn)
+
+
+def statement_summary(spans) -> list:
+    """
+    Time, statements, rows and parameter bytes per statement kind from finished spans,
+    e.g. InMemorySpanExporter.get_finished_spans(), slowest kind first.
+    """
+    kinds = {}
+    for span in spans:
+        kind = span.attributes.get('db.operation.name')
+        if kind is None or not span.name.startswith('sql '):
+            continue
+        summary = kinds.setdefault(kind, {'kind': kind, 'statements': 0, 'seconds': 0.0, 'rows': 0, 'parameter_bytes': 0})
+        summary['statements'] += 1
+        summary['seconds'] += (span.end_time - span.start_time) / 1e9
+        summary['rows'] += span.attributes.get('db.response.returned_rows', 0)
+        summary['parameter_bytes'] += span.attributes.get('lab_import.sql.parameter_bytes', 0)
+    total = sum(summary['seconds'] for summary in kinds.values()) or 1
+    ranked = sorted(kinds.values(), key=lambda summary: summary['seconds'], reverse=True)
+    for summary in ranked:
+        summary['share'] = round(summary['seconds'] / total, 3)
+        summary['seconds'] = round(summary['seconds'], 3)
+    return ranked
@@ -0,0 +1,149 @@
+"""
+A pyodbc connection to an in-memory stand-in for the SQL Server load path of sql.py: the
+#TempLabBatch staging table, the insert-only MERGE, the batch ledger and the reject table.
+
+Writes are held per connection until commit() and dropped by rollback(), so tests can check
+what a failed or resumed import leaves behind. Staged rows whose value is BAD_VALUE fail the
+MERGE with a DataError, as a value the target column cannot hold does.
+"""
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None
+
+TABLE = 'assay_result'
+COLUMN_MAPPINGS = {'sample_id': 'sample_id', 'lab_method': 'lab_method', 'analyte': 'analyte', 'value': 'value', 'source_name': 'source_name'}
+MATCH_CONDITIONS = {'sample_id': 'sample_id', 'lab_method': 'lab_method', 'analyte': 'analyte'}
+COLLATION = 'Latin1_General_CI_AS'
+COLUMNS = [
+    ('sample_id', 'varchar', 50, 'NO', COLLATION),
+    ('lab_method', 'varchar', 50, 'NO', COLLATION),
+    ('analyte', 'varchar', 50, 'NO', COLLATION),
+    ('value', 'float', None, 'YES', None),
+    ('source_name', 'varchar', 255, 'YES', COLLATION),
+]
+BAD_VALUE = 'not a number'
+
+
+class FakeServer:
+    """ Committed state shared by the connections of a test """
+    def __init__(self):
+        self.rows = {}
+        self.ledger = []
+        self.rejects = []
+        self.connections = []
+
+    def connect(self, fail=None):
+        cnxn = FakeConnection(self, fail)
+        self.connections.append(cnxn)
+        return cnxn
+
+
+class FakeConnection:
+    """
+    fail(statement) is called before each statement and may raise, e.g. a deadlock on the
+    second MERGE. The statements run are kept in `statements`.
+    """
+    def __init__(self, server: FakeServer, fail=None):
+        self.server = server
+        self.fail = fail
+        self.statements = []
+        self.staged = []
+        self.pending = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        for kind, value in self.pending:
+            if kind == 'row':
+                self.server.rows[value[:3]] = value
+            elif kind == 'ledger':
+                self.server.ledger.append(value)
+            else:
+                self.server.rejects.append(value)
+        self.pending = []
+        self.commits += 1
+
+    def rollback(self):
+        self.pending = []
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+    def pending_keys(self):
+        return {value[:3] for kind, value in self.pending if kind == 'row'}
+
+
+class FakeCursor:
+    """
+    Statements report no row counts, so `description` is set by the statements returning a
+    result set and there is no next set.
+    """
+    rowcount = -1
+
+    def __init__(self, cnxn: FakeConnection):
+        self.cnxn = cnxn
+        self.fast_executemany = False
+        self.results = []
+        self.description = None
+
+    def execute(self, statement, *params):
+        cnxn = self.cnxn
+        cnxn.statements.append(statement)
+        if cnxn.fail:
+            cnxn.fail(statement)
+        upper = ' '.join(statement.split()).upper()
+        self.results = []
+        self.description = (('result', None, None, None, None, None, True),) if upper.startswith('SELECT') or 'OUTPUT $ACTION' in upper else None
+        if 'INFORMATION_SCHEMA.COLUMNS' in upper:
+            self.results = list(COLUMNS)
+        elif upper.startswith('SELECT ROW_START'):
+            run_key = tuple(params[0])
+            self.results = [(start, end) for key, start, end, _ in cnxn.server.ledger if key == run_key]
+        elif upper.startswith('INSERT INTO IMPORT_RUN_BATCH'):
+            values = params[0]
+            cnxn.pending.append(('ledger', (tuple(values[:2]), values[2], values[3], values[4])))
+        elif 'MERGE INTO' in upper:
+            if any(row[3] == BAD_VALUE for row in cnxn.staged):
+                raise pyodbc.DataError('22018', f"[22018] Conversion failed when converting '{BAD_VALUE}' to float (8114) (SQLExecDirectW)")
+            existing = set(cnxn.server.rows) | cnxn.pending_keys()
+            for row in cnxn.staged:
+                if row[:3] not in existing:
+                    existing.add(row[:3])
+                    cnxn.pending.append(('row', row))
+                    self.results.append(('INSERT',))
+        elif upper.startswith('SELECT COUNT(*) AS DISTINCT_COUNT'):
+            self.results = [(len({row[:3] for row in cnxn.staged}),)]
+        elif 'DROP TABLE #TEMPLABBATCH' in upper:
+            cnxn.staged = []
+        return self
+
+    def executemany(self, statement, params):
+        cnxn = self.cnxn
+        cnxn.statements.append(statement)
+        if cnxn.fail:
+            cnxn.fail(statement)
+        params = [tuple(row) for row in params]
+        if statement.startswith('INSERT INTO #TempLabBatch'):
+            cnxn.staged = params
+        elif statement.startswith('INSERT INTO assay_result_reject'):
+            cnxn.pending.extend(('reject', row) for row in params)
+
+    def fetchall(self):
+        results, self.results = self.results, []
+        return results
+
+    def nextset(self):
+        self.description = None
+        return False
+
+    def fetchone(self):
+        return self.results[0] if self.results else None
+
+    def close(self):
+        pass
@@ -0,0 +1,106 @@
+"""
+Date parsing of lab headers and logging sheets: utils.detect_date_format, parse_dates,
+format_dates and normalize_date_columns.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import utils
+
+
+class RecordingLogger:
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+
+def dates(*values):
+    return [pd.Timestamp(value) for value in values]
+
+
+class ParseDatesTest(unittest.TestCase):
+    def setUp(self):
+        utils._date_formats.clear()
+
+    def test_day_first(self):
+        parsed = utils.parse_dates(['09/01/2024', '10/01/2024', '31/01/2024'])
+        self.assertEqual(parsed.tolist(), dates('2024-01-09', '2024-01-10', '2024-01-31'))
+        self.assertEqual(utils.detect_date_format(pd.Series(['09/01/2024', '31/01/2024'])), '%d/%m/%Y')
+
+    def test_month_first(self):
+        # 12/31/2024 cannot be day first, so the whole column is read month first
+        parsed = utils.parse_dates(['09/01/2024', '12/31/2024'])
+        self.assertEqual(parsed.tolist(), dates('2024-09-01', '2024-12-31'))
+        self.assertEqual(utils.detect_date_format(pd.Series(['09/01/2024', '12/31/2024'])), '%m/%d/%Y')
+
+    def test_iso(self):
+        parsed = utils.parse_dates(['2024-09-01', '2024-09-01 10:30:00', '2024-09-01T10:30:00', '2024-09-01 10:30'])
+        self.assertEqual(parsed.tolist(), dates('2024-09-01', '2024-09-01 10:30', '2024-09-01 10:30', '2024-09-01 10:30'))
+
+    def test_mixed(self):
+        logger = RecordingLogger()
+        parsed = utils.parse_dates(['2024-09-01', '09/01/2024', '1-Sep-2024', 'Sep 3, 2024', '', None, 'pending'], 'Date_Start', logger)
+        self.assertEqual(parsed.tolist()[:4], dates('2024-09-01', '2024-01-09', '2024-09-01', '2024-09-03'))
+        self.assertTrue(parsed.iloc[4:].isna().all())
+        self.assertEqual(len(logger.warnings), 1)
+        self.assertIn('1 unparsed dates in Date_Start', logger.warnings[0])
+        self.assertIn('pending', logger.warnings[0])
+        # no single format fits a mixed column, so nothing is memoised
+        self.assertNotIn('Date_Start', utils._date_formats)
+
+    def test_datetimes_unchanged(self):
+        values = pd.Series(pd.to_datetime(['2024-09-01', '2024-01-09']))
+        self.assertIs(utils.parse_dates(values), values)
+
+    def test_memo(self):
+        utils.parse_dates(['31/01/2024', '01/02/2024'], 'Date_Completed')
+        self.assertEqual(utils._date_formats, {'Date_Completed': '%d/%m/%Y'})
+
+        # a later file of the same column is read with the memoised format, without detection
+        detect = utils.detect_date_format
+        utils.detect_date_format = lambda *args, **kwargs: self.fail('format detected again')
+        try:
+            parsed = utils.parse_dates(['05/06/2024', '2024-07-08'], 'Date_Completed')
+        finally:
+            utils.detect_date_format = detect
+        # values the memoised format does not parse fall back to the other formats
+        self.assertEqual(parsed.tolist(), dates('2024-06-05', '2024-07-08'))
+
+    def test_memo_per_key(self):
+        utils.parse_dates(['12/31/2024'], 'us')
+        utils.parse_dates(['31/12/2024'], 'au')
+        self.assertEqual(utils._date_formats, {'us': '%m/%d/%Y', 'au': '%d/%m/%Y'})
+        self.assertEqual(utils.parse_dates(['05/06/2024'], 'us').tolist(), dates('2024-05-06'))
+        self.assertEqual(utils.parse_dates(['05/06/2024'], 'au').tolist(), dates('2024-06-05'))
+
+
+class NormalizeDateColumnsTest(unittest.TestCase):
+    def setUp(self):
+        utils._date_formats.clear()
+
+    def test_format_dates(self):
+        formatted = utils.format_dates(['01/02/2024', '', 'pending'], fmt='%Y-%m-%d')
+        self.assertEqual(formatted.tolist(), ['2024-02-01', None, None])
+
+    def test_normalize_date_columns(self):
+        df = pd.DataFrame({
+            'Date_Start': ['09/01/2024', '2024-01-10', 'TBC'],
+            'Date_Completed': ['12/31/2024', '01/01/2025', None],
+            'Hole_ID': ['H1', 'H2', 'H3'],
+        })
+        df = utils.normalize_date_columns(df, ['Date_Start', 'Date_Completed', 'Surveyed_Date'])
+        self.assertEqual(df['Date_Start'].tolist(), ['2024-01-09 00:00:00', '2024-01-10 00:00:00', 'TBC'])
+        self.assertEqual(df['Date_Completed'].tolist(), ['2024-12-31 00:00:00', '2025-01-01 00:00:00', None])
+        self.assertEqual(df['Hole_ID'].tolist(), ['H1', 'H2', 'H3'])
+        self.assertNotIn('Surveyed_Date', df.columns)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Duplicate keys within a certificate: utils.resolve_duplicate_keys, eager and streamed with iter_lab_import.
+"""
+import csv
+import io
+import os
+import sys
+import unittest
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import lab_formats
+import utils
+import warmup
+
+KEYS = ['sample_id', 'lab_method', 'analyte']
+
+
+def certificate(sample_rows) -> pd.ExcelFile:
+    """ The warm-up certificate as a CSV workbook, with `sample_rows` after its two samples """
+    text = io.StringIO()
+    csv.writer(text).writerows(warmup.WARM_CERTIFICATE + sample_rows)
+    return utils.open_workbook(io.BytesIO(text.getvalue().encode()), 'cert.csv')
+
+
+class ResolveDuplicateKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'sample_id': ['S1', 'S1', 'S2', 'S1'],
+            'lab_method': ['M', 'M', 'M', 'M'],
+            'analyte': ['Au', 'Au', 'Au', 'Au'],
+            'value': [1.0, 2.0, 3.0, 4.0],
+        })
+
+    def test_first_and_last(self):
+        df, report = utils.resolve_duplicate_keys(self.df, KEYS, 'first')
+        self.assertEqual(df['value'].tolist(), [1.0, 3.0])
+        self.assertEqual((report['duplicate_keys'], report['duplicate_rows'], report['examples']), (1, 2, ['S1|M|Au']))
+        df, _ = utils.resolve_duplicate_keys(self.df, KEYS, 'last')
+        self.assertEqual(df['value'].tolist(), [3.0, 4.0])
+
+    def test_reassay(self):
+        df, report = utils.resolve_duplicate_keys(self.df, KEYS, 'reassay')
+        self.assertEqual(df[utils.REASSAY_COLUMN].tolist(), [0, 1, 0, 2])
+        self.assertEqual(df['analyte'].tolist(), ['Au'] * 4)
+        self.assertEqual(report['duplicate_rows'], 2)
+
+    def test_reassay_continues_over_chunks(self):
+        assays = Counter()
+        utils.resolve_duplicate_keys(self.df, KEYS, 'reassay', assays)
+        df, _ = utils.resolve_duplicate_keys(self.df.iloc[[0, 2]], KEYS, 'reassay', assays)
+        self.assertEqual(df[utils.REASSAY_COLUMN].tolist(), [3, 1])
+        self.assertEqual(assays, Counter({('S1', 'M', 'Au'): 4, ('S2', 'M', 'Au'): 2}))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            utils.resolve_duplicate_keys(self.df, KEYS, 'newest')
+
+
+class StreamedReassayTest(unittest.TestCase):
+    def test_reassay_in_a_later_chunk(self):
+        # W0001 is re-assayed after W0002, so with two samples per chunk it lands in the second chunk
+        workbook = certificate([['W0001', '0.15', '0.02']])
+        first_rows = utils.first_rows(workbook)
+        layout, _ = lab_formats.detect_layout(first_rows)
+        df_headers = utils.clean_lab_header(workbook, first_rows, layout)
+        duplicates = {}
+        chunks = list(utils.iter_lab_import(workbook, df_headers, 'cert.csv', layout.laboratory, '', 'reassay', duplicates, samples_per_chunk=2, layout=layout))
+
+        self.assertEqual(len(chunks), 2)
+        second = chunks[1].set_index('analyte')
+        self.assertEqual(second['sample_id'].tolist(), ['W0001', 'W0001'])
+        self.assertEqual(second[utils.REASSAY_COLUMN].tolist(), [1, 1])
+        self.assertEqual(second.loc['Au', 'value'], 0.15)
+
+        columns = KEYS + [utils.REASSAY_COLUMN, 'value']
+        streamed = pd.concat([chunk[columns] for chunk in chunks], ignore_index=True)
+        self.assertFalse(streamed.duplicated(KEYS + [utils.REASSAY_COLUMN]).any())
+
+        # the same numbers as the eager path, which resolves the whole file at once
+        eager = utils.join_lab_header(utils.clean_lab_results(workbook, layout), df_headers, 'cert.csv', layout.laboratory, '')
+        eager, _ = utils.resolve_duplicate_keys(eager, KEYS, 'reassay')
+        self.assertEqual(
+            sorted(map(tuple, streamed[columns].astype(str).values.tolist())),
+            sorted(map(tuple, eager[columns].astype(str).values.tolist())),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Reading and sizing a certificate before it is parsed: utils.sniff_workbook, CsvWorkbook and plan_import.
+"""
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+import warmup
+
+MB = 2**20
+
+
+class SniffWorkbookTest(unittest.TestCase):
+    def setUp(self):
+        self.sources = warmup.certificate_sources()
+
+    def test_first_rows_and_dimension(self):
+        sniffed = utils.sniff_workbook(io.BytesIO(self.sources['warmup.xlsx']), nrows=3)
+        self.assertEqual(sniffed['dimension'], 'A1:C12')
+        self.assertEqual(sniffed['rows'], [
+            ['WARMUP0001 - FINAL', None, None],
+            ['CLIENT REF : WARMUP', None, None],
+            ['QUANTITY : 2', None, None],
+        ])
+
+    def test_keeps_the_stream_position(self):
+        source = io.BytesIO(self.sources['warmup.xlsx'])
+        source.seek(10)
+        utils.sniff_workbook(source)
+        self.assertEqual(source.tell(), 10)
+
+    def test_not_xlsx(self):
+        self.assertIsNone(utils.sniff_workbook(io.BytesIO(self.sources['warmup.csv'])))
+
+
+class CsvWorkbookTest(unittest.TestCase):
+    def read(self, data: bytes):
+        workbook = utils.open_workbook(io.BytesIO(data), 'cert.csv')
+        return workbook, utils.read_sheet(workbook)
+
+    def test_encodings(self):
+        text = 'SAMPLE DESCRIPTION,Au\nUNITS,µg/g\n'
+        for encoding, expected in [('utf-8-sig', 'utf-8-sig'), ('utf-8', 'utf-8-sig'), ('cp1252', 'cp1252')]:
+            with self.subTest(encoding=encoding):
+                workbook, df = self.read(text.encode(encoding))
+                self.assertEqual(workbook.encoding, expected)
+                self.assertEqual(df.iloc[1, 1], 'µg/g')
+
+    def test_ragged_rows(self):
+        _, df = self.read(b'WARMUP0001 - FINAL\nMETHOD,Au-AA23,ME-ICP61\nW0001,0.12\n')
+        self.assertEqual(df.shape, (3, 3))
+        self.assertEqual(df.iloc[1].tolist(), ['METHOD', 'Au-AA23', 'ME-ICP61'])
+
+
+class PlanImportTest(unittest.TestCase):
+    def setUp(self):
+        self.workbook = utils.open_workbook(io.BytesIO(warmup.certificate_sources()['warmup.csv']), 'warmup.csv')
+        self.rows = utils.first_rows(self.workbook)
+
+    def plan(self, size, budget_mb=100):
+        return utils.plan_import(self.workbook, size, self.rows, memory_budget_mb=budget_mb)
+
+    def test_thresholds(self):
+        # the eager clean needs EAGER_BYTES_PER_CELL per cell, FILE_BYTES_PER_CELL file bytes make a cell
+        eager_limit = 100 * MB / utils.EAGER_BYTES_PER_CELL * utils.FILE_BYTES_PER_CELL
+        self.assertEqual(self.plan(int(eager_limit * 0.99))['plan'], 'eager')
+        self.assertEqual(self.plan(int(eager_limit * 1.01))['plan'], 'stream')
+        # the streaming clean holds STREAM_BYTES_PER_FILE_BYTE per file byte
+        stream_limit = 100 * MB / utils.STREAM_BYTES_PER_FILE_BYTE
+        self.assertEqual(self.plan(int(stream_limit * 0.9))['plan'], 'stream')
+        self.assertEqual(self.plan(int(stream_limit * 1.1))['plan'], 'defer')
+
+    def test_estimates(self):
+        plan = self.plan(6 * MB, budget_mb=768)
+        self.assertEqual((plan['source'], plan['cells'], plan['budget_mb']), ('size', MB, 768))
+        self.assertEqual(plan['eager_mb'], round(MB * utils.EAGER_BYTES_PER_CELL / MB, 1))
+        self.assertIn(plan['plan'], utils.IMPORT_PLANS)
+
+    def test_xlsx_dimension(self):
+        data = warmup.certificate_sources()['warmup.xlsx']
+        workbook = utils.open_workbook(io.BytesIO(data), 'warmup.xlsx')
+        plan = utils.plan_import(workbook, len(data), utils.first_rows(workbook))
+        self.assertEqual((plan['source'], plan['cells'], plan['plan']), ('dimension', 12 * 3, 'eager'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+"""
+Cold import of function_app.py, as the Functions host does it when indexing a new worker: the
+time budget of benchmark.py and the modules lazy_imports.py defers.
+"""
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmark
+import lazy_imports
+
+# cold imports timed, the best one is held to the budget
+REPEAT = 3
+
+
+def run_python(*args) -> subprocess.CompletedProcess:
+    """ Run a fresh interpreter in the repository root """
+    run = subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True)
+    if run.returncode != 0:
+        raise AssertionError(run.stderr)
+    return run
+
+
+class ColdImportTest(unittest.TestCase):
+    def test_within_budget(self):
+        timings = []
+        for _ in range(REPEAT):
+            rows = benchmark.parse_importtime(run_python('-X', 'importtime', '-c', 'import function_app').stderr)
+            timings.append(next(row['cumulative_us'] for row in rows if row['module'] == 'function_app' and row['depth'] == 0) / 1000)
+        self.assertLessEqual(min(timings), benchmark.IMPORT_BUDGET_MS, f'import function_app took {min(timings):.1f} ms')
+
+    def test_deferred_modules_not_imported(self):
+        script = ('import json, sys, function_app, lazy_imports; '
+                  'print(json.dumps([name for name in lazy_imports.DEFERRED_MODULES if name in sys.modules]))')
+        eager = json.loads(run_python('-c', script).stdout.strip().splitlines()[-1])
+        self.assertEqual(eager, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
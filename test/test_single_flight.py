@@ -0,0 +1,176 @@
+"""
+Coalescing of concurrent imports: utils.single_flight, function_app.import_key and http_lab.
+"""
+import json
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import azure.functions as func
+
+import function_app
+import utils
+
+# how long a test gives its threads to reach single_flight() before the leader finishes
+JOIN_SECONDS = 0.2
+
+
+def run_threads(calls) -> list:
+    """ Run each call in a thread of its own and return their results in order """
+    results = [None] * len(calls)
+
+    def run(i, call):
+        try:
+            results[i] = call()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i, call)) for i, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_callers_share_one_run(self):
+        calls = []
+        release = threading.Event()
+
+        def work():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+        threading.Timer(JOIN_SECONDS, release.set).start()
+        results = run_threads([lambda: utils.single_flight('key', work)] * 3)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('result', False), ('result', True), ('result', True)])
+        self.assertEqual(utils._in_flight, {})
+
+    def test_error_shared(self):
+        release = threading.Event()
+
+        def work():
+            release.wait(5)
+            raise ValueError('bad certificate')
+        threading.Timer(JOIN_SECONDS, release.set).start()
+        results = run_threads([lambda: utils.single_flight('key', work)] * 2)
+
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(utils._in_flight, {})
+
+    def test_keys_run_apart(self):
+        results = run_threads([lambda: utils.single_flight('a', lambda: 'a'), lambda: utils.single_flight('b', lambda: 'b')])
+        self.assertEqual(results, [('a', False), ('b', False)])
+
+    def test_later_call_runs_again(self):
+        self.assertEqual(utils.single_flight('key', lambda: 1), (1, False))
+        self.assertEqual(utils.single_flight('key', lambda: 2), (2, False))
+
+
+class ImportKeyTest(unittest.TestCase):
+    def test_parameters_in_key(self):
+        key = function_app.import_key('lab', 'a/b/c/d_Final/cert.xlsx', 'insert', 'first', False)
+        self.assertEqual(key, 'insert|first|eager|lab/a/b/c/d_Final/cert.xlsx')
+        variants = {
+            function_app.import_key('lab', 'a/b/c/d_Final/cert.xlsx', 'upsert', 'first', False),
+            function_app.import_key('lab', 'a/b/c/d_Final/cert.xlsx', 'insert', 'reassay', False),
+            function_app.import_key('lab', 'a/b/c/d_Final/cert.xlsx', 'insert', 'first', True),
+            function_app.import_key('lab', 'a/b/c/d_Final/cert.xlsx', 'insert', 'first', False, profiled=True),
+            function_app.import_key('other', 'a/b/c/d_Final/cert.xlsx', 'insert', 'first', False),
+        }
+        self.assertEqual(len(variants), 5)
+        self.assertNotIn(key, variants)
+
+    def test_source_last(self):
+        # import_run_result keeps the first 450 characters, the parameters must survive a long path
+        key = function_app.import_key('lab', 'x' * 500, 'reissue', 'last', True, profiled=True)
+        self.assertTrue(key[:450].startswith('profile|reissue|last|stream|lab/'))
+
+
+class HttpLabTest(unittest.TestCase):
+    """ http_lab with import_lab replaced, and without the SQL application lock """
+    def setUp(self):
+        self.imports = []
+        self.release = threading.Event()
+        self.saved = function_app.import_lab, function_app.import_lab_exclusive
+        function_app.import_lab = self.import_lab
+        function_app.import_lab_exclusive = lambda key, vault_id, run: run()
+
+    def tearDown(self):
+        function_app.import_lab, function_app.import_lab_exclusive = self.saved
+
+    def import_lab(self, path, container, vault_id, duplicate_policy='first', stream=False, mode='insert', deferred=None):
+        self.imports.append((mode, duplicate_policy, stream))
+        self.release.wait(5)
+        body = json.dumps({'inputfile': path, 'status': 'failed', 'mode': mode, 'duplicates': duplicate_policy})
+        return func.HttpResponse(body, status_code=503, mimetype='application/json', headers={'Retry-After': '30'})
+
+    def call(self, **params):
+        params = {'path': 'a/b/c/d_Final/cert.xlsx', 'container': 'lab', 'keyvault': 'kv', **params}
+        request = func.HttpRequest('POST', '/api/http_lab', params=params, body=b'')
+        http_lab = function_app.http_lab
+        # the decorated function, as the Functions host calls it
+        http_lab = http_lab._function._func if hasattr(http_lab, '_function') else http_lab
+        return http_lab(request, None)
+
+    def test_follower_keeps_status_and_headers(self):
+        threading.Timer(JOIN_SECONDS, self.release.set).start()
+        responses = run_threads([self.call, self.call])
+
+        self.assertEqual(len(self.imports), 1)
+        for response in responses:
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.mimetype, 'application/json')
+            self.assertEqual(response.headers.get('Retry-After'), '30')
+        self.assertIsNot(responses[0], responses[1])
+
+    def test_followers_with_other_parameters_run_apart(self):
+        threading.Timer(JOIN_SECONDS, self.release.set).start()
+        responses = run_threads([
+            self.call,
+            lambda: self.call(mode='upsert'),
+            lambda: self.call(duplicates='reassay'),
+            lambda: self.call(stream='true'),
+            self.call,
+        ])
+
+        self.assertEqual(sorted(self.imports), sorted([('insert', 'first', False), ('upsert', 'first', False), ('insert', 'reassay', False), ('insert', 'first', True)]))
+        bodies = [json.loads(response.get_body()) for response in responses]
+        self.assertEqual([(body['mode'], body['duplicates']) for body in bodies],
+                         [('insert', 'first'), ('upsert', 'first'), ('insert', 'reassay'), ('insert', 'first'), ('insert', 'first')])
+
+
+class TimeoutResponseTest(unittest.TestCase):
+    def test_built_like_every_response(self):
+        saved = function_app.utils.get_sql_connection, function_app.sql.open_database, function_app.sql.acquire_app_lock
+        function_app.utils.get_sql_connection = lambda vault_id, logger: ('Driver=fake', '')
+        function_app.sql.open_database = lambda conn_string, logger, autocommit=False: (FakeConnection(), '')
+        function_app.sql.acquire_app_lock = lambda cnxn, key, logger: None
+        try:
+            response = function_app.import_lab_exclusive('insert|first|eager|lab/cert.xlsx', 'kv', lambda: self.fail('imported'))
+        finally:
+            function_app.utils.get_sql_connection, function_app.sql.open_database, function_app.sql.acquire_app_lock = saved
+
+        body = json.loads(response.get_body())
+        expected = json.loads(utils.create_response('lab/cert.xlsx', 'failed', body['message'], 'low', '', '', logger=NullLogger()).get_body())
+        self.assertEqual(body, expected)
+        self.assertIn('Timed out', body['message'])
+
+
+class FakeConnection:
+    def close(self):
+        pass
+
+
+class NullLogger:
+    def info(self, message):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+"""
+Pure batch logic of sql.py: error classes and backoff, adaptive batch sizes, key order, the
+key range of the MERGE and the reissue diff.
+"""
+import logging
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+import sql
+import fake_sql
+from fake_sql import COLLATION, COLUMN_MAPPINGS, MATCH_CONDITIONS, TABLE
+
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None
+
+logger = logging.getLogger('test_sql_batches')
+
+
+@unittest.skipIf(pyodbc is None, 'pyodbc is not installed')
+class ClassifyErrorTest(unittest.TestCase):
+    def test_transient_error_numbers(self):
+        for number, kind in sql.TRANSIENT_ERRORS.items():
+            with self.subTest(number=number):
+                e = pyodbc.OperationalError('HY000', f'[HY000] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]Transient ({number}) (SQLExecDirectW)')
+                self.assertEqual(sql.classify_error(e), kind)
+                self.assertIn(kind, sql.RETRY_POLICIES)
+
+    def test_sqlstates(self):
+        self.assertEqual(sql.classify_error(pyodbc.Error('40001', 'serialization failure')), 'deadlock')
+        self.assertEqual(sql.classify_error(pyodbc.OperationalError('08S01', 'Communication link failure')), 'connection')
+        self.assertEqual(sql.classify_error(ConnectionError('login timeout')), 'connection')
+
+    def test_permanent(self):
+        self.assertIsNone(sql.classify_error(pyodbc.DataError('22018', 'Conversion failed (8114)')))
+        self.assertIsNone(sql.classify_error(pyodbc.ProgrammingError('42S02', 'Invalid object name (208)')))
+        self.assertIsNone(sql.classify_error(ValueError('not a database error')))
+
+
+class RetryDelayTest(unittest.TestCase):
+    def test_capped_full_jitter(self):
+        random.seed(1)
+        policy = {'base_seconds': 1, 'max_seconds': 30}
+        for attempt in range(8):
+            delays = [sql.retry_delay(policy, attempt) for _ in range(50)]
+            self.assertTrue(all(0 <= delay <= min(30, 2 ** attempt) for delay in delays))
+
+
+class AdaptiveBatcherTest(unittest.TestCase):
+    def test_grows_then_settles(self):
+        batcher = sql.AdaptiveBatcher(5, logger, initial_size=1000, max_size=16000)
+        batcher.record(1000, 1.0)
+        self.assertEqual(batcher.next_size(), 2000)
+        batcher.record(2000, 1.0)
+        self.assertEqual(batcher.next_size(), 4000)
+        # twice the rows in more than twice the time: settle on the best size
+        batcher.record(4000, 2.5)
+        self.assertEqual(batcher.next_size(), 2000)
+        batcher.record(2000, 1.0)
+        self.assertEqual(batcher.next_size(), 2000)
+
+    def test_shrinks_slow_batches(self):
+        batcher = sql.AdaptiveBatcher(5, logger, initial_size=4000, target_seconds=5.0)
+        batcher.record(4000, 8.0)
+        self.assertEqual(batcher.next_size(), 2000)
+        self.assertEqual(batcher.max_size, 3999)
+
+    def test_short_final_batch_ignored(self):
+        batcher = sql.AdaptiveBatcher(5, logger, initial_size=1000)
+        batcher.record(10, 30.0)
+        self.assertEqual(batcher.next_size(), 1000)
+
+    def test_caps(self):
+        self.assertEqual(sql.AdaptiveBatcher(21, logger, stage_method='values').max_size, sql.values_rows_per_statement(21))
+        self.assertEqual(sql.AdaptiveBatcher(5, logger, row_bytes=1024, memory_budget=1024 * 500).max_size, 500)
+
+
+class KeyOrderTest(unittest.TestCase):
+    def test_order_by_key(self):
+        df = pd.DataFrame({
+            'sample_id': ['b2', 'A1', 'B2', 'a1', 'C3'],
+            'lab_method': ['M'] * 5,
+            'analyte': ['Cu', 'Cu', 'Au', 'Au', 'Au'],
+            'value': [1, 2, 3, 4, 5],
+        })
+        ordered, boundaries = sql.order_by_key(df, COLUMN_MAPPINGS, MATCH_CONDITIONS)
+        # case insensitive, stable for equal keys
+        self.assertEqual(ordered['value'].tolist(), [4, 2, 3, 1, 5])
+        self.assertEqual(boundaries.tolist(), [2, 4])
+
+    def test_key_boundary(self):
+        boundaries = np.array([3, 7, 12])
+        self.assertEqual(sql.key_boundary(boundaries, 0, 10), 7)
+        self.assertEqual(sql.key_boundary(boundaries, 0, 7), 7)
+        self.assertEqual(sql.key_boundary(boundaries, 7, 10), 10)
+        self.assertEqual(sql.key_boundary(boundaries, 0, 2), 2)
+
+
+@unittest.skipIf(pyodbc is None, 'pyodbc is not installed')
+class KeyRangeTargetTest(unittest.TestCase):
+    def setUp(self):
+        self.cnxn = fake_sql.FakeServer().connect()
+        self.cursor = self.cnxn.cursor()
+
+    def test_session_options_untouched(self):
+        statement = sql.insert_merge_statement(self.cursor, TABLE, COLUMN_MAPPINGS, MATCH_CONDITIONS)
+        self.assertNotIn('NOCOUNT', statement.upper())
+
+    def test_bounds_under_the_key_collation(self):
+        statement = ' '.join(sql.key_range_target(self.cursor, TABLE, MATCH_CONDITIONS).split())
+        self.assertIn(f'DECLARE @key_low varchar(50) = (SELECT MIN(sample_id COLLATE {COLLATION}) FROM #TempLabBatch);', statement)
+        self.assertIn(f'DECLARE @key_high varchar(50) = (SELECT MAX(sample_id COLLATE {COLLATION}) FROM #TempLabBatch);', statement)
+        self.assertIn(f'WHERE sample_id BETWEEN @key_low COLLATE {COLLATION} AND @key_high COLLATE {COLLATION}', statement)
+
+    def test_staging_columns_keep_the_collation(self):
+        definition = sql.temp_table_definition(self.cursor, TABLE)
+        self.assertIn(f'sample_id varchar(50) COLLATE {COLLATION} NOT NULL', definition)
+        self.assertIn('value float NULL', definition)
+
+    def test_output_read_past_row_counts(self):
+        # a session with NOCOUNT OFF reports a row count before the OUTPUT of the MERGE
+        counts = [None, None, (('action', str, None, None, None, None, True),)]
+
+        def nextset():
+            counts.pop(0)
+            self.cursor.description = counts[0]
+            return True
+        self.cursor.nextset = nextset
+        self.cursor.results = [('INSERT',)]
+        self.assertEqual(sql.first_result_set(self.cursor).fetchall(), [('INSERT',)])
+        self.assertEqual(len(counts), 1)
+
+
+class DiffSnapshotTest(unittest.TestCase):
+    def test_statuses(self):
+        keys = ['sample_id', 'analyte']
+        previous = pd.DataFrame({'sample_id': ['S1', 'S2', 'S3'], 'analyte': ['Au'] * 3, 'row_hash': [1, 2, 3]})
+        current = pd.DataFrame({'sample_id': ['S4', 'S2', 'S1'], 'analyte': ['Au'] * 3, 'row_hash': [4, 20, 1]}, index=[10, 11, 12])
+        status, removed = sql.diff_snapshot(current, previous, keys)
+        self.assertEqual(status.to_dict(), {10: 'inserted', 11: 'changed', 12: 'unchanged'})
+        self.assertEqual(removed.to_dict('records'), [{'sample_id': 'S3', 'analyte': 'Au'}])
+
+    def test_keys_compared_as_text(self):
+        keys = ['sample_id']
+        previous = pd.DataFrame({'sample_id': ['101'], 'row_hash': [7]})
+        current = pd.DataFrame({'sample_id': [101], 'row_hash': [7]})
+        status, removed = sql.diff_snapshot(current, previous, keys)
+        self.assertEqual(status.tolist(), ['unchanged'])
+        self.assertTrue(removed.empty)
+
+
+if __name__ == '__main__':
+    unittest.main()
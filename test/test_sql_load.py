@@ -0,0 +1,241 @@
+"""
+The batch load of sql.py against the in-memory server of fake_sql: insert_frames, bisect_insert
+and run_batch.
+"""
+import json
+import logging
+import os
+import sys
+import unittest
+from collections import Counter
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import fake_sql
+from fake_sql import BAD_VALUE, COLUMN_MAPPINGS, MATCH_CONDITIONS, TABLE
+
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None
+
+import sql
+
+logger = logging.getLogger('test_sql_load')
+
+
+def results(values, source_name='cert.xlsx') -> pd.DataFrame:
+    """ One row per value, sample S<n> with analyte Au """
+    return pd.DataFrame({
+        'sample_id': [f'S{n}' for n in range(len(values))],
+        'lab_method': 'Au-AA23',
+        'analyte': 'Au',
+        'value': values,
+        'source_name': source_name,
+    })
+
+
+def fail_on(statement_start: str, error, times: int = 1, skip: int = 0):
+    """ fail() hook raising `error` on the statements containing statement_start, after `skip` of them """
+    seen = []
+
+    def fail(statement):
+        if statement_start in statement:
+            seen.append(statement)
+            if skip < len(seen) <= skip + times:
+                raise error
+    return fail
+
+
+@unittest.skipIf(pyodbc is None, 'pyodbc is not installed')
+class InsertFramesTest(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_sql.FakeServer()
+
+    def insert(self, df, cnxn=None, **kwargs):
+        kwargs = {'batch_size': 2, 'key_order': False, **kwargs}
+        return sql.db_insert_batch(cnxn or self.server.connect(), df, TABLE, COLUMN_MAPPINGS, MATCH_CONDITIONS, logger, **kwargs)
+
+    def test_insert(self):
+        result = self.insert(results([1.0, 2.0, 3.0]))
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['inserted_count'], 3)
+        self.assertEqual(len(self.server.rows), 3)
+
+    def test_bisect_isolates_rejects(self):
+        df = results([1.0, BAD_VALUE, 3.0, 4.0, BAD_VALUE, 6.0, 7.0])
+        result = self.insert(df, batch_size=10, isolate_errors=True)
+
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual((result['inserted_count'], result['rejected_count']), (5, 2))
+        self.assertEqual(sorted(key[0] for key in self.server.rows), ['S0', 'S2', 'S3', 'S5', 'S6'])
+        rejected = sorted(json.loads(row_data)['sample_id'] for _, _, row_data, _ in self.server.rejects)
+        self.assertEqual(rejected, ['S1', 'S4'])
+
+    def test_bisect_commits_each_part(self):
+        server = self.server
+        cnxn = server.connect()
+        cursor = cnxn.cursor()
+        rejected = []
+        temp_table_columns = sql.temp_table_definition(cursor, TABLE)
+        inserted, _ = sql.bisect_insert(cnxn, cursor, results([1.0, 2.0, 3.0, BAD_VALUE]), TABLE, temp_table_columns, COLUMN_MAPPINGS, MATCH_CONDITIONS, logger, rejected)
+
+        self.assertEqual(inserted, 3)
+        self.assertEqual(len(server.rows), 3)
+        self.assertEqual(cnxn.pending, [])
+        self.assertEqual([row[0] for row, _ in rejected], ['S3'])
+        self.assertIn('8114', rejected[0][1])
+        self.assertEqual(server.rejects, [])
+
+    def test_without_isolation_a_bad_batch_fails(self):
+        result = self.insert(results([1.0, BAD_VALUE, 3.0]))
+        self.assertTrue(result['status'].startswith('failure'))
+        self.assertEqual((result['inserted_count'], len(self.server.rows)), (0, 0))
+
+    def test_transient_errors_not_bisected(self):
+        deadlock = pyodbc.Error('40001', 'Transaction was deadlocked (1205)')
+        cnxn = self.server.connect(fail_on('MERGE INTO', deadlock))
+        sleep, sql.time.sleep = sql.time.sleep, lambda seconds: None
+        try:
+            result = self.insert(results([1.0, 2.0]), cnxn, isolate_errors=True)
+        finally:
+            sql.time.sleep = sleep
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual((result['retries'], result['rejected_count']), ({'deadlock': 1}, 0))
+        self.assertEqual(len(self.server.rows), 2)
+
+    def test_write_slot_held_for_merge_and_commit(self):
+        events = []
+
+        class Governor(sql.WriteGovernor):
+            @contextmanager
+            def slot(self):
+                events.append('slot')
+                with super().slot() as slot:
+                    yield slot
+                events.append('free')
+
+        cnxn = self.server.connect(lambda statement: events.append(' '.join(statement.split())))
+        commit = cnxn.commit
+        cnxn.commit = lambda: events.append('commit') or commit()
+        governor = Governor(TABLE, logger)
+        result = self.insert(results([1.0, 2.0, 3.0, 4.0]), cnxn, run_key=('cert.xlsx', 'abc'), governor=governor)
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(governor.stats()['slots_taken'], 2)
+
+        # staging runs outside a slot, every MERGE and, from the first batch on, every commit inside one
+        held = loading = False
+        batch_commits = 0
+        for event in events:
+            if event in ('slot', 'free'):
+                held = event == 'slot'
+            elif 'INTO #TempLabBatch' in event or 'CREATE TABLE #TempLabBatch' in event:
+                loading = True
+                self.assertFalse(held, f'{event[:40]} inside a write slot')
+            elif 'MERGE INTO' in event or (event == 'commit' and loading):
+                self.assertTrue(held, f'{event[:40]} outside a write slot')
+                batch_commits += event == 'commit'
+        self.assertEqual(batch_commits, 2)
+
+    def test_rejects_committed_with_their_batch(self):
+        df = results([1.0, BAD_VALUE, 3.0, 4.0, 5.0, 6.0])
+        run_key = ('cert.xlsx', 'abc')
+        # the import dies on the third batch, after the first two were checkpointed: the first
+        # batch takes three MERGEs, of both rows and of each half once bisected
+        failing = self.server.connect(fail_on('MERGE INTO', pyodbc.ProgrammingError('42000', 'Permission denied (229)'), skip=4))
+        result = self.insert(df, failing, isolate_errors=True, run_key=run_key)
+
+        self.assertTrue(result['status'].startswith('failure'))
+        self.assertEqual(sorted(start for _, start, _, _ in self.server.ledger), [0, 2])
+        self.assertEqual(len(self.server.rejects), 1)
+        target_table, source_name, row_data, error = self.server.rejects[0]
+        self.assertEqual((target_table, source_name), (TABLE, 'cert.xlsx'))
+        self.assertIn(BAD_VALUE, row_data)
+        self.assertIn('8114', error)
+
+        # the resumed run skips the checkpointed batches and keeps their rejects
+        result = self.insert(df, isolate_errors=True, run_key=run_key)
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['skipped_rows'], 4)
+        self.assertEqual(result['inserted_count'], 2)
+        self.assertEqual(len(self.server.rejects), 1)
+        self.assertEqual(sorted(key[0] for key in self.server.rows), ['S0', 'S2', 'S3', 'S4', 'S5'])
+
+    def test_rejects_rolled_back_with_their_batch(self):
+        # a ledger insert failing on a dropped connection rolls back the batch's rejects too,
+        # the retry on a new connection writes them once
+        failing = self.server.connect(fail_on('INSERT INTO import_run_batch', pyodbc.OperationalError('08S01', 'Communication link failure')))
+        connector = sql.Connector('', logger)
+        connector.connect = self.server.connect
+        result = self.insert(results([BAD_VALUE, 2.0]), failing, isolate_errors=True, run_key=('cert.xlsx', 'abc'), connector=connector)
+
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['rejected_count'], 1)
+        self.assertEqual(len(self.server.rejects), 1)
+        self.assertEqual(len(self.server.ledger), 1)
+
+
+@unittest.skipIf(pyodbc is None, 'pyodbc is not installed')
+class RunBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_sql.FakeServer()
+        self.sleep, sql.time.sleep = sql.time.sleep, lambda seconds: None
+
+    def tearDown(self):
+        sql.time.sleep = self.sleep
+
+    def broken(self, error):
+        """ A connection failing its first statement with `error`, after which it cannot roll back """
+        cnxn = self.server.connect(fail_on('SELECT 1', error))
+
+        def rollback():
+            raise pyodbc.OperationalError('08S01', 'Communication link failure')
+        cnxn.rollback = rollback
+        return cnxn
+
+    @staticmethod
+    def work(cnxn, cursor):
+        cursor.execute('SELECT 1')
+        return 'done'
+
+    def connector(self):
+        connector = sql.Connector('', logger)
+        connector.connect = self.server.connect
+        return connector
+
+    def test_reconnects_when_rollback_fails(self):
+        # deadlock and throttled do not reconnect, unless the connection dropped meanwhile
+        for error in [pyodbc.Error('40001', 'Transaction was deadlocked (1205)'), pyodbc.OperationalError('42000', 'busy (40501)')]:
+            with self.subTest(error=error):
+                broken = self.broken(error)
+                result, cnxn = sql.run_batch(self.work, broken, logger, 'batch', self.connector())
+                self.assertEqual(result, 'done')
+                self.assertIsNot(cnxn, broken)
+                self.assertTrue(broken.closed)
+
+    def test_raises_without_connector(self):
+        broken = self.broken(pyodbc.Error('40001', 'Transaction was deadlocked (1205)'))
+        with self.assertRaises(pyodbc.Error):
+            sql.run_batch(self.work, broken, logger, 'batch')
+        self.assertTrue(broken.closed)
+
+    def test_same_connection_after_rollback(self):
+        cnxn = self.server.connect(fail_on('SELECT 1', pyodbc.Error('40001', 'Transaction was deadlocked (1205)')))
+        retries = Counter()
+        result, used = sql.run_batch(self.work, cnxn, logger, 'batch', self.connector(), retries=retries)
+        self.assertEqual((result, used, cnxn.rollbacks, retries), ('done', cnxn, 1, Counter({'deadlock': 1})))
+        self.assertFalse(cnxn.closed)
+
+    def test_connection_error_replaces_connection(self):
+        cnxn = self.server.connect(fail_on('SELECT 1', pyodbc.OperationalError('08S01', 'Communication link failure')))
+        result, used = sql.run_batch(self.work, cnxn, logger, 'batch', self.connector())
+        self.assertEqual(result, 'done')
+        self.assertIsNot(used, cnxn)
+        self.assertTrue(cnxn.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
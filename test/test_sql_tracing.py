@@ -0,0 +1,168 @@
+"""
+Spans and metrics recorded by sql_tracing for a fake pyodbc connection, exported in memory.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sql_tracing
+
+try:
+    from opentelemetry import metrics, trace
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+except ImportError:
+    trace = None
+
+exporter = reader = None
+
+
+def setUpModule():
+    global exporter, reader
+    if trace is None:
+        return
+    # providers can be set once per process
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    reader = InMemoryMetricReader()
+    metrics.set_meter_provider(MeterProvider(metric_readers=[reader]))
+
+
+class FakeCursor:
+    """ pyodbc cursor whose writes report `affected` rows, and whose other statements -1 """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self.fast_executemany = False
+        self._rows = []
+
+    def execute(self, statement, *params):
+        self.connection.statements.append(statement)
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        self.rowcount = self.connection.affected if verb in ('INSERT', 'UPDATE', 'DELETE') else -1
+        self._rows = [(1,), (2,), (3,)] if verb == 'SELECT' else []
+        return self
+
+    def executemany(self, statement, params):
+        self.connection.statements.append(statement)
+        self.connection.fast_executemany.append(self.fast_executemany)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, affected=0):
+        self.affected = affected
+        self.statements = []
+        self.fast_executemany = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+@unittest.skipIf(trace is None, 'opentelemetry-sdk is not installed')
+class TracedConnectionTest(unittest.TestCase):
+    def setUp(self):
+        exporter.clear()
+        self.fake = FakeConnection(affected=42)
+        self.cnxn = sql_tracing.traced(self.fake)
+
+    def spans(self):
+        return exporter.get_finished_spans()
+
+    def test_span_per_statement(self):
+        cursor = self.cnxn.cursor()
+        cursor.execute("SET NOCOUNT ON;")
+        cursor.execute("MERGE INTO dbo.Lab AS target USING #TempLabBatch AS source ON 1 = 0 OUTPUT $action;")
+        cursor.fetchall()
+        self.cnxn.commit()
+
+        self.assertEqual([span.name for span in self.spans()], ['sql set', 'sql merge', 'sql commit'])
+        for span in self.spans():
+            self.assertEqual(span.kind, trace.SpanKind.CLIENT)
+            self.assertEqual(span.attributes['db.system'], 'mssql')
+        self.assertTrue(self.spans()[1].attributes['db.query.text'].startswith('MERGE INTO dbo.Lab'))
+        self.assertEqual(self.fake.commits, 1)
+
+    def test_rows_from_rowcount(self):
+        cursor = self.cnxn.cursor()
+        cursor.execute("INSERT INTO #TempLabBatch (sample_id, value) VALUES (?, ?)", 'S1', 1.5)
+
+        span, = self.spans()
+        self.assertEqual(span.name, 'sql stage')
+        self.assertEqual(span.attributes['db.response.returned_rows'], 42)
+        self.assertEqual(span.attributes['lab_import.sql.parameter_bytes'], 2 * len('S1') + 8)
+        # no extra round trip for the rows
+        self.assertEqual(len(self.fake.statements), 1)
+
+    def test_no_rows_without_rowcount(self):
+        self.cnxn.cursor().execute("SELECT sample_id FROM dbo.Lab")
+
+        self.assertEqual(len(self.fake.statements), 1)
+        self.assertNotIn('db.response.returned_rows', self.spans()[0].attributes)
+
+    def test_executemany(self):
+        cursor = self.cnxn.cursor()
+        cursor.fast_executemany = True
+        rows = [('S1', 1.0), ('S2', 2.0), ('S3', None)]
+        cursor.executemany("INSERT INTO #TempLabBatch (sample_id, value) VALUES (?, ?)", rows)
+
+        span, = self.spans()
+        self.assertEqual(span.attributes['db.response.returned_rows'], 3)
+        self.assertEqual(span.attributes['lab_import.sql.parameter_bytes'], 3 * 4 + 2 * 8)
+        self.assertEqual(self.fake.fast_executemany, [True])
+
+    def test_failed_statement(self):
+        cursor = self.cnxn.cursor()
+        cursor._cursor.execute = lambda statement, *params: 1 / 0
+        with self.assertRaises(ZeroDivisionError):
+            cursor.execute("DELETE FROM dbo.Lab WHERE sample_id = ?", 'S1')
+
+        span, = self.spans()
+        self.assertEqual(span.name, 'sql delete')
+        self.assertFalse(span.status.is_ok)
+
+    def test_duration_histogram(self):
+        self.cnxn.cursor().execute("DELETE FROM dbo.Lab WHERE sample_id = ?", 'S1')
+
+        names = [metric.name for resource in reader.get_metrics_data().resource_metrics
+                 for scope in resource.scope_metrics for metric in scope.metrics]
+        self.assertIn('db.client.operation.duration', names)
+
+    def test_statement_summary(self):
+        cursor = self.cnxn.cursor()
+        cursor.executemany("INSERT INTO #TempLabBatch (sample_id) VALUES (?)", [('S1',), ('S2',)])
+        cursor.execute("INSERT INTO #TempLabBatch (sample_id) VALUES (?)", 'S3')
+        self.cnxn.commit()
+
+        summary = {row['kind']: row for row in sql_tracing.statement_summary(self.spans())}
+        self.assertEqual(set(summary), {'stage', 'commit'})
+        self.assertEqual(summary['stage']['statements'], 2)
+        self.assertEqual(summary['stage']['rows'], 2 + 42)
+        self.assertAlmostEqual(sum(row['share'] for row in summary.values()), 1, places=2)
+
+    def test_wrapped_once(self):
+        self.assertIs(sql_tracing.traced(None), None)
+        self.assertIs(sql_tracing.traced(self.cnxn), self.cnxn)
+
+
+if __name__ == '__main__':
+    unittest.main()
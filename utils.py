@@ -1,49 +1,565 @@
 """"
 Helper functions
 """
+from __future__ import annotations
+
 import azure.functions as func
-from azure.storage.blob import BlobServiceClient
-from azure.identity import DefaultAzureCredential
-from azure.core.exceptions import ClientAuthenticationError
-from azure.keyvault.secrets import SecretClient
 
-import pandas as pd
 import io
 import json
-from datetime import datetime 
 from collections import Counter
 import os
-import numpy as np
+import itertools
+import threading
+import time
+import zipfile
+import csv
+from xml.etree import ElementTree
+
+import lab_formats
+from lazy_imports import lazy_import
+
+# imported by the first request rather than when the host indexes the functions, see lazy_imports.py
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+arrow_csv = lazy_import('pyarrow.csv')
+azure_exceptions = lazy_import('azure.core.exceptions')
+
+# repeating string columns of the long-format assay frame kept dictionary encoded
+CATEGORICAL_COLUMNS = ('sample_id', 'lab_method', 'analyte', 'unit', 'qualifier', 'job_title')
+
+# how resolve_duplicate_keys() treats repeated (sample_id, lab_method, analyte) keys within one file
+DUPLICATE_POLICIES = ('first', 'last', 'reassay')
+# column numbering the assays of a key under the 'reassay' policy, 0 for the original, see assay_keys()
+REASSAY_COLUMN = 'reassay'
+
+# how http_lab writes results: insert-only MERGE, or upsert of changed rows
+IMPORT_MODES = ('insert', 'upsert', 'reissue')
+
+# strings pd.read_excel reads as NaN by default, see excel_cell_value()
+EXCEL_NA_VALUES = {
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+}
+
+# date formats tried by parse_dates(), most specific first, day first before month first
+DATE_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d',
+    '%d-%b-%Y',
+    '%d %b %Y',
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y',
+    '%m/%d/%Y',
+    '%d-%m-%Y',
+    '%Y/%m/%d',
+    '%Y-%m',
+    '%Y',
+]
+# detected date format per column, memoised by parse_dates()
+_date_formats = {}
+
+# namespaces of the xlsx parts read by sniff_workbook()
+XLSX_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_RELATIONSHIPS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_PACKAGE_RELATIONSHIPS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# delimited text certificates, read by CsvWorkbook instead of pd.ExcelFile
+CSV_EXTENSIONS = ('.csv', '.txt')
+# encodings tried in order for delimited text, Windows Excel exports are commonly cp1252
+CSV_ENCODINGS = ('utf-8-sig', 'cp1252', 'latin-1')
+# every certificate format open_workbook() reads
+WORKBOOK_EXTENSIONS = ('.xlsx', '.xlsm', '.xls', '.xlsb') + CSV_EXTENSIONS
+
+# memory the import may use, half of the Consumption plan's 1.5 GB by default, see plan_import()
+MEMORY_BUDGET_MB = int(os.environ.get('LAB_IMPORT_MEMORY_MB', 768))
+# peak bytes per sheet cell of the eager clean (read, transpose, melt, join), measured on xlsx
+EAGER_BYTES_PER_CELL = 700
+# file bytes per sheet cell, xlsx and CSV certificates both measure about 6.5
+FILE_BYTES_PER_CELL = 6
+# the streaming clean holds the downloaded file and its parser state, plus one chunk
+STREAM_BYTES_PER_FILE_BYTE = 4
+IMPORT_PLANS = ('eager', 'stream', 'defer')
+
+# calls in progress in this process, see single_flight()
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+# Azure SDK clients shared by every request of this worker, see credential() and secret_client()
+_credential = None
+_secret_clients = {}
+_sdk_lock = threading.Lock()
+
+# Key Vault secrets kept by get_secret(), {(vault_id, name): (value, fetched at)}
+SECRET_TTL_SECONDS = 600
+_secrets = {}
+
+# bump when a change to the cleaning functions changes their output, older cleaned sidecars are then ignored
+PARSER_VERSION = '1'
+
+
+def credential():
+    """
+    DefaultAzureCredential of this worker, created on first use so the SDK is not imported
+    while the host indexes the functions, and shared so its token cache outlives a request.
+    """
+    global _credential
+    with _sdk_lock:
+        if _credential is None:
+            from azure.identity import DefaultAzureCredential
+            _credential = DefaultAzureCredential()
+        return _credential
+
+def secret_client(vault_id):
+    """
+    Key Vault SecretClient of a vault, created on first use and reused.
+    """
+    client = _secret_clients.get(vault_id)
+    if client is None:
+        from azure.keyvault.secrets import SecretClient
+        client = _secret_clients.setdefault(vault_id, SecretClient(vault_url=f"https://{vault_id}.vault.azure.net/", credential=credential()))
+    return client
+
+def get_secret(vault_id, name: str, refresh: bool = False) -> str:
+    """
+    Value of a Key Vault secret, fetched at most once every SECRET_TTL_SECONDS per worker.
+
+    Args:
+        vault_id (str): Key Vault name
+        name (str): secret name, e.g. 'sql-connection'
+        refresh (bool): fetch even when a cached value is still fresh, as the keep-warm timer does
+
+    Returns:
+        str: the secret value; Key Vault errors are raised as by SecretClient.get_secret
+    """
+    cached = _secrets.get((vault_id, name))
+    if cached is not None and not refresh and time.monotonic() - cached[1] < SECRET_TTL_SECONDS:
+        return cached[0]
+    value = secret_client(vault_id).get_secret(name).value
+    _secrets[(vault_id, name)] = (value, time.monotonic())
+    return value
 
+def blob_service_client(conn_string: str):
+    """
+    BlobServiceClient of a storage connection string, the SDK imported on first use.
+    """
+    from azure.storage.blob import BlobServiceClient
+    return BlobServiceClient.from_connection_string(conn_string)
 
 def fetch_file_contents(vault_id, container, filename, logger):
-    identity = DefaultAzureCredential()
-    secretClient = SecretClient(vault_url=f"https://{vault_id}.vault.azure.net/", credential=identity)
     try:
-        blob_secret = secretClient.get_secret('blob-connection')
-        blob_conn = blob_secret.value
-        blob_service_client = BlobServiceClient.from_connection_string(blob_conn)
-        if blob_service_client.get_blob_client(container, filename).exists():
-            blob_client = blob_service_client.get_blob_client(container, filename)
+        blob_conn = get_secret(vault_id, 'blob-connection')
+        service_client = blob_service_client(blob_conn)
+        if service_client.get_blob_client(container, filename).exists():
+            blob_client = service_client.get_blob_client(container, filename)
             blob_download = blob_client.download_blob()
             stream = io.BytesIO()
             blob_download.download_to_stream(stream)
-            df_workbook = pd.ExcelFile(stream)
+            df_workbook = open_workbook(stream, filename)
             logger.info("Workbook loaded.")
             return df_workbook, ""
         else:
             return None, "File not found in storage"
-    except ClientAuthenticationError as e:
+    except azure_exceptions.ClientAuthenticationError as e:
         logger.error(e)
         return None, "Blob client authentication 'blob-connection' failed."
 
+def open_workbook(stream: io.BytesIO, filename: str):
+    """
+    Open a certificate for the cleaning functions by its extension: delimited text as a
+    CsvWorkbook, .xlsb with pyxlsb, anything else as a pd.ExcelFile.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in CSV_EXTENSIONS:
+        return CsvWorkbook(stream.getvalue())
+    if extension == '.xlsb':
+        return pd.ExcelFile(stream, engine='pyxlsb')
+    return pd.ExcelFile(stream)
+
+class CsvWorkbook:
+    """
+    A delimited text certificate, standing in for pd.ExcelFile in the cleaning functions.
+
+    The whole sheet is parsed by the multithreaded Arrow CSV reader, the first rows by the
+    csv module, see read_sheet(). Text that is not UTF-8 is read as the first of
+    CSV_ENCODINGS that decodes it, e.g. cp1252 from Excel on Windows.
+    """
+    def __init__(self, data: bytes, delimiter: str = None):
+        self.data = data
+        self.io = io.BytesIO(data)
+        self.encoding = text_encoding(data)
+        if delimiter is None:
+            try:
+                delimiter = csv.Sniffer().sniff(data[:65536].decode(self.encoding, errors='replace'), delimiters=',;\t|').delimiter
+            except csv.Error:
+                delimiter = ','
+        self.delimiter = delimiter
+
+def text_encoding(data: bytes) -> str:
+    """
+    First of CSV_ENCODINGS that decodes `data`. latin-1 decodes any bytes, so there always is one.
+    """
+    for encoding in CSV_ENCODINGS:
+        try:
+            data.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return CSV_ENCODINGS[-1]
+
+def read_sheet(df, nrows: int = None) -> pd.DataFrame:
+    """
+    First sheet of a workbook without a header row, like pd.read_excel(df, header=None, sheet_name=0).
+    """
+    if not isinstance(df, CsvWorkbook):
+        return pd.read_excel(df, header=None, sheet_name=0, nrows=nrows)
+    if nrows is not None:
+        lines = itertools.islice(io.TextIOWrapper(io.BytesIO(df.data), encoding=df.encoding, newline=''), nrows)
+        rows = [[np.nan if value in EXCEL_NA_VALUES else value for value in row] for row in csv.reader(lines, delimiter=df.delimiter)]
+        return pd.DataFrame(rows)
+    try:
+        table = arrow_csv.read_csv(
+            io.BytesIO(df.data),
+            read_options=arrow_csv.ReadOptions(autogenerate_column_names=True, use_threads=True, encoding='utf8' if df.encoding == 'utf-8-sig' else df.encoding),
+            parse_options=arrow_csv.ParseOptions(delimiter=df.delimiter, newlines_in_values=True),
+            convert_options=arrow_csv.ConvertOptions(null_values=list(EXCEL_NA_VALUES), strings_can_be_null=True)
+        )
+    except Exception:
+        # Arrow needs the same number of fields on every line, exports that trim trailing blanks do not have it
+        rows = [[np.nan if value in EXCEL_NA_VALUES else value for value in row] for row in csv.reader(io.StringIO(df.data.decode(df.encoding)), delimiter=df.delimiter)]
+        return pd.DataFrame(rows)
+    df_sheet = table.to_pandas()
+    df_sheet.columns = range(df_sheet.shape[1])
+    return df_sheet.astype(object).where(df_sheet.notna(), np.nan)
+
+def fetch_file_properties(vault_id, container, filename, logger):
+    """
+    Read the blob properties without downloading the file.
+
+    Returns:
+        tuple: (dictionary with etag, content_hash and size or None, log message)
+    """
+    try:
+        blob_conn = get_secret(vault_id, 'blob-connection')
+        service_client = blob_service_client(blob_conn)
+        blob_client = service_client.get_blob_client(container, filename)
+        if blob_client.exists():
+            properties = blob_client.get_blob_properties()
+            content_md5 = properties.content_settings.content_md5
+            return {
+                'etag': properties.etag.strip('"'),
+                # MD5 is only set by some uploaders, the etag changes with every write
+                'content_hash': bytes(content_md5).hex() if content_md5 else properties.etag.strip('"'),
+                'size': properties.size
+            }, ""
+        else:
+            return None, "File not found in storage"
+    except azure_exceptions.ClientAuthenticationError as e:
+        logger.error(e)
+        return None, "Blob client authentication 'blob-connection' failed."
+
+def get_container_client(vault_id, container, logger):
+    """
+    Container client for writing next to the source files.
+
+    Returns:
+        tuple: (ContainerClient or None, log message)
+    """
+    try:
+        service_client = blob_service_client(get_secret(vault_id, 'blob-connection'))
+        return service_client.get_container_client(container), ""
+    except azure_exceptions.ClientAuthenticationError as e:
+        logger.error(e)
+        return None, "Blob client authentication 'blob-connection' failed."
+
+def sidecar_name(filename: str) -> str:
+    """
+    Name of the cleaned results sidecar written next to a source file.
+    """
+    return f"{os.path.splitext(filename)[0]}.cleaned.parquet"
+
+def save_cleaned_frames(location, filename: str, etag: str, df_headers: pd.DataFrame, df: pd.DataFrame, logger):
+    """
+    Write the cleaned long-format results as a Parquet sidecar next to the source file.
+
+    The header frame, source etag and PARSER_VERSION travel in the Parquet metadata, so the
+    sidecar is self-describing and can be read by analysts with any Parquet reader.
+
+    Args:
+        location: ContainerClient of the source container, or a local directory
+        filename (str): source file name, relative to location
+        etag (str): version of the source file the frames were cleaned from
+    """
+    name = sidecar_name(filename)
+    # the sidecar is only a cache, a frame Arrow cannot store (e.g. numeric and text sample ids
+    # in one column) is logged and the import carries on without it
+    try:
+        df_out = df.copy(deep=False)
+        df_out.attrs = {
+            'source_etag': etag,
+            'parser_version': PARSER_VERSION,
+            'header': df_headers.to_json(orient='records', date_format='iso'),
+            # Parquet stores these typed, they are turned back into objects with None on load
+            'object_columns': [col for col in df.columns if df[col].dtype == object],
+        }
+        buffer = io.BytesIO()
+        df_out.to_parquet(buffer, index=False)
+        if isinstance(location, str):
+            path = os.path.join(location, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename, so an interrupted run never leaves a partial file behind
+            with open(path + '.tmp', 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(path + '.tmp', path)
+        else:
+            location.upload_blob(name, buffer.getvalue(), overwrite=True, metadata={'source_etag': etag, 'parser_version': PARSER_VERSION})
+        logger.info(f"Cleaned results written to {name}")
+    except Exception as e:
+        logger.warning(f"Could not write cleaned results to {name}: {e}")
+
+def load_cleaned_frames(location, filename: str, etag: str, logger):
+    """
+    Load the frames written by save_cleaned_frames() if they were cleaned from this version of
+    the source file by this parser version.
+
+    Returns:
+        tuple: (df_headers, df) or None when no valid sidecar exists
+    """
+    name = sidecar_name(filename)
+    try:
+        if isinstance(location, str):
+            path = os.path.join(location, name)
+            if not os.path.exists(path):
+                return None
+            data = path
+        else:
+            blob_client = location.get_blob_client(name)
+            if not blob_client.exists():
+                return None
+            # the blob metadata is checked first, a stale sidecar is never downloaded
+            metadata = blob_client.get_blob_properties().metadata
+            if metadata.get('source_etag') != etag or metadata.get('parser_version') != PARSER_VERSION:
+                return None
+            data = io.BytesIO(blob_client.download_blob().readall())
+        df = pd.read_parquet(data)
+        if df.attrs.get('source_etag') != etag or df.attrs.get('parser_version') != PARSER_VERSION:
+            return None
+        df_headers = pd.read_json(io.StringIO(df.attrs['header']), orient='records', dtype=False, convert_dates=False)
+        for col in df.attrs.get('object_columns', []):
+            if df[col].dtype != object:
+                df[col] = df[col].astype(object).where(df[col].notna(), None)
+        df.attrs = {}
+        return df_headers, df
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable cleaned results {name}: {e}")
+        return None
+
+def sniff_workbook(source, nrows: int = 9):
+    """
+    Read the first rows of the first sheet of an xlsx file straight from its zip.
+
+    The sheet XML is parsed incrementally and abandoned after row `nrows`, and only the
+    shared strings those rows refer to are read, so this costs milliseconds however large
+    the sheet is.
+
+    Args:
+        source: path or file-like object of the workbook, e.g. ExcelFile.io
+        nrows (int): number of rows to read
+
+    Returns:
+        dict: 'rows' (nrows lists of cell values, padded with None) and 'dimension'
+              (the sheet's dimension ref, e.g. 'A1:U60', or None),
+              or None when source is not an xlsx file
+    """
+    position = source.tell() if hasattr(source, 'tell') else None
+    try:
+        with zipfile.ZipFile(source) as archive:
+            cells = {}
+            dimension = None
+            with archive.open(first_sheet_path(archive)) as sheet:
+                row_number = 0
+                for _, element in ElementTree.iterparse(sheet):
+                    if element.tag == XLSX_MAIN + 'dimension':
+                        dimension = element.get('ref')
+                    elif element.tag == XLSX_MAIN + 'row':
+                        row_number = int(element.get('r', row_number + 1))
+                        if row_number > nrows:
+                            break
+                        for column, cell in enumerate(element.iter(XLSX_MAIN + 'c')):
+                            ref = cell.get('r')
+                            column = column_index(ref) if ref else column
+                            cells[(row_number - 1, column)] = (cell.get('t'), cell_text(cell))
+                        element.clear()
+
+            indices = [int(text) for kind, text in cells.values() if kind == 's' and text]
+            strings = shared_strings(archive, max(indices)) if indices else []
+            width = max([column for _, column in cells] + [0]) + 1
+            rows = [[None] * width for _ in range(nrows)]
+            for (row, column), (kind, text) in cells.items():
+                rows[row][column] = cell_value(kind, text, strings)
+            return {'rows': rows, 'dimension': dimension}
+    except (zipfile.BadZipFile, KeyError):
+        return None
+    finally:
+        if position is not None:
+            source.seek(position)
+
+def first_sheet_path(archive: zipfile.ZipFile) -> str:
+    """
+    Path within the xlsx zip of the first sheet in workbook order.
+    """
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    sheet_id = workbook.find(f'{XLSX_MAIN}sheets/{XLSX_MAIN}sheet').get(XLSX_RELATIONSHIPS + 'id')
+    relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    target = next(rel.get('Target') for rel in relationships.iter(XLSX_PACKAGE_RELATIONSHIPS + 'Relationship') if rel.get('Id') == sheet_id)
+    return target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+def column_index(ref: str) -> int:
+    """
+    Zero based column of a cell reference, e.g. 'AB7' -> 27.
+    """
+    index = 0
+    for char in ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - ord('A') + 1
+    return index - 1
+
+def cell_text(cell) -> str:
+    """
+    Raw text of a sheet cell: the <v> value, or the joined <t> runs of an inline string.
+    """
+    if cell.get('t') == 'inlineStr':
+        return ''.join(t.text or '' for t in cell.iter(XLSX_MAIN + 't'))
+    value = cell.find(XLSX_MAIN + 'v')
+    return value.text if value is not None else None
+
+def shared_strings(archive: zipfile.ZipFile, max_index: int) -> list:
+    """
+    Shared strings up to max_index, the rest of the table is not read.
+    """
+    strings = []
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return strings
+    with archive.open('xl/sharedStrings.xml') as table:
+        for _, element in ElementTree.iterparse(table):
+            if element.tag == XLSX_MAIN + 'si':
+                # phonetic runs (rPh) are not part of the displayed text
+                strings.append(''.join(
+                    t.text or '' for t in element.iter(XLSX_MAIN + 't')
+                    if t not in element.findall(f'{XLSX_MAIN}rPh/{XLSX_MAIN}t')
+                ))
+                element.clear()
+                if len(strings) > max_index:
+                    break
+    return strings
+
+def cell_value(kind: str, text: str, strings: list):
+    """
+    Python value of a sniffed cell, typed like openpyxl returns it.
+    """
+    if text is None or (kind == 'inlineStr' and text == ''):
+        return None
+    if kind == 's':
+        return strings[int(text)]
+    if kind == 'b':
+        return text == '1'
+    if kind in ('str', 'inlineStr', 'e', 'd'):
+        return text
+    number = float(text)
+    return int(number) if number.is_integer() and not any(char in text for char in '.eE') else number
+
+def first_rows(df_workbook: pd.ExcelFile, nrows: int = 9) -> list:
+    """
+    First rows of the first sheet as lists of cell values, sniffed from the zip when the
+    workbook is xlsx and read by pandas otherwise.
+    """
+    sniffed = sniff_workbook(df_workbook.io, nrows)
+    if sniffed is not None:
+        return sniffed['rows']
+    rows = read_sheet(df_workbook, nrows).astype(object).where(lambda df: df.notna(), None).values.tolist()
+    return rows + [[None]] * (nrows - len(rows))
+
+def plan_import(df_workbook, size: int, rows: list, memory_budget_mb: int = MEMORY_BUDGET_MB, samples_per_chunk: int = 500) -> dict:
+    """
+    Choose how to clean a certificate from its size, before the sheet is parsed.
+
+    The sheet's cell count comes from its declared dimension when the workbook is xlsx, and
+    from the file size otherwise. The eager path holds the whole sheet several times over while
+    it transposes and melts, the streaming path only the file and one chunk of samples.
+
+    Args:
+        df_workbook: workbook opened by open_workbook()
+        size (int): file size in bytes
+        rows (list): first rows from first_rows(), the widest gives the column count
+
+    Returns:
+        dict: plan ('eager', 'stream' or 'defer'), cells, source of the cell count,
+              estimated eager and stream peak and the budget, in MB
+    """
+    columns = max([len(row) for row in rows] + [1])
+    cells, source = size / FILE_BYTES_PER_CELL, 'size'
+    sniffed = sniff_workbook(df_workbook.io, nrows=0)
+    dimension = sniffed['dimension'] if sniffed else None
+    if dimension and ':' in dimension:
+        # a declared dimension of a single cell is not trustworthy, see iter_clean_lab_results()
+        first, last = dimension.split(':')
+        row_count = int(''.join(filter(str.isdigit, last))) - int(''.join(filter(str.isdigit, first))) + 1
+        column_count = column_index(last) - column_index(first) + 1
+        cells, source = row_count * column_count, 'dimension'
+        columns = max(columns, column_count)
+
+    eager_mb = cells * EAGER_BYTES_PER_CELL / 2**20
+    stream_mb = (size * STREAM_BYTES_PER_FILE_BYTE + samples_per_chunk * columns * EAGER_BYTES_PER_CELL) / 2**20
+    if eager_mb <= memory_budget_mb:
+        plan = 'eager'
+    elif stream_mb <= memory_budget_mb:
+        plan = 'stream'
+    else:
+        plan = 'defer'
+    return {
+        'plan': plan,
+        'cells': int(cells),
+        'source': source,
+        'eager_mb': round(eager_mb, 1),
+        'stream_mb': round(stream_mb, 1),
+        'budget_mb': memory_budget_mb,
+    }
+
+def single_flight(key: str, fn):
+    """
+    Run fn() once for concurrent callers with the same key in this process. The first caller
+    runs it, the others wait for it and share its result (or its exception).
+
+    Returns:
+        tuple: (result of fn, True when the result came from another caller's run)
+    """
+    with _in_flight_lock:
+        call = _in_flight.get(key)
+        leader = call is None
+        if leader:
+            call = _in_flight[key] = {'done': threading.Event(), 'result': None, 'error': None}
+    if not leader:
+        call['done'].wait()
+        if call['error'] is not None:
+            raise call['error']
+        return call['result'], True
+    try:
+        call['result'] = fn()
+        return call['result'], False
+    except Exception as e:
+        call['error'] = e
+        raise
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+        call['done'].set()
+
 def get_sql_connection(vault_id, logger):
-    identity = DefaultAzureCredential()
-    secretClient = SecretClient(vault_url=f"https://{vault_id}.vault.azure.net/", credential=identity)
     try:
-        sql_conn_string = secretClient.get_secret('sql-connection').value
+        sql_conn_string = get_secret(vault_id, 'sql-connection')
         return sql_conn_string, ""
-    except ClientAuthenticationError as e:
+    except azure_exceptions.ClientAuthenticationError as e:
         logger.error(e)
         return None, "Secret client authentication 'sql-connection' failed."    
 
@@ -83,7 +599,13 @@ def create_response(
         project = '',
         comments = '',
         po_number = '',
-        logger = ''
+        logger = '',
+        duplicate_count = '',
+        rejected_count = '',
+        updated_count = '',
+        unchanged_count = '',
+        removed_count = '',
+        version = ''
     ):
     """_summary_
 
@@ -94,7 +616,7 @@ def create_response(
         importance (str): _description_
         inserted_count (str): _description_
         sample_count (str): _description_
-        updated_count (str): _description_
+        updated_count (str): matched rows rewritten because their content changed
         work_order_status (str): _description_
         client_ref (str): _description_
         samples_submitted (str): _description_
@@ -103,7 +625,12 @@ def create_response(
         project (str): _description_
         comments (str): _description_
         po_number (str): _description_
-        
+        duplicate_count (str): rows with a repeated key resolved before insert
+        rejected_count (str): rows quarantined by the insert because of bad values
+        unchanged_count (str): matched rows skipped because their content hash was unchanged
+        removed_count (str): rows deleted because a reissued certificate no longer has them
+        version (str): version of the job recorded by a reissue import
+
     Returns:
         _type_: _description_
     """
@@ -122,20 +649,153 @@ def create_response(
         "date_finalized": date_finalized,
         "project": project,
         "comments": comments,
-        "po_number": po_number
+        "po_number": po_number,
+        "duplicate_count": duplicate_count,
+        "rejected_count": rejected_count,
+        "updated_count": updated_count,
+        "unchanged_count": unchanged_count,
+        "removed_count": removed_count,
+        "version": version
     })
     logger.info(f"INFO: JSON response {output}")
     return func.HttpResponse(output)
 
+def add_to_response(response: func.HttpResponse, **fields) -> func.HttpResponse:
+    """
+    The JSON response of create_response with extra fields, e.g. the link to a profile.
+    """
+    output = json.loads(response.get_body())
+    output.update(fields)
+    return copy_response(response, json.dumps(output))
+
+def copy_response(response: func.HttpResponse, body=None) -> func.HttpResponse:
+    """
+    A new response with the status code, headers and mimetype of `response`, and its body
+    unless another is given. single_flight() callers each return their own copy.
+    """
+    return func.HttpResponse(
+        response.get_body() if body is None else body,
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        mimetype=response.mimetype,
+        charset=response.charset
+    )
+
+def detect_date_format(values: pd.Series, sample_size: int = 50):
+    """
+    Find the first entry of DATE_FORMATS that parses every value in a sample of the column.
+    Returns None when no single format fits, i.e. the column is mixed.
+    """
+    sample = values.dropna().head(sample_size)
+    if sample.empty:
+        return None
+    for fmt in DATE_FORMATS:
+        if pd.to_datetime(sample, format=fmt, errors='coerce').notna().all():
+            return fmt
+    return None
+
+def parse_dates(values, key: str = None, logger=None) -> pd.Series:
+    """
+    Parse a column of dates in one vectorised pass.
+
+    The format is detected once from a sample and memoised under `key`
+    (e.g. the column name), so later files skip detection. Values the
+    detected format does not parse fall back to the remaining known formats,
+    one vectorised pass each, then to pandas' per-value inference. Ambiguous
+    dates such as 09/01/2024 are read day first, as the labs write them,
+    unless another value of the sample, e.g. 12/31/2024, makes the column
+    month first. Year first dates such as 2024-09-01 are never swapped.
+    Anything still unparsed becomes NaT and is logged.
+
+    Args:
+        values: series or list-like of dates, strings or datetimes
+        key (str, optional): memo key for the detected format
+        logger (optional): logger warned about values no format parses
+
+    Returns:
+        pd.Series: datetime64 series aligned with `values`
+    """
+    series = values if isinstance(values, pd.Series) else pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    text = series.astype('string').str.strip()
+    text = text.mask(text == '')
+
+    fmt = _date_formats.get(key) if key else None
+    if fmt is None:
+        fmt = detect_date_format(text)
+        if key and fmt:
+            _date_formats[key] = fmt
+
+    parsed = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    formats = [fmt] + [f for f in DATE_FORMATS if f != fmt] if fmt else DATE_FORMATS
+    for candidate in formats:
+        pending = parsed.isna() & text.notna()
+        if not pending.any():
+            break
+        parsed[pending] = pd.to_datetime(text[pending], format=candidate, errors='coerce')
+    pending = parsed.isna() & text.notna()
+    if pending.any():
+        parsed[pending] = pd.to_datetime(text[pending], format='mixed', dayfirst=True, errors='coerce')
+        unparsed = text[parsed.isna() & text.notna()]
+        if len(unparsed) and logger is not None:
+            logger.warning(f"WARNING: {len(unparsed)} unparsed dates{f' in {key}' if key else ''} set to NULL, e.g. {', '.join(unparsed.head(5).tolist())}")
+    return parsed
+
+def format_dates(values, key: str = None, fmt: str = '%Y-%m-%d %H:%M:%S', logger=None) -> pd.Series:
+    """
+    Parse a column with parse_dates() and format it for SQL, blanks and unparsed values become None.
+    """
+    parsed = parse_dates(values, key, logger)
+    return parsed.dt.strftime(fmt).astype(object).where(parsed.notna(), None)
+
+def normalize_date_columns(df: pd.DataFrame, columns: list, fmt: str = '%Y-%m-%d %H:%M:%S') -> pd.DataFrame:
+    """
+    Apply format_dates() to each of `columns` present in a logging sheet, memoised by column name.
+    Values that no known format parses are kept as logged.
+    """
+    for col in columns:
+        if col in df.columns:
+            formatted = format_dates(df[col], col, fmt)
+            df[col] = formatted.where(formatted.notna(), df[col])
+    return df
+
 def parse_date(date_str):
-    date_str = str(date_str).strip()
-    formats = ['%Y', '%Y-%m', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S']
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_str, fmt)
-        except ValueError:
+    parsed = parse_dates([date_str]).iloc[0]
+    return None if pd.isna(parsed) else parsed.to_pydatetime()
+
+def split_categorical(series: pd.Series, sep: str, names: list) -> dict:
+    """
+    Split a categorical series on `sep` into one categorical series per name.
+    The string split runs once per category and the row codes are remapped,
+    so the result never materialises the strings for every row.
+    """
+    codes = series.cat.codes.to_numpy()
+    parts = series.cat.categories.to_series().str.split(sep, expand=True)
+    split = {}
+    for i, name in enumerate(names):
+        part_codes, part_categories = pd.factorize(parts[i])
+        # keep missing values (code -1) missing after the remap
+        row_codes = np.where(codes == -1, -1, part_codes[codes])
+        split[name] = pd.Series(
+            pd.Categorical.from_codes(row_codes, categories=part_categories),
+            index=series.index
+        )
+    return split
+
+def to_categorical(df: pd.DataFrame, columns=CATEGORICAL_COLUMNS) -> pd.DataFrame:
+    """
+    Dictionary encode the repeating key columns of the long-format assay frame.
+    Columns that are already categorical only have their unused categories dropped.
+    """
+    for col in columns:
+        if col not in df.columns:
             continue
-    return None
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.remove_unused_categories()
+        else:
+            df[col] = df[col].astype('category')
+    return df
 
 def make_unique_columns(columns):
     """
@@ -196,27 +856,91 @@ def parse_path(path: str) -> dict :
         print(f"An error occurred: {e}")
         return None 
 
-def clean_lab_results(df: pd.DataFrame) -> pd.DataFrame:
+def clean_lab_results(df: pd.DataFrame, layout: lab_formats.LabLayout = lab_formats.ALS_ARABIA) -> pd.DataFrame:
     """Clean lab results from excel file in to results dataframe
 
     Args:
         file_path (str): path to file
+        layout (LabLayout): layout of the certificate, see lab_formats.detect_layout()
 
     Returns:
         pd.DataFrame: results dataframe
     """
     # import excel file dataframe
-    df_results = pd.read_excel(df, header=None, sheet_name=0)
+    df_results = read_sheet(df)
     #extract job title
-    job_title = df_results.iloc[0, 0]
-    # Remove the first 7 rows
-    df_results = df_results.iloc[7:]
+    row, column, _ = layout.header_fields['job_title']
+    job_title = df_results.iloc[row, column]
+    # Remove the header rows
+    df_results = df_results.iloc[layout.header_rows:]
+    return reshape_lab_results(df_results, job_title, layout)
+
+def iter_clean_lab_results(df: pd.ExcelFile, samples_per_chunk: int = 500, layout: lab_formats.LabLayout = lab_formats.ALS_ARABIA):
+    """Stream lab results from the excel file as cleaned chunks of `samples_per_chunk` samples
+
+    The first sheet is read row by row, so only one chunk of the sheet is held at a time.
+    Each chunk has the same columns as clean_lab_results().
+
+    Args:
+        df (pd.ExcelFile): workbook
+        samples_per_chunk (int): sample rows per chunk
+        layout (LabLayout): layout of the certificate
+
+    Yields:
+        pd.DataFrame: results dataframe for the next samples
+    """
+    if isinstance(df, pd.ExcelFile) and df.engine == 'openpyxl':
+        sheet = df.book.worksheets[0]
+        # read only sheets can carry a wrong dimension, pd.read_excel resets it too
+        sheet.reset_dimensions()
+        rows = sheet.iter_rows(values_only=True)
+    else:
+        # text and xlsb sheets are read whole, they are far cheaper to hold than an openpyxl parse
+        rows = read_sheet(df).itertuples(index=False, name=None)
+    header_rows = list(itertools.islice(rows, layout.header_rows))
+    row, column, _ = layout.header_fields['job_title']
+    job_title = excel_cell_value(header_rows[row][column])
+    parameter_rows = list(itertools.islice(rows, len(layout.parameter_rows)))
+    while True:
+        sample_rows = list(itertools.islice(rows, samples_per_chunk))
+        if not sample_rows:
+            break
+        df_chunk = pd.DataFrame(parameter_rows + sample_rows).map(excel_cell_value)
+        df_chunk = reshape_lab_results(df_chunk, job_title, layout)
+        if len(df_chunk):
+            yield df_chunk
+
+def excel_cell_value(value):
+    """
+    Convert a raw openpyxl cell value the way pd.read_excel does: blanks and NA strings become NaN,
+    whole floats become int.
+    """
+    if value is None or (isinstance(value, str) and value in EXCEL_NA_VALUES):
+        return np.nan
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def reshape_lab_results(df_results: pd.DataFrame, job_title, layout: lab_formats.LabLayout = lab_formats.ALS_ARABIA) -> pd.DataFrame:
+    """Reshape the wide results block (parameter rows, then one row per sample) in to long format
+
+    Args:
+        df_results (pd.DataFrame): results block of the sheet, without header rows
+        job_title: job title of the certificate
+        layout (LabLayout): names of the parameter rows and the qualifier grammar
+
+    Returns:
+        pd.DataFrame: results dataframe
+    """
+    parameter_count = len(layout.parameter_rows)
     # Transpose dataframe
     transposed_df_results = df_results.T
-    # Merge first three columns
-    transposed_df_results['Parameter'] = transposed_df_results.iloc[:, 0].astype(str) + '|' + transposed_df_results.iloc[:, 1].astype(str) + '|' + transposed_df_results.iloc[:, 2].astype(str)
+    # Merge the parameter columns
+    transposed_df_results['Parameter'] = transposed_df_results.iloc[:, 0].astype(str)
+    for i in range(1, parameter_count):
+        transposed_df_results['Parameter'] += '|' + transposed_df_results.iloc[:, i].astype(str)
     # Drop the original columns and keep the merged one
-    transposed_df_results = transposed_df_results.drop(transposed_df_results.columns[:3], axis=1)
+    transposed_df_results = transposed_df_results.drop(transposed_df_results.columns[:parameter_count], axis=1)
     # extract the columsn as a list
     columns = transposed_df_results.columns.to_list()
     #remove newly created column from dataframe
@@ -233,83 +957,169 @@ def clean_lab_results(df: pd.DataFrame) -> pd.DataFrame:
     df_results = df_results.iloc[1:].reset_index(drop=True)
     # melt (unpivot) the dataframe
     df_results = df_results.melt (id_vars = df_results.columns[0], var_name = 'attribute', value_name = 'text_value')
-    # Split 'Column1' into two new columns based on the delimiter '|'
-    df_results[['lab_method', 'analyte', 'unit']] = df_results['attribute'].str.split('|', expand=True)
+    # Split 'Column1' into three new columns based on the delimiter '|'
+    # the split runs on the few hundred distinct attributes, not on every row
+    df_results['attribute'] = df_results['attribute'].astype('category')
+    for name, part in split_categorical(df_results['attribute'], '|', list(layout.parameter_rows)).items():
+        df_results[name] = part
     # replace '%' with 'perc'
     #df_results['unit'] = df_results['unit'].replace('%', 'perc')
     # drop split column
     df_results = df_results.drop(columns=['attribute'])
     #rename columns
     df_results = df_results.rename(columns={df_results.columns[0]: 'sample_id'})
+    df_results['sample_id'] = df_results['sample_id'].astype('category')
     # remove null lab results from dataframe
-    df_results = df_results[(~df_results['text_value'].isnull()) & (df_results['text_value'] != '')]
-    # qualifier from value
-    df_results['qualifier'] = np.where(df_results['text_value'].str.contains('<', na=False), '<',
-                    np.where(df_results['text_value'].str.contains('>', na=False), '>', 
-                    None))
-
-    df_results['value'] =  df_results['text_value']
-    df_results['value'].str.replace('[<>]', '', regex=True)
-    df_results['value'] = [''.join(c for c in str(value) if c.isdigit() or c == '.') for value in df_results['value']]
-    # df_results['value'] = pd.to_numeric(df_results['value'], errors='coerce')  # Convert to numeric, invalid values -> NaN
-    # df_results = df_results.dropna()  
+    df_results = df_results[(~df_results['text_value'].isnull()) & (df_results['text_value'] != '')].copy()
+    # numbers and strings such as '<0.01' share the column, keep it text so it has one type
+    df_results['text_value'] = df_results['text_value'].astype(str)
+    # qualifier from value, the first of the layout's qualifiers found wins
+    qualifier = np.full(len(df_results), None, dtype=object)
+    for symbol in reversed(layout.qualifiers):
+        qualifier = np.where(df_results['text_value'].str.contains(symbol, regex=False), symbol, qualifier)
+    df_results['qualifier'] = pd.Categorical(qualifier, categories=list(layout.qualifiers))
 
+    # keep only the characters of the number
+    df_results['value'] = df_results['text_value'].str.replace(layout.value_pattern, '', regex=True)
     df_results['value'] = pd.to_numeric(df_results['value'], errors='coerce')  # Coerce non-numeric to nan
     df_results['value'] = df_results['value'].replace(np.nan, None) 
-    df_results['value'] != 0
-    df_results['value'] != None
-    df_results['job_title'] = job_title
-    return df_results
+    df_results['job_title'] = pd.Categorical.from_codes(np.zeros(len(df_results), dtype='int8'), categories=[job_title])
+    return to_categorical(df_results)
 
-def clean_lab_header(df: pd.DataFrame) -> pd.DataFrame:
-    # import excel file dataframe
-    df_header = pd.read_excel(df, header=None, sheet_name=0)
-    #file_name_with_extension = file_path.split('/')[-1]
-    #extract job title
-    job_title = df_header.iloc[0, 0]
-    # Remove the first 7 rows
-    df_header = df_header.iloc[:7]
+def clean_lab_header(df: pd.DataFrame, rows: list = None, layout: lab_formats.LabLayout = lab_formats.ALS_ARABIA, logger=None) -> pd.DataFrame:
+    """Clean the certificate header in to a one row dataframe
 
-    # Transpose dataframe
-    df_header = df_header.T
-    df_header = df_header.replace('', pd.NA)
-    df_header = df_header.dropna()
-
-    # Get the name of the first column
-    first_col = df_header.columns[0]
-    # Split the first column and create the two new columns
-    df_header['job_number'] = df_header[first_col].str.split('-').str[0]
-    df_header['result_status'] = df_header[first_col].str.split('-').str[1]
-
-    date_column = df_header[3]
-    date_columns = date_column.str.split('DATE', expand=True)
-    date_rec = date_columns[1].str.split(':', expand=True)
-    date_received = date_rec[1] 
-    date_final = date_columns[2].str.split(':', expand=True)
-    date_finalised = date_final[1] 
-    df_header['date_received'] = date_received
-    df_header['date_finalized'] = date_finalised    
-    # Function to process a datetime value: convert empty/null to None or format valid values
-    def format_datetime(value):
-        if pd.isnull(value) or value == '':
-            return None  # Convert empty/blank values to NULL
-        else:
-            return pd.to_datetime(value).strftime('%Y-%m-%d 00:00:00')  # Convert valid dates to YYYY-MM-DD 00:00:00 format
-
-    # Apply the formatting function
-    df_header['date_received'] = df_header['date_received'].apply(format_datetime)
-    df_header['date_finalized'] = df_header['date_finalized'].apply(format_datetime)
-
-    df_header = df_header.drop(columns=[3])
-    df_header = df_header.rename(columns={0: 'job_title'})
-    df_header = df_header.rename(columns={1: 'client_ref'})
-    df_header = df_header.rename(columns={2: 'quantity'})
-    df_header = df_header.rename(columns={4: 'project'})
-    df_header = df_header.rename(columns={5: 'cert_comment'})
-    df_header = df_header.rename(columns={6: 'po_number'})
-    df_header['job_title'] = job_title
+    Args:
+        df (pd.ExcelFile): workbook
+        rows (list): first rows already sniffed by first_rows(), used instead of reading the file again
+        layout (LabLayout): header cell positions of the certificate
+        logger (optional): logger warned about header dates that do not parse
+
+    Returns:
+        pd.DataFrame: header dataframe
+    """
+    # import excel file dataframe, the header is in the first rows
+    if rows is None:
+        rows = read_sheet(df, layout.header_rows).values.tolist()
+    header = {}
+    for field, (row, column, pattern) in layout.header_fields.items():
+        header[field] = header_value(rows, row, column, pattern)
+    df_header = pd.DataFrame([header])
+    # Convert empty/blank values to NULL and valid dates to YYYY-MM-DD 00:00:00 format
+    for field in layout.date_fields:
+        df_header[field] = format_dates(df_header[field], field, '%Y-%m-%d 00:00:00', logger)
     return df_header
 
+def header_value(rows: list, row: int, column: int, pattern=None):
+    """
+    Value of a header cell, or the first group of pattern in it. Blank and missing cells are NaN.
+    """
+    try:
+        value = rows[row][column]
+    except IndexError:
+        return np.nan
+    if value is None or value == '' or (isinstance(value, float) and np.isnan(value)):
+        return np.nan
+    if pattern is None:
+        return value
+    match = pattern.search(value) if isinstance(value, str) else None
+    return match.group(1) if match else np.nan
+
+def join_lab_header(df_results: pd.DataFrame, df_headers: pd.DataFrame, source_name: str, laboratory: str, import_timestamp: str) -> pd.DataFrame:
+    """
+    Join the header on to the results based on job title and add the import columns.
+    """
+    df = pd.merge(df_results, df_headers, on='job_title', how='left')
+    df = to_categorical(df)
+    df['source_name'] = source_name
+    df['laboratory'] = laboratory
+    df['srk_import_timestamp'] = import_timestamp
+    return df
+
+def iter_lab_import(df_workbook: pd.ExcelFile, df_headers: pd.DataFrame, source_name: str, laboratory: str, import_timestamp: str, duplicate_policy: str, duplicates: dict, samples_per_chunk: int = 500, layout: lab_formats.LabLayout = lab_formats.ALS_ARABIA):
+    """
+    Streaming equivalent of clean_lab_results(), join_lab_header() and resolve_duplicate_keys().
+
+    Duplicate keys are resolved within each chunk and counted in `duplicates`
+    (duplicate_rows, examples). Under the reassay policy the rows of each key are
+    counted over all chunks, so a re-assay in a later chunk is numbered after the
+    earlier ones. Under first and last, a key repeated across chunks is left to the
+    insert-only MERGE, which keeps the first row loaded.
+
+    Yields:
+        pd.DataFrame: chunk ready for sql.db_insert_stream()
+    """
+    assays = Counter()
+    for df_results in iter_clean_lab_results(df_workbook, samples_per_chunk, layout):
+        df = join_lab_header(df_results, df_headers, source_name, laboratory, import_timestamp)
+        df, report = resolve_duplicate_keys(df, ['sample_id', 'lab_method', 'analyte'], duplicate_policy, assays)
+        duplicates['duplicate_rows'] = duplicates.get('duplicate_rows', 0) + report['duplicate_rows']
+        duplicates['examples'] = (duplicates.get('examples', []) + report['examples'])[:10]
+        yield df
+
+def resolve_duplicate_keys(df: pd.DataFrame, keys: list, policy: str = 'first', assays: Counter = None) -> tuple:
+    """
+    Resolve rows that share the same key within one file, so the MERGE source is unique.
+
+    Policies:
+    - first: keep the first occurrence of each key
+    - last: keep the last occurrence of each key
+    - reassay: keep every row, numbered 0 (the original), 1, 2, ... in REASSAY_COLUMN, which
+      assay_keys() adds to the match keys. The analyte name is left as the lab wrote it
+
+    Args:
+        df (pd.DataFrame): long-format results
+        keys (list): key columns, e.g. ['sample_id', 'lab_method', 'analyte']
+        policy (str): one of DUPLICATE_POLICIES
+        assays (Counter, optional): reassay only, rows per key in earlier chunks of the same
+            file, numbering continues from them and the counter is updated with this chunk
+
+    Returns:
+        tuple: (resolved dataframe, report dictionary)
+    """
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicate policy '{policy}'. Expected one of {', '.join(DUPLICATE_POLICIES)}.")
+
+    if policy == 'reassay':
+        numbers = df.groupby(keys, observed=True, sort=False).cumcount().to_numpy()
+        if assays is not None:
+            key_rows = list(df[keys].itertuples(index=False, name=None))
+            if assays:
+                numbers = numbers + np.fromiter((assays.get(key, 0) for key in key_rows), dtype=numbers.dtype, count=len(key_rows))
+            assays.update(key_rows)
+        df = df.assign(**{REASSAY_COLUMN: numbers.astype('int32')})
+    duplicated = df.duplicated(subset=keys, keep=False)
+    report = {
+        'policy': policy,
+        'duplicate_keys': 0,
+        'duplicate_rows': 0,
+        'examples': []
+    }
+    if not duplicated.any():
+        return df, report
+
+    df_duplicates = df.loc[duplicated, keys].drop_duplicates()
+    report['duplicate_keys'] = len(df_duplicates)
+    report['duplicate_rows'] = int(duplicated.sum()) - len(df_duplicates)
+    report['examples'] = ['|'.join(str(v) for v in row) for row in df_duplicates.head(10).itertuples(index=False)]
+
+    if policy == 'reassay':
+        return df, report
+
+    return df[~df.duplicated(subset=keys, keep=policy)], report
+
+def assay_keys(column_mappings: dict, match_conditions: dict, policy: str) -> tuple:
+    """
+    Column mappings and match conditions of an import resolved with `policy`. Under 'reassay'
+    REASSAY_COLUMN is written and matched on, so every assay of a key is kept as its own row.
+
+    Returns:
+        tuple: (column_mappings, match_conditions)
+    """
+    if policy != 'reassay':
+        return column_mappings, match_conditions
+    return {**column_mappings, REASSAY_COLUMN: REASSAY_COLUMN}, {**match_conditions, REASSAY_COLUMN: REASSAY_COLUMN}
+
 def filter_new_records(df, existing_records):
     """
     Filter out rows from lab `df` that already exist in the database.
@@ -1,3 +1,35 @@
 # Spreadsheet values
 
 ## Sheet names
+
+
+## assay_result columns, shared by http_lab and reprocess.py
+# left is DF right is DB
+ASSAY_COLUMN_MAPPINGS = {
+    'source_name': 'source_name',
+    'sample_id': 'sample_id', 
+    'lab_method': 'lab_method',
+    'analyte': 'analyte', 
+    'unit': 'unit', 
+    'text_value': 'text_value',
+    'qualifier': 'qualifier', 
+    'value': 'value', 
+    'job_title': 'job_title', 
+    'client_ref': 'client_ref', 
+    'quantity': 'quantity', 
+    'project': 'project', 
+    'cert_comment': 'cert_comment',
+    'po_number':'po_number',
+    'job_number':'job_number',
+    'result_status':'result_status',
+    'date_received':'date_received',
+    'date_finalized':'date_finalised',
+    'laboratory':'laboratory',
+    'srk_import_timestamp':'srk_import_timestamp'
+}
+ASSAY_MATCH_CONDITIONS = {
+    'sample_id': 'sample_id', 
+    'lab_method': 'lab_method',
+    'analyte': 'analyte', 
+}
+ASSAY_TABLE = 'assay_result'
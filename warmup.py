@@ -0,0 +1,127 @@
+"""
+Keep-warm priming of a worker, run by the warm_lab timer in function_app.py.
+
+The first import after a worker has idled pays for the heavy imports deferred by
+lazy_imports.py, the managed identity token, the Key Vault secrets, the ODBC driver load and
+the first pass through the parser. warm() does each of these ahead of time: it imports the
+deferred modules, fetches a Key Vault token and refreshes the secrets cached by
+utils.get_secret(), opens a connection that is validated with SELECT 1 and left in the
+driver manager's pool, and cleans WARM_CERTIFICATE from xlsx and CSV. It reports the seconds
+each step took, so a slow step shows in the logs before a real import runs into it.
+"""
+import csv
+import importlib
+import io
+import json
+import time
+
+import lab_formats
+import sql
+import utils
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+
+# modules the first import needs, see lazy_imports.DEFERRED_MODULES
+WARM_MODULES = ('pandas', 'numpy', 'pyarrow.csv', 'openpyxl', 'pyodbc')
+
+# secrets read by an import, refreshed on every run so a request never waits for Key Vault
+WARM_SECRETS = ('sql-connection', 'blob-connection')
+
+KEYVAULT_SCOPE = 'https://vault.azure.net/.default'
+
+# ALS certificate of two samples, just enough rows for every cleaning step
+WARM_CERTIFICATE = [
+    ['WARMUP0001 - FINAL', '', ''],
+    ['CLIENT REF : WARMUP', '', ''],
+    ['QUANTITY : 2', '', ''],
+    ['DATE RECEIVED : 2024-01-02 DATE FINALISED : 2024-01-03', '', ''],
+    ['PROJECT : WARMUP', '', ''],
+    ['COMMENT : none', '', ''],
+    ['PO NUMBER : WARMUP', '', ''],
+    ['METHOD', 'Au-AA23', 'ME-ICP61'],
+    ['SAMPLE DESCRIPTION', 'Au', 'Cu'],
+    ['UNITS', 'ppm', '%'],
+    ['W0001', '0.12', '<0.01'],
+    ['W0002', '>10', '1.5'],
+]
+
+
+def certificate_sources() -> dict:
+    """
+    WARM_CERTIFICATE as the bytes of a .csv and of an .xlsx file, the latter written with openpyxl.
+    """
+    text = io.StringIO()
+    csv.writer(text).writerows(WARM_CERTIFICATE)
+    workbook = io.BytesIO()
+    pd.DataFrame(WARM_CERTIFICATE).to_excel(workbook, header=False, index=False)
+    return {'warmup.csv': text.getvalue().encode(), 'warmup.xlsx': workbook.getvalue()}
+
+
+def warm_parser() -> int:
+    """
+    Clean WARM_CERTIFICATE from each source as import_lab does.
+
+    Returns:
+        int: result rows cleaned, over all sources
+    """
+    rows = 0
+    for filename, data in certificate_sources().items():
+        df_workbook = utils.open_workbook(io.BytesIO(data), filename)
+        first_rows = utils.first_rows(df_workbook)
+        layout, reasons = lab_formats.detect_layout(first_rows)
+        if layout is None:
+            raise ValueError(' '.join(reasons))
+        df_headers = utils.clean_lab_header(df_workbook, first_rows, layout)
+        df = utils.join_lab_header(utils.clean_lab_results(df_workbook, layout), df_headers, filename, layout.laboratory, '')
+        df, _ = utils.resolve_duplicate_keys(df, ['sample_id', 'lab_method', 'analyte'])
+        rows += len(df)
+    return rows
+
+
+def warm(vault_id, logger) -> dict:
+    """
+    Prime the caches of this worker for the next import.
+
+    Args:
+        vault_id (str): Key Vault name, the token, secret and SQL steps are skipped without it
+        logger: logger for failed steps
+
+    Returns:
+        dict: seconds per step ('skipped' or the error for steps that did not run), the total
+        seconds and a status of 'success' or 'failed'
+    """
+    steps = {}
+    failed = []
+
+    def step(name, call):
+        start = time.perf_counter()
+        try:
+            detail = call()
+        except Exception as e:
+            logger.warning(f'WARNING: Warm-up step {name} failed: {e}')
+            steps[name] = f'failed: {e}'
+            failed.append(name)
+            return None
+        steps[name] = round(time.perf_counter() - start, 3)
+        return detail
+
+    start = time.perf_counter()
+    step('imports', lambda: [importlib.import_module(module) for module in WARM_MODULES])
+    if vault_id:
+        step('token', lambda: utils.credential().get_token(KEYVAULT_SCOPE))
+        step('secrets', lambda: [utils.get_secret(vault_id, name, refresh=True) for name in WARM_SECRETS])
+        if 'secrets' not in failed:
+            connection = step('sql', lambda: sql.validate_connection(utils.get_secret(vault_id, 'sql-connection'), logger))
+            if connection is not None and connection['status'] != 'success':
+                steps['sql'] = connection['status']
+                failed.append('sql')
+        else:
+            steps['sql'] = 'skipped'
+    else:
+        steps.update(token='skipped', secrets='skipped', sql='skipped')
+    step('parser', warm_parser)
+
+    result = {'steps': steps, 'seconds': round(time.perf_counter() - start, 3), 'status': 'failed' if failed else 'success'}
+    logger.info(f"INFO: Warm-up {json.dumps(result)}")
+    return result